@@ -14,9 +14,48 @@ import cv2
 import os
 import shutil
 import calibration
+import calibration_cache
 import textwrap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from dtrack_params import dtrack_params
+import parallel
+from chessboard_detection import find_chessboard, frame_sharpness,\
+    grid_irregularity, to_grey
+
+# Candidate frames are checked in batches of this many frames per detection
+# worker. Larger batches keep the workers busy, smaller batches stop sooner
+# once enough frames have been found.
+DETECTION_BATCH_PER_WORKER = 4
+
+# When reading candidate frames in order, gaps of up to this many frames are
+# skipped by decoding (grabbing) frames rather than seeking, which is usually
+# faster for compressed video.
+MAX_GRAB_GAP = 30
+
+# Number of threads used to write cached images (PNG compression releases the
+# GIL so this overlaps with reading the video).
+IMAGE_WRITE_THREADS = 2
+
+# In the 'diverse' frame selection mode, this many candidate frames are found
+# for each frame which is kept (see select_diverse_frames()).
+DIVERSE_CANDIDATES_PER_FRAME = 4
+
+# Image coverage is measured on a grid with this many cells (columns, rows).
+COVERAGE_GRID = (16, 9)
+
+# Candidates whose corners are less regular than this (see
+# grid_irregularity()) are assumed to be misdetected and are not selected.
+MAX_GRID_IRREGULARITY = 0.3
+
+# Views are only pruned from the intrinsic calibration if their reprojection
+# error is also this many times the median error of all views (so that a
+# camera which is poorly modelled everywhere does not lose all its views).
+OUTLIER_MEDIAN_FACTOR = 2.0
+
+# Pruning never leaves fewer than this many views.
+MIN_CALIBRATION_VIEWS = 6
 
 def define_object_chessboard(n_rows, n_columns, square_size):
     """
@@ -88,12 +127,14 @@ def select_extrinsic_frame(video_path, calibration_cache, chessboard_size):
                     cv2.LINE_AA # Line type
                     )
                 
-        chessboard_found, corners = cv2.findChessboardCorners(frame,
-                                                              chessboard_size)               
-        cv2.drawChessboardCorners(frame, 
-                                  chessboard_size, 
-                                  corners, 
-                                  patternWasFound=chessboard_found)
+        chessboard_found, corners = find_chessboard(frame,
+                                                    chessboard_size,
+                                                    full_resolution_fallback=True)
+        if chessboard_found:
+            cv2.drawChessboardCorners(frame, 
+                                      chessboard_size, 
+                                      corners, 
+                                      patternWasFound=chessboard_found)
         
         
         cv2.imshow(window, frame)
@@ -127,8 +168,9 @@ def select_extrinsic_frame(video_path, calibration_cache, chessboard_size):
             cv2.imwrite(os.path.join(path, '000.png'), frame)                
 
             # Detect chessboard corners and save to file.
-            success, corners = cv2.findChessboardCorners(frame,
-                                                   chessboard_size)
+            success, corners = find_chessboard(frame,
+                                               chessboard_size,
+                                               full_resolution_fallback=True)
             
             if success:
                 corners.dump(os.path.join(path, 'corners', '000.dat'))
@@ -163,8 +205,11 @@ def store_corners_from_image_file(image_path,
 
     # Load frame and attempt to find chessboard corners
     frame = cv2.imread(image_path)
-    success, corners = cv2.findChessboardCorners(frame, chessboard_size)
-    cv2.drawChessboardCorners(frame, chessboard_size, corners, patternWasFound=success)
+    success, corners = find_chessboard(frame,
+                                       chessboard_size,
+                                       full_resolution_fallback=True)
+    if success:
+        cv2.drawChessboardCorners(frame, chessboard_size, corners, patternWasFound=success)
 
     if not success:
         # If corners were not found inform the user
@@ -229,18 +274,314 @@ def store_corners_from_image_file(image_path,
 
                
 
+def spread_frame_order(frame_count, offset=0):
+    """
+    Order the frames of a video such that every prefix of the order is spread
+    evenly over the whole video (a bit-reversal permutation). Checking frames
+    in this order means that the frames found first come from all parts of
+    the video rather than just the start.
+
+    :param frame_count: The number of frames in the video.
+    :param offset: Rotation applied to the order (e.g. a random offset so that
+                   repeated runs use different frames).
+    :return: An array containing every frame index exactly once.
+    """
+    frame_count = int(frame_count)
+    bits = max(int(np.ceil(np.log2(max(frame_count, 1)))), 1)
+    keys = np.arange(2**bits)
+
+    reversed_keys = np.zeros_like(keys)
+    for bit in range(bits):
+        reversed_keys |= ((keys >> bit) & 1) << (bits - 1 - bit)
+
+    order = reversed_keys[reversed_keys < frame_count]
+    return (order + offset) % frame_count
+
+def read_frames(cap, frame_indices):
+    """
+    Read a set of frames from a video capture in ascending order. Small gaps
+    between frames are skipped by grabbing frames rather than seeking.
+
+    :param cap: An OpenCV VideoCapture.
+    :param frame_indices: The frame indices to read (in ascending order).
+    :return: A generator of (frame index, frame) pairs. The frame is None if it
+             could not be read.
+    """
+    position = None
+    for frame_idx in frame_indices:
+        frame_idx = int(frame_idx)
+        if (position is None) or (frame_idx < position) or\
+           (frame_idx - position > MAX_GRAB_GAP):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+            position = frame_idx
+
+        while position < frame_idx:
+            cap.grab()
+            position += 1
+
+        success, frame = cap.read()
+        position += 1
+        yield frame_idx, (frame if success else None)
+
+def detect_chessboard_frames(video_path,
+                             chessboard_size,
+                             N,
+                             workers=1,
+                             min_sharpness=0,
+                             exclude=None,
+                             progress=None,
+                             random_state=None):
+    """
+    Find N frames in a video which contain the chessboard.
+
+    Frames are checked in an order which spreads them over the whole video
+    (see spread_frame_order()). Each batch of candidate frames is decoded in
+    ascending order and the chessboard detection is run by a pool of worker
+    processes. Checking stops once N frames with a chessboard have been found;
+    if a batch finds more than N, the frames found earliest in the spread order
+    are kept so that the result still covers the whole video.
+
+    Blurred frames (e.g. while the board is being moved) rarely contain a
+    usable chessboard, so candidates whose sharpness (see frame_sharpness())
+    is below min_sharpness times the median sharpness of the frames checked so
+    far are skipped without running the detection.
+
+    :param video_path: The filepath to the calibration video.
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :param N: The number of frames to find.
+    :param workers: The number of detection processes (0 = one per CPU).
+    :param min_sharpness: Sharpness threshold relative to the median sharpness
+                          (0 = check every frame).
+    :param exclude: Optional list of frame indices which should not be
+                    checked (e.g. frames which are already cached).
+    :param progress: Optional callback, called after each batch with the number
+                     of frames found and the number of frames checked so far.
+    :param random_state: Optional numpy RandomState (for repeatable selection).
+    :return: A list of (frame index, corners) pairs sorted by frame index. This
+             has fewer than N entries if not enough frames could be found.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    workers = parallel.worker_count(workers)
+    batch_size = max(DETECTION_BATCH_PER_WORKER * workers, 1)
+
+    cap = cv2.VideoCapture(video_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    order = spread_frame_order(frame_count,
+                               offset=random_state.randint(max(frame_count, 1)))
+
+    # Rank of each frame in the spread order, used to choose between frames
+    # found in the same batch.
+    rank = np.empty(frame_count, dtype=np.int64)
+    rank[order] = np.arange(frame_count)
+
+    if exclude is not None:
+        order = order[~np.isin(order, exclude)]
+
+    found = dict()
+    checked = 0
+    skipped = 0
+    sharpness = []
+
+    executor = None
+    if workers > 1:
+        # Spawn rather than fork, as with the smoothing workers.
+        context = multiprocessing.get_context('spawn')
+        executor = ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=context)
+
+    try:
+        for start in range(0, len(order), batch_size):
+            batch = np.sort(order[start:start + batch_size])
+
+            # Detection does not need colour, so only keep the (smaller)
+            # greyscale frames.
+            candidates = []
+            for frame_idx, frame in read_frames(cap, batch):
+                if frame is None:
+                    continue
+
+                grey = to_grey(frame)
+                score = frame_sharpness(grey) if min_sharpness > 0 else 0
+                candidates.append((frame_idx, grey, score))
+                sharpness.append(score)
+
+            if min_sharpness > 0:
+                threshold = min_sharpness * np.median(sharpness)
+                sharp = [c for c in candidates if c[2] >= threshold]
+                skipped += len(candidates) - len(sharp)
+                candidates = sharp
+
+            results = []
+            for frame_idx, grey, _ in candidates:
+                if executor is None:
+                    results.append((frame_idx,
+                                    find_chessboard(grey, chessboard_size)))
+                else:
+                    results.append((frame_idx,
+                                    executor.submit(find_chessboard,
+                                                    grey,
+                                                    chessboard_size)))
+
+            for frame_idx, result in results:
+                if executor is not None:
+                    result = result.result()
+
+                chessboard_found, corners = result
+                if chessboard_found:
+                    found[frame_idx] = corners
+
+            checked += len(batch)
+            print("Checked {} frames ({} skipped as blurred), chessboard found in {}"
+                  .format(checked, skipped, len(found)))
+
+            if progress is not None:
+                progress(min(len(found), N), checked)
+
+            if len(found) >= N:
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        cap.release()
+
+    selected = sorted(found, key=lambda frame_idx: rank[frame_idx])[:N]
+    return [(frame_idx, found[frame_idx]) for frame_idx in sorted(selected)]
+
+def board_features(corners, chessboard_size, image_size):
+    """
+    Describe where a chessboard is in an image and how it is tilted, for use
+    by select_diverse_frames().
+
+    :param corners: The chessboard corners (N x 1 x 2).
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :param image_size: The image size (width, height).
+    :return: Multiple return, a boolean mask (COVERAGE_GRID cells, rows first)
+             of the cells covered by the chessboard and the tilt of the
+             chessboard (the perspective terms of the homography from the
+             chessboard grid to the image, normalised by the image width).
+    """
+    width, height = image_size
+    grid = corners.reshape(chessboard_size[1], chessboard_size[0], 2)
+
+    # Coverage: fill the outline of the chessboard on the coarse grid.
+    outline = np.array([grid[0, 0], grid[0, -1], grid[-1, -1], grid[-1, 0]])
+    cell_scale = np.array([COVERAGE_GRID[0] / width, COVERAGE_GRID[1] / height])
+    mask = np.zeros((COVERAGE_GRID[1], COVERAGE_GRID[0]), dtype=np.uint8)
+    cv2.fillConvexPoly(mask, np.round(outline * cell_scale).astype(np.int32), 1)
+
+    # Tilt: a fronto-parallel chessboard has no perspective terms; the terms
+    # grow with the tilt and their direction gives the tilt axis.
+    board_points = np.array([[c / (chessboard_size[0] - 1),
+                              r / (chessboard_size[1] - 1)]
+                             for r in range(chessboard_size[1])
+                             for c in range(chessboard_size[0])],
+                            dtype=np.float32)
+    homography, _ = cv2.findHomography(board_points,
+                                       grid.reshape(-1, 2) / width)
+    tilt = homography[2, :2] / homography[2, 2]
+
+    return mask.astype(bool), tilt
+
+def select_diverse_frames(detections, N, chessboard_size, image_size):
+    """
+    Greedily choose N frames which between them cover as much of the image
+    as possible with as wide a range of chessboard tilts as possible. Both
+    matter for calibration: coverage constrains the distortion model and tilt
+    constrains the focal length.
+
+    At each step, the frame with the largest combined gain is chosen, where
+    the coverage gain counts the grid cells the frame covers (cells already
+    covered by chosen frames count less each time they are covered) and the
+    tilt gain is the distance to the nearest tilt already chosen. Each gain is
+    scaled by its largest value at that step so that neither dominates.
+
+    Frames near the edge of the image are the most useful for coverage but
+    also the most likely to be misdetected, so frames whose corners do not
+    form a smooth grid are left out (unless there are not enough others).
+
+    :param detections: A list of (frame index, corners) pairs.
+    :param N: The number of frames to choose.
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :param image_size: The image size (width, height).
+    :return: The chosen (frame index, corners) pairs sorted by frame index.
+    """
+    regular = [(frame_idx, corners) for frame_idx, corners in detections
+               if grid_irregularity(corners, chessboard_size) <= MAX_GRID_IRREGULARITY]
+    if len(regular) >= N:
+        if len(regular) < len(detections):
+            print("Ignoring {} frames where the chessboard corners are irregular"
+                  .format(len(detections) - len(regular)))
+        detections = regular
+
+    if len(detections) <= N:
+        return sorted(detections, key=lambda d: d[0])
+
+    features = [board_features(corners, chessboard_size, image_size)
+                for _, corners in detections]
+    masks = np.array([mask.ravel() for mask, _ in features], dtype=np.float64)
+    tilts = np.array([tilt for _, tilt in features])
+
+    coverage_count = np.zeros(masks.shape[1])
+    nearest_tilt = np.full(len(detections), np.inf)
+    available = np.ones(len(detections), dtype=bool)
+    chosen = []
+    for _ in range(N):
+        coverage_gain = masks @ (1 / (1 + coverage_count))
+        if len(chosen) == 0:
+            # Prefer strongly tilted boards to start with.
+            tilt_gain = np.linalg.norm(tilts, axis=1)
+        else:
+            tilt_gain = nearest_tilt.copy()
+
+        gain = coverage_gain / max(coverage_gain[available].max(), 1e-12) +\
+               tilt_gain / max(tilt_gain[available].max(), 1e-12)
+        gain[~available] = -np.inf
+
+        best = int(np.argmax(gain))
+        chosen.append(best)
+        available[best] = False
+        coverage_count += masks[best]
+        nearest_tilt = np.minimum(nearest_tilt,
+                                  np.linalg.norm(tilts - tilts[best], axis=1))
+
+    return sorted((detections[i] for i in chosen), key=lambda d: d[0])
+
 def cache_calibration_video_frames(video_path, 
                                    chessboard_size,
                                    N=15, 
-                                   frame_cache='calibration_image_cache'):
+                                   frame_cache='calibration_image_cache',
+                                   workers=None,
+                                   min_sharpness=None,
+                                   selection=None,
+                                   cache_images=None,
+                                   progress=None):
     """
     Select N frames from a calibration video where the chessboard is successfully
-    found.
+    found (see detect_chessboard_frames()).
+
+    Frames are selected in one of two ways:
+    - 'spread': the first N frames found, spread over the whole video.
+    - 'diverse': several times more frames are found and the N which best
+      cover the image with the widest range of chessboard tilts are kept
+      (see select_diverse_frames()).
 
     :param video_path: The filepath to the calibration video
     :param chessboard_size: The dimensions of the chessboard (inner corners).
     :param N: the number of frames you want to find.
     :param frame_cache: The caching directory to use for calibration frames.
+    :param workers: The number of detection processes (0 = one per CPU). If
+                    None, the detection_workers option is used.
+    :param min_sharpness: Relative sharpness below which frames are skipped
+                          (see detect_chessboard_frames()). If None, the
+                          min_frame_sharpness option is used.
+    :param selection: The frame selection mode, 'spread' or 'diverse'. If
+                      None, the frame_selection option is used.
+    :param cache_images: If True, a full resolution image of each frame is
+                         also written to the cache. If None, the cache_images
+                         option is used.
+    :param progress: Optional progress callback (see detect_chessboard_frames).
 
     :return: True on success
     """
@@ -248,82 +589,98 @@ def cache_calibration_video_frames(video_path,
     print("Attempting to build calibration cache")
     print("")
 
-    # Init random generator, can be used to make repeatable randomness for testing
-    # by providing a seed.
-    random_state = np.random.RandomState()
+    if workers is None:
+        workers = dtrack_params["options.autocalibration.detection_workers"]
+    if min_sharpness is None:
+        min_sharpness = dtrack_params["options.autocalibration.min_frame_sharpness"]
+    if selection is None:
+        selection = dtrack_params["options.autocalibration.frame_selection"]
+    if cache_images is None:
+        cache_images = dtrack_params["options.autocalibration.cache_images"]
 
     # Open OpenCV video capture
     cap = cv2.VideoCapture(video_path)
     frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    image_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                  int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
 
     if N > frame_count:
         print("Cache construction failed!")
         print("You selected N to be greater than the number of frames in the calibration video ({})."
               .format(frame_count))
-        print("Try again with reduced N (< {}).".forma(frame_count))
+        print("Try again with reduced N (< {}).".format(frame_count))
+        return False
 
-    if not os.path.exists(os.path.join(frame_cache, 'intrinsic')):
-        # Create the intrinsic/corners subdirectory.
-        os.makedirs(os.path.join(frame_cache, 'intrinsic', 'corners'))
-    else:
+    if os.path.exists(os.path.join(frame_cache, 'intrinsic')):
         # Clear old calibration cache
         shutil.rmtree(os.path.join(frame_cache, 'intrinsic'))
-        os.makedirs(os.path.join(frame_cache, 'intrinsic', 'corners'))
-
-    # Compute random frame selection
-    sample_indices = random_state.choice(range(int(frame_count)),
-                                         size=int(N),
-                                         replace=False)
-
-    # Cache appropriate images for intrinsic calibration
-    failed_indices = []
-    idx = 0
-    while idx < len(sample_indices):
-        frame_idx = sample_indices[idx]
-
-        print("Chessboard check, frame {}".format(frame_idx))
-
-        # Set capture position and get frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-        _, frame = cap.read()
-
-        chessboard_found, corners = cv2.findChessboardCorners(frame,
-                                                              chessboard_size)
+    os.makedirs(os.path.join(frame_cache, 'intrinsic'))
 
-        if not chessboard_found:
-            print("Failed to find chessboard in frame, trying a new frame...")
+    n_candidates = N
+    if selection == 'diverse':
+        n_candidates = int(min(DIVERSE_CANDIDATES_PER_FRAME * N, frame_count))
 
+    detections = detect_chessboard_frames(video_path,
+                                          chessboard_size,
+                                          n_candidates,
+                                          workers=workers,
+                                          min_sharpness=min_sharpness,
+                                          progress=progress)
 
-            # Note, this may be prone to failure if the chessboard cannot be found
-            # in enough frames (software will freeze)
-            failed_indices.append(frame_idx) # Keep track of failed frames
-            new_choice = frame_idx
-
-            if (len(failed_indices) + len(sample_indices)) > frame_count:
-                print("Cache construction failed!")
-                print("You asked for {} calibration frames but I could only find {}"
-                      .format(N, idx))
-                print("Reduce your chosen N to be less than {}".format(idx))
-                print("")
-                return False
-            
-            # Look for a new (random) frame index which hasn't been tried already
-            # and isn't in the current sample_indices list.
-            while ((new_choice in failed_indices) or (new_choice in sample_indices)):
-                new_choice = random_state.choice(range(int(frame_count)), size=1)
+    if len(detections) < N:
+        print("Cache construction failed!")
+        print("You asked for {} calibration frames but I could only find {}"
+              .format(N, len(detections)))
+        print("Reduce your chosen N to be less than {}".format(len(detections)))
+        print("")
+        return False
 
-            # Replace the current frame with the new one to try again.
-            sample_indices[idx] = new_choice
-            
-            continue # continue without index increment to try again.
+    if selection == 'diverse':
+        print("Choosing {} of {} frames for coverage and tilt"
+              .format(N, len(detections)))
+        detections = select_diverse_frames(detections,
+                                           N,
+                                           chessboard_size,
+                                           image_size)
+
+    # Save the corners to the cache. The selected frames are re-read (in
+    # order) rather than holding every candidate frame in memory; full
+    # resolution images are only written if requested, in the background
+    # while the remaining frames are read. Frames which cannot be re-read
+    # are dropped.
+    frame_indices = []
+    corners = []
+    thumbnails = []
+    with ThreadPoolExecutor(max_workers=IMAGE_WRITE_THREADS) as image_writer:
+        frames = read_frames(cap, [frame_idx for frame_idx, _ in detections])
+        for (frame_idx, frame), (_, frame_corners) in zip(frames, detections):
+            if frame is None:
+                print("Frame {} could not be read, not used".format(frame_idx))
+                continue
+
+            print("Chessboard found in frame {}".format(frame_idx))
+            if cache_images:
+                filepath = os.path.join(frame_cache,
+                                        "intrinsic",
+                                        "{:03d}.png".format(len(frame_indices)))
+                image_writer.submit(cv2.imwrite, filepath, frame)
+            frame_indices.append(frame_idx)
+            corners.append(frame_corners)
+            thumbnails.append(calibration_cache.make_thumbnail(frame))
+
+    cap.release()
+
+    if len(frame_indices) == 0:
+        print("Cache construction failed! The calibration frames could not be read.")
+        print("")
+        return False
 
-        # If the chessboard was found, then save the image and the corners to the cache
-        filepath = os.path.join(frame_cache, "intrinsic", "{:03d}.png".format(idx))
-        corner_file = os.path.join(frame_cache, "intrinsic", "corners", "{:03d}.dat".format(idx))
-        print("Chessboard found, caching image at {}".format(filepath))
-        cv2.imwrite(filepath, frame)
-        corners.dump(corner_file)
-        idx += 1
+    calibration_cache.save(frame_cache,
+                           corners,
+                           frame_indices,
+                           image_size,
+                           chessboard_size,
+                           thumbnails=thumbnails)
 
     print("")
     print("Calibration cache constructed succcessfully at:")
@@ -332,93 +689,111 @@ def cache_calibration_video_frames(video_path,
 
     return True
 
-def generate_calibration_from_cache(chessboard_columns,
-                                    chessboard_rows,
-                                    square_size,
-                                    cache_path='calibration_image_cache',
-                                    metadata=""):
+def calibrate_intrinsics(object_points,
+                         image_points,
+                         frame_size,
+                         flags,
+                         camera_matrix=None,
+                         distortion=None,
+                         max_view_error=0):
     """
-    Generate a calibration file from an image cache (constructed using
-    cache_calibration_video_frames()).
-
-    :param chessboard_columns: The number of columns in the chessboard
-    :param chessboard_rows: The number of rows in the chessboard
-    :param square_size: The square size of the chessboard
-    :param cache_path: The location where the calibration cache is stored
-    :param metadata: A short description of this calibration
-
-    :return: True on success
+    Intrinsic calibration with automatic removal of outlying views. After
+    each solve, the view with the largest reprojection error is removed if
+    its error is above max_view_error and OUTLIER_MEDIAN_FACTOR times the
+    median, and the calibration is re-solved (starting from the previous
+    solution). This is repeated until no view is an outlier.
+
+    :param object_points: The chessboard object points for each view.
+    :param image_points: The chessboard corners for each view.
+    :param frame_size: The frame size (as passed to cv2.calibrateCamera).
+    :param flags: Calibration flags (see cv2.calibrateCamera).
+    :param camera_matrix: Optional initial camera matrix (requires
+                          cv2.CALIB_USE_INTRINSIC_GUESS in flags).
+    :param distortion: Optional initial distortion coefficients.
+    :param max_view_error: Views with a larger RMS reprojection error (px) may
+                           be removed (0 = keep every view).
+    :return: Multiple return, the overall reprojection error, camera matrix,
+             distortion, rotation and translation vectors (kept views only),
+             the reprojection error of every view (for removed views, the
+             error when they were removed), and the indices of the removed
+             views.
     """
+    views = list(range(len(image_points)))
+    view_errors = np.zeros(len(image_points))
+    pruned = []
+
+    while True:
+        rproj_err, camera_matrix, distortion, rvecs, tvecs, _, _, errors =\
+            cv2.calibrateCameraExtended([object_points[i] for i in views],
+                                        [image_points[i] for i in views],
+                                        frame_size,
+                                        camera_matrix,
+                                        distortion,
+                                        flags=flags)
+        errors = errors.ravel()
+        view_errors[views] = errors
+
+        worst = int(np.argmax(errors))
+        if (max_view_error <= 0) or\
+           (len(views) <= MIN_CALIBRATION_VIEWS) or\
+           (errors[worst] <= max_view_error) or\
+           (errors[worst] <= OUTLIER_MEDIAN_FACTOR * np.median(errors)):
+            break
 
-    object_chessboard, chessboard_size =\
-        define_object_chessboard(chessboard_rows, chessboard_columns, square_size)
-    
-    object_chessboard = object_chessboard.astype(np.uint8)
-
-    # Work out object points
-    object_points = []
-    _, obj_points = cv2.findChessboardCorners(object_chessboard, 
-                                              chessboard_size)
-
-    # OpenCV wants the object points as an array of the form 
-    # [[x1, y1, 0], ... , [xN, yN, 0]] (which isn't what the above function returns)
-    # This list manipulation augments each point with a 0 and strips out one of
-    # the additional dimensions given by findChessboardCorners.
-    obj_points =\
-          np.array([ (np.append(op[0], 0.0)) for op in obj_points]).astype(np.float32)
-
-    #
-    # Intrinsic calibration
-    #
+        pruned.append(views.pop(worst))
+        flags |= cv2.CALIB_USE_INTRINSIC_GUESS
 
-    # Read in pattern corners from cache
-    corner_file_list = os.listdir(os.path.join(cache_path, 'intrinsic', 'corners'))
-    
-    image_points = []
-    for file in corner_file_list:
-        filepath = os.path.join(cache_path, "intrinsic", "corners", file)
-        points = np.load(filepath, allow_pickle=True)
-        image_points.append(points)
-
-        # Note, OpenCV requires the number of sets of object points and the 
-        # number of sets of image points to be the same. I don't know why
-        # as object points are presumably constant and never change. To
-        # satisfy OpenCV we replicate the object points for each set of 
-        # image points.
-        object_points.append(obj_points)
-
-    # Determine image size
-    imagepath = os.path.join(cache_path, 'intrinsic', '000.png')
-    sample_frame = cv2.imread(imagepath)
-    frame_size = sample_frame.shape[:2]
+    return rproj_err, camera_matrix, distortion, rvecs, tvecs, view_errors, pruned
 
-    #
-    # Compute camera calibration.
-    #
+def print_view_errors(view_errors, pruned_views, frame_indices=None):
+    """
+    Print the reprojection error of each calibration view.
 
-    # The camera model assumes more variability than should actually be
-    # possible with a standard consumer video camera which is correctly 
-    # configured for experiments.
+    :param view_errors: The RMS reprojection error of each view (px).
+    :param pruned_views: The indices of views removed from the calibration.
+    :param frame_indices: Optional video frame index for each view.
+    """
+    print("Reprojection error per view:")
+    for view, error in enumerate(view_errors):
+        frame = "" if frame_indices is None else\
+                " (frame {})".format(frame_indices[view])
+        status = " - removed" if view in pruned_views else ""
+        print("  View {:3d}{}: {:.3f} px{}".format(view, frame, error, status))
+
+    if len(pruned_views) > 0:
+        print("{} of {} views were removed as outliers"
+              .format(len(pruned_views), len(view_errors)))
+    print("")
 
-    # Avoid changing k2 and k3 radial distortion parameters and assume no
-    # tangent distortion. This is drawn from Yakir and corroberated with some
-    # online discussion on OpenCV calibration
-    fix_k1 = cv2.CALIB_FIX_K1 * int(dtrack_params["options.autocalibration.fix_k1"])
-    fix_k2 = cv2.CALIB_FIX_K2 * int(dtrack_params["options.autocalibration.fix_k2"])
-    fix_k3 = cv2.CALIB_FIX_K3 * int(dtrack_params["options.autocalibration.fix_k3"])
-    zero_tangent = cv2.CALIB_ZERO_TANGENT_DIST * int(dtrack_params["options.autocalibration.fix_tangential"])
+def extrinsic_calibration(cache_path,
+                          mtx,
+                          dist,
+                          rvecs,
+                          tvecs,
+                          rproj_err,
+                          frame_size,
+                          obj_points,
+                          chessboard_size,
+                          square_size,
+                          metadata=""):
+    """
+    Complete a calibration given the intrinsic calibration: find the
+    perspective transformation and scale from the extrinsic (ground) image in
+    the calibration cache.
 
-    # These are user configurable but by default, only K1 is enabled and other
-    # params (k2, k3, and tangential distortion) are fixed.
-    flags = fix_k1 + fix_k2 + fix_k3 + zero_tangent
-    
-    rproj_err, mtx, dist, rvecs, tvecs =\
-          cv2.calibrateCamera(object_points, 
-                              image_points,
-                              frame_size,
-                              None,
-                              None,
-                              flags=flags)
+    :param cache_path: The location where the calibration cache is stored
+    :param mtx: The camera matrix
+    :param dist: The distortion coefficients
+    :param rvecs: Rotation vectors from the intrinsic calibration
+    :param tvecs: Translation vectors from the intrinsic calibration
+    :param rproj_err: Reprojection error from the intrinsic calibration
+    :param frame_size: The frame size (rows, columns)
+    :param obj_points: The chessboard object points
+    :param chessboard_size: The dimensions of the chessboard (inner corners)
+    :param square_size: The square size of the chessboard
+    :param metadata: A short description of this calibration
+    :return: The Calibration or None if the extrinsic calibration failed.
+    """
     optmtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, frame_size, 1, frame_size)
 
     #
@@ -429,8 +804,9 @@ def generate_calibration_from_cache(chessboard_columns,
     undistorted_extrinsic =\
           cv2.undistort(extrinsic_img, mtx, dist, newCameraMatrix=optmtx)
     
-    success, ext_points = cv2.findChessboardCorners(undistorted_extrinsic,
-                                                    chessboard_size)
+    success, ext_points = find_chessboard(undistorted_extrinsic,
+                                          chessboard_size,
+                                          full_resolution_fallback=True)
     
     if not success:
         print("")
@@ -446,7 +822,7 @@ def generate_calibration_from_cache(chessboard_columns,
         print("or modifying modifying the available calibration parameters in the")
         print("options screen.")
 
-        return False
+        return None
     
     # Compute the perspective transformation between an undistorted image plane and the 
     # ground plane.
@@ -476,17 +852,32 @@ def generate_calibration_from_cache(chessboard_columns,
     # Augment the homography to include the translation correction
     corrected_homography = A @ homography
   
+    calib = calibration.Calibration(
+        matrix=mtx,
+        distortion=dist,
+        opt_matrix=optmtx,
+        rvecs=rvecs,
+        tvecs=tvecs,
+        reprojection_error=rproj_err,
+        perspective_transform=corrected_homography,
+        bbox_width=bwidth,
+        bbox_height=bheight,
+        metadata=metadata,
+        chessboard_size=chessboard_size,
+        chessboard_square_size=square_size,
+        uncorrected_homography=homography,
+        corrective_transform=A
+    )
+
     #
     # Scale - scale transformation between undistorted perspective shifted (calibrated)
     # image and the object checkerboard.
     #
-    calibrated_extrinsic_frame = cv2.warpPerspective(undistorted_extrinsic,
-                                                     corrected_homography,
-                                                     (bwidth, bheight),
-                                                     borderValue=255)
+    calibrated_extrinsic_frame = calib.rectify(extrinsic_img)
     
-    success, img_scale_points = cv2.findChessboardCorners(calibrated_extrinsic_frame, 
-                                                          chessboard_size)
+    success, img_scale_points = find_chessboard(calibrated_extrinsic_frame,
+                                                chessboard_size,
+                                                full_resolution_fallback=True)
     
     #
     # Estimate the average square size detected in the image
@@ -504,25 +895,136 @@ def generate_calibration_from_cache(chessboard_columns,
     mean_distance = np.mean(distances)
 
     # Determine scaling parameter
-    scale = mean_distance / square_size
+    calib.scale = mean_distance / square_size
 
-    calib = calibration.Calibration(
-        matrix=mtx,
-        distortion=dist,
-        opt_matrix=optmtx,
-        rvecs=rvecs,
-        tvecs=tvecs,
-        reprojection_error=rproj_err,
-        perspective_transform=corrected_homography,
-        scale=scale,
-        bbox_width=bwidth,
-        bbox_height=bheight,
-        metadata=metadata,
-        chessboard_size=chessboard_size,
-        chessboard_square_size=square_size,
-        uncorrected_homography=homography,
-        corrective_transform=A
-    )
+    # Precompute the pixel to mm lookup grid for the calibrated resolution so
+    # that tracks can be calibrated by table lookup.
+    world_grid_step = int(dtrack_params["options.autocalibration.world_grid_step"])
+    if world_grid_step > 0:
+        calib.compute_world_grid((frame_size[1], frame_size[0]),
+                                 step=world_grid_step)
+
+    return calib
+
+def generate_calibration_from_cache(chessboard_columns,
+                                    chessboard_rows,
+                                    square_size,
+                                    cache_path='calibration_image_cache',
+                                    metadata="",
+                                    initial_calibration=None):
+    """
+    Generate a calibration file from an image cache (constructed using
+    cache_calibration_video_frames()).
+
+    :param chessboard_columns: The number of columns in the chessboard
+    :param chessboard_rows: The number of rows in the chessboard
+    :param square_size: The square size of the chessboard
+    :param cache_path: The location where the calibration cache is stored
+    :param metadata: A short description of this calibration
+    :param initial_calibration: Optional Calibration whose camera matrix and
+                                distortion are used as the starting point for
+                                the intrinsic calibration (see
+                                refine_calibration()).
+
+    :return: True on success
+    """
+
+    object_chessboard, chessboard_size =\
+        define_object_chessboard(chessboard_rows, chessboard_columns, square_size)
+    
+    object_chessboard = object_chessboard.astype(np.uint8)
+
+    # Work out object points
+    _, obj_points = find_chessboard(object_chessboard,
+                                    chessboard_size,
+                                    max_width=None)
+
+    # OpenCV wants the object points as an array of the form 
+    # [[x1, y1, 0], ... , [xN, yN, 0]] (which isn't what the above function returns)
+    # This list manipulation augments each point with a 0 and strips out one of
+    # the additional dimensions given by findChessboardCorners.
+    obj_points =\
+          np.array([ (np.append(op[0], 0.0)) for op in obj_points]).astype(np.float32)
+
+    #
+    # Intrinsic calibration
+    #
+
+    # Read in pattern corners from cache
+    cache = calibration_cache.load(cache_path)
+    if cache is None:
+        print("No calibration cache found at {}".format(cache_path))
+        return False
+
+    image_points = cache["corners"]
+
+    # Note, OpenCV requires the number of sets of object points and the
+    # number of sets of image points to be the same. I don't know why
+    # as object points are presumably constant and never change. To
+    # satisfy OpenCV we replicate the object points for each set of
+    # image points.
+    object_points = [obj_points] * len(image_points)
+
+    # Frame size as (rows, columns), as it has always been passed to OpenCV
+    # below.
+    frame_size = (cache["image_size"][1], cache["image_size"][0])
+
+    #
+    # Compute camera calibration.
+    #
+
+    # The camera model assumes more variability than should actually be
+    # possible with a standard consumer video camera which is correctly 
+    # configured for experiments.
+
+    # Avoid changing k2 and k3 radial distortion parameters and assume no
+    # tangent distortion. This is drawn from Yakir and corroberated with some
+    # online discussion on OpenCV calibration
+    fix_k1 = cv2.CALIB_FIX_K1 * int(dtrack_params["options.autocalibration.fix_k1"])
+    fix_k2 = cv2.CALIB_FIX_K2 * int(dtrack_params["options.autocalibration.fix_k2"])
+    fix_k3 = cv2.CALIB_FIX_K3 * int(dtrack_params["options.autocalibration.fix_k3"])
+    zero_tangent = cv2.CALIB_ZERO_TANGENT_DIST * int(dtrack_params["options.autocalibration.fix_tangential"])
+
+    # These are user configurable but by default, only K1 is enabled and other
+    # params (k2, k3, and tangential distortion) are fixed.
+    flags = fix_k1 + fix_k2 + fix_k3 + zero_tangent
+
+    initial_mtx = None
+    initial_dist = None
+    if initial_calibration is not None:
+        # Start from the previous intrinsics (fixed distortion parameters
+        # keep their previous values).
+        flags += cv2.CALIB_USE_INTRINSIC_GUESS
+        initial_mtx = initial_calibration.camera_matrix.copy()
+        initial_dist = initial_calibration.distortion.copy()
+    
+    rproj_err, mtx, dist, rvecs, tvecs, view_errors, pruned_views =\
+          calibrate_intrinsics(object_points,
+                               image_points,
+                               frame_size,
+                               flags,
+                               camera_matrix=initial_mtx,
+                               distortion=initial_dist,
+                               max_view_error=dtrack_params["options.autocalibration.max_view_error"])
+
+    print_view_errors(view_errors, pruned_views, cache["frame_indices"])
+
+    calib = extrinsic_calibration(cache_path,
+                                  mtx,
+                                  dist,
+                                  rvecs,
+                                  tvecs,
+                                  rproj_err,
+                                  frame_size,
+                                  obj_points,
+                                  chessboard_size,
+                                  square_size,
+                                  metadata)
+    if calib is None:
+        return False
+
+    calib.per_view_errors = view_errors
+    calib.pruned_views = pruned_views
 
     calib_filepath = os.path.join(cache_path, 'calibration.dt2c')
     calibration.save(calib, calib_filepath)
@@ -530,6 +1032,183 @@ def generate_calibration_from_cache(chessboard_columns,
     return True
 
 
+def add_calibration_frames(video_path,
+                           chessboard_size,
+                           N,
+                           frame_cache='calibration_image_cache',
+                           workers=None,
+                           min_sharpness=None,
+                           cache_images=None,
+                           progress=None):
+    """
+    Find N more frames with a chessboard in the calibration video and add
+    them to an existing calibration cache. Frames which are already cached
+    are not checked again.
+
+    :param video_path: The filepath to the calibration video
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :param N: The number of frames to add.
+    :param frame_cache: The caching directory to use for calibration frames.
+    :param workers: The number of detection processes (see
+                    cache_calibration_video_frames()).
+    :param min_sharpness: Relative sharpness below which frames are skipped
+                          (see cache_calibration_video_frames()).
+    :param cache_images: Write a full resolution image of each added frame
+                         (see cache_calibration_video_frames()).
+    :param progress: Optional progress callback (see detect_chessboard_frames).
+    :return: The number of frames added.
+    """
+    if workers is None:
+        workers = dtrack_params["options.autocalibration.detection_workers"]
+    if min_sharpness is None:
+        min_sharpness = dtrack_params["options.autocalibration.min_frame_sharpness"]
+    if cache_images is None:
+        cache_images = dtrack_params["options.autocalibration.cache_images"]
+
+    cache = calibration_cache.load(frame_cache)
+    if cache is None:
+        print("No calibration cache found at {}".format(frame_cache))
+        return 0
+
+    # The added corners are only usable alongside the cached ones if they
+    # come from the same chessboard and frame size. Older caches do not
+    # record the chessboard size (None).
+    if (cache["chessboard_size"] is not None and
+            tuple(cache["chessboard_size"]) != tuple(chessboard_size)):
+        print("The calibration cache at {} uses a {}x{} chessboard, not {}x{}"
+              .format(frame_cache, *cache["chessboard_size"], *chessboard_size))
+        return 0
+
+    cap = cv2.VideoCapture(video_path)
+    image_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                  int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    if image_size != tuple(cache["image_size"]):
+        print("The calibration cache at {} has {}x{} frames, but {} is {}x{}"
+              .format(frame_cache, *cache["image_size"], video_path, *image_size))
+        cap.release()
+        return 0
+
+    # Older caches do not record which frames were used (-1).
+    frame_indices = cache["frame_indices"]
+    if frame_indices is None:
+        frame_indices = np.full(len(cache["corners"]), -1, dtype=np.int64)
+
+    detections = detect_chessboard_frames(video_path,
+                                          chessboard_size,
+                                          N,
+                                          workers=workers,
+                                          min_sharpness=min_sharpness,
+                                          exclude=frame_indices,
+                                          progress=progress)
+    if len(detections) == 0:
+        cap.release()
+        return 0
+
+    # The frames only need re-reading for thumbnails or images. Added images
+    # are numbered on from the cached ones.
+    thumbnails = cache["thumbnails"]
+    if thumbnails is not None or cache_images:
+        if thumbnails is not None:
+            thumbnails = list(thumbnails)
+        os.makedirs(os.path.join(frame_cache, "intrinsic"), exist_ok=True)
+        readable = []
+        with ThreadPoolExecutor(max_workers=IMAGE_WRITE_THREADS) as image_writer:
+            frames = read_frames(cap, [d[0] for d in detections])
+            for (frame_idx, frame), detection in zip(frames, detections):
+                if frame is None:
+                    print("Frame {} could not be read, not used".format(frame_idx))
+                    continue
+                if cache_images:
+                    filepath = os.path.join(
+                        frame_cache,
+                        "intrinsic",
+                        "{:03d}.png".format(len(cache["corners"]) + len(readable)))
+                    image_writer.submit(cv2.imwrite, filepath, frame)
+                if thumbnails is not None:
+                    thumbnails.append(calibration_cache.make_thumbnail(frame))
+                readable.append(detection)
+
+        detections = readable
+    cap.release()
+
+    if len(detections) == 0:
+        return 0
+
+    calibration_cache.save(frame_cache,
+                           cache["corners"] + [c for _, c in detections],
+                           list(frame_indices) + [d[0] for d in detections],
+                           cache["image_size"],
+                           chessboard_size,
+                           thumbnails=thumbnails)
+
+    print("Added {} frames to the calibration cache ({} frames in total)"
+          .format(len(detections), len(cache["corners"]) + len(detections)))
+
+    return len(detections)
+
+def refine_calibration(chessboard_columns,
+                       chessboard_rows,
+                       square_size,
+                       video_path,
+                       N,
+                       cache_path='calibration_image_cache',
+                       metadata=None,
+                       progress=None):
+    """
+    Improve an existing calibration by adding N frames to its calibration
+    cache and re-solving the intrinsic calibration starting from the existing
+    camera matrix and distortion. This is much quicker than rebuilding the
+    cache and calibration from scratch. The extrinsic calibration is repeated
+    with the existing extrinsic image.
+
+    :param chessboard_columns: The number of columns in the chessboard
+    :param chessboard_rows: The number of rows in the chessboard
+    :param square_size: The square size of the chessboard
+    :param video_path: The filepath to the calibration video
+    :param N: The number of frames to add.
+    :param cache_path: The location where the calibration cache is stored
+    :param metadata: A short description of this calibration (None = keep the
+                     existing description).
+    :param progress: Optional progress callback (see detect_chessboard_frames).
+    :return: Multiple return, True on success and the reprojection errors of
+             the previous and refined calibrations.
+    """
+    calib_filepath = os.path.join(cache_path, 'calibration.dt2c')
+    if not os.path.exists(calib_filepath):
+        print("No calibration found at {}, generate a calibration first."
+              .format(calib_filepath))
+        return False, None, None
+
+    previous = calibration.from_file(calib_filepath)
+    chessboard_size = (chessboard_columns - 1, chessboard_rows - 1)
+
+    if add_calibration_frames(video_path,
+                              chessboard_size,
+                              N,
+                              frame_cache=cache_path,
+                              progress=progress) == 0:
+        print("No new calibration frames could be found.")
+        return False, previous.reprojection_error, None
+
+    if metadata is None:
+        metadata = previous.metadata
+
+    if not generate_calibration_from_cache(chessboard_columns,
+                                           chessboard_rows,
+                                           square_size,
+                                           cache_path=cache_path,
+                                           metadata=metadata,
+                                           initial_calibration=previous):
+        return False, previous.reprojection_error, None
+
+    refined = calibration.from_file(calib_filepath)
+    print("Reprojection error: {:.4f} -> {:.4f} ({:+.4f})"
+          .format(previous.reprojection_error,
+                  refined.reprojection_error,
+                  refined.reprojection_error - previous.reprojection_error))
+
+    return True, previous.reprojection_error, refined.reprojection_error
+
 # These globals are only used to allow the calibration check window to update
 # on mouse clicks. They should not be used for anything else.
 calib_point_ctr = 0
@@ -601,25 +1280,14 @@ def check_calibration(example_image_path, calibration):
     sample_image = cv2.imread(example_image_path)
     dsize = (sample_image.shape[1], sample_image.shape[0])
 
-    # Undistort the sample image
-    undistorted_extrinsic =\
-          cv2.undistort(sample_image, 
-                        calibration.camera_matrix, 
-                        calibration.distortion, 
-                        newCameraMatrix=calibration.opt_matrix)     
-
-      
-    # Warp the image to give a top-down view.
-    check_calibration_frame =\
-          cv2.warpPerspective(undistorted_extrinsic,
-                              calibration.perspective_transform,
-                              (calibration.bbox_width, calibration.bbox_height),
-                              borderValue=255)
+    # Undistort and warp the image to give a top-down view.
+    check_calibration_frame = calibration.rectify(sample_image)
  
    
     # Work out the chessboard corners and draw these on the frame.
-    success, img_scale_points = cv2.findChessboardCorners(check_calibration_frame,
-                                                          chessboard_size)
+    success, img_scale_points = find_chessboard(check_calibration_frame,
+                                                chessboard_size,
+                                                full_resolution_fallback=True)
     
     check_calibration_frame = cv2.drawChessboardCorners(check_calibration_frame,
                                                            chessboard_size,
@@ -648,6 +1316,15 @@ def check_calibration(example_image_path, calibration):
     print("Your square size is {}mm".format(square_size))
     print("Top edge is {} squares".format(chessboard_size[0] - 1))
     print("Length of top edge in mm (true : estimated) -> ({} : {})".format(true_edge_length, estimated_edge_length))    
+    print("Reprojection error -> {:.3f}px".format(calibration.reprojection_error))
+
+    # Calibrations from older versions do not have per-view diagnostics.
+    per_view_errors = getattr(calibration, 'per_view_errors', None)
+    if per_view_errors is not None:
+        pruned_views = getattr(calibration, 'pruned_views', None) or []
+        kept_errors = np.delete(per_view_errors, pruned_views)
+        print("Worst view reprojection error -> {:.3f}px ({} of {} views removed as outliers)"
+              .format(kept_errors.max(), len(pruned_views), len(per_view_errors)))
     print("")
     str = "To check distortion over the whole arena, click on four points on the arena radius." +\
           " These points will be used to define two lines, select points such that" +\
@@ -12,7 +12,7 @@ Related:
 import shutil
 import os
 import tkinter as tk
-from tkinter import messagebox, filedialog, dialog
+from tkinter import messagebox, filedialog, dialog, ttk
 
 from project import project_file
 from dtrack_params import dtrack_params
@@ -113,10 +113,22 @@ class AutocalibrationTool(tk.Toplevel):
         self.__btn_generate = tk.Button(self,
                                         text="Generate!",
                                         command=self.__generate_calibration)
+        self.__btn_refine = tk.Button(self,
+                                      text="Add N frames to existing calibration",
+                                      command=self.__refine_calibration)
+
+        # Progress of the search for calibration frames
+        self.__stv_progress = tk.StringVar()
+        self.__lbl_progress = tk.Label(self,
+                                       textvariable=self.__stv_progress,
+                                       anchor='w')
+        self.__pgb_progress = ttk.Progressbar(self,
+                                              orient='horizontal',
+                                              mode='determinate')
 
         # Set window geometry (grid layout and resizability)
         n_columns = 3
-        n_rows = 5
+        n_rows = 7
         for i in range(n_rows):
             for j in range(n_columns):
                 self.rowconfigure(i, weight=1)
@@ -145,6 +157,11 @@ class AutocalibrationTool(tk.Toplevel):
         self.__lbf_extrinsic_selection.grid(row=4, column=0, columnspan=2, sticky='nesw')
         self.__btn_generate.grid(row=4, column=2, sticky='nesw', padx=10, pady=10)
 
+        self.__lbl_progress.grid(row=5, column=0, sticky='nesw')
+        self.__pgb_progress.grid(row=5, column=1, columnspan=2, sticky='ew', padx=10)
+
+        self.__btn_refine.grid(row=6, column=2, sticky='nesw', padx=10, pady=10)
+
         # Place widgets in extrinsic frame selector
         self.__btn_select_frame.grid(row=0, column=0, sticky='nesw')
         self.__lbl_or.grid(row=0, column=1, sticky='ew')
@@ -173,6 +190,23 @@ class AutocalibrationTool(tk.Toplevel):
         return False
 
 
+    def __update_progress(self, n_found, n_checked):
+        """
+        Progress callback for the calibration frame search.
+
+        :param n_found: The number of frames found with a chessboard.
+        :param n_checked: The number of frames checked so far.
+        """
+        self.__pgb_progress.configure(value=n_found)
+        self.__stv_progress.set("Found {} of {} frames ({} checked)"
+                                .format(n_found,
+                                        self.__pgb_progress['maximum'],
+                                        n_checked))
+
+        # Process pending window events so the window is redrawn while the
+        # search continues.
+        self.update()
+
     def __update_ext_calibration_label(self):
         """
         Update the extrinsic calibration label so that the correct image 
@@ -273,12 +307,27 @@ class AutocalibrationTool(tk.Toplevel):
             return
         
         N_frames = int(self.__stv_N_frames.get())
-        
-        cache_success =\
-              ac.cache_calibration_video_frames(project_file['calibration_video'],
-                                                project_file['chessboard_size'],
-                                                N=N_frames,
-                                                frame_cache=project_file['calibration_cache'])
+
+        # In the diverse selection mode, more candidate frames are found than
+        # are kept.
+        N_candidates = N_frames
+        if dtrack_params["options.autocalibration.frame_selection"] == 'diverse':
+            N_candidates = N_frames * ac.DIVERSE_CANDIDATES_PER_FRAME
+
+        self.__pgb_progress.configure(maximum=N_candidates, value=0)
+        self.__stv_progress.set("Searching for calibration frames...")
+        self.__btn_generate.configure(state='disabled')
+        self.update()
+
+        try:
+            cache_success =\
+                ac.cache_calibration_video_frames(project_file['calibration_video'],
+                                                  project_file['chessboard_size'],
+                                                  N=N_frames,
+                                                  frame_cache=project_file['calibration_cache'],
+                                                  progress=self.__update_progress)
+        finally:
+            self.__btn_generate.configure(state='normal')
         
         if not cache_success:
             msg = "Construction of the calibration cache failed. Check the" +\
@@ -326,3 +375,57 @@ class AutocalibrationTool(tk.Toplevel):
         
         
         
+
+    def __refine_calibration(self):
+        """
+        Add N frames to the existing calibration cache and refine the existing
+        calibration, starting from its camera matrix and distortion.
+        """
+        calib_filepath = os.path.join(project_file['calibration_cache'],
+                                      'calibration.dt2c')
+        if not os.path.exists(calib_filepath):
+            msg = "There is no calibration to refine. Use 'Generate!' to" +\
+                  " create a calibration first."
+            messagebox.showerror(title="No calibration found",
+                                 message=msg)
+            return
+
+        N_frames = int(self.__stv_N_frames.get())
+
+        self.__pgb_progress.configure(maximum=N_frames, value=0)
+        self.__stv_progress.set("Searching for calibration frames...")
+        self.__btn_generate.configure(state='disabled')
+        self.__btn_refine.configure(state='disabled')
+        self.update()
+
+        try:
+            success, previous_error, refined_error =\
+                ac.refine_calibration(
+                    int(project_file['chessboard_columns']),
+                    int(project_file['chessboard_rows']),
+                    int(project_file['chessboard_square_size']),
+                    project_file['calibration_video'],
+                    N_frames,
+                    cache_path=project_file['calibration_cache'],
+                    progress=self.__update_progress)
+        finally:
+            self.__btn_generate.configure(state='normal')
+            self.__btn_refine.configure(state='normal')
+
+        if not success:
+            msg = "Calibration refinement failed. Check the terminal for" +\
+                  " specific error information."
+            messagebox.showerror(title="Refinement failed",
+                                 message=msg)
+            return
+
+        msg = "Reprojection error changed from {:.4f} to {:.4f}."\
+              .format(previous_error, refined_error)
+        messagebox.showinfo(title="Calibration refined", message=msg)
+
+        print("")
+        print("Calibration refined successfully!")
+        print("Closing autocalibration tool.")
+        print("")
+
+        self.destroy()
@@ -11,9 +11,12 @@ import numpy as np
 
 from random import randint
 
-import pandas as pd
 import os
 
+import track_store
+import calibration as calib
+from track_set import TrackSet
+
 from dtrack_params import dtrack_params
 from project import project_file
 
@@ -98,6 +101,16 @@ def autotracker():
 
     print("Chosen tracker: {}".format(desired_tracker))
 
+    # If the project has a calibration, the tracked point is also shown in
+    # world coordinates (mm) using the calibration's lookup grid.
+    calibration = None
+    calibration_filepath = project_file["calibration_file"]
+    if os.path.exists(calibration_filepath):
+        try:
+            calibration = calib.from_file(calibration_filepath)
+        except calib.CalibrationFileError as e:
+            print("Calibration not used: {}".format(e))
+
     # Extract background frame. 
     # A background frame is always computed but if tracking is using the centre
     # of the bbox, then the background subtration isn't used.
@@ -164,6 +177,18 @@ def autotracker():
                               color=colour,
                               thickness=3
                              )
+
+                if calibration is not None:
+                    world_point = calibration.image_to_world(frame_centroid)[0]
+                    cv2.putText(display_frame,
+                                '({:.0f}, {:.0f}) mm'.format(world_point[0],
+                                                             world_point[1]),
+                                (int(bbox[0]), int(bbox[1]) - 10),
+                                cv2.FONT_HERSHEY_SIMPLEX,
+                                0.8,
+                                colour,
+                                2,
+                                cv2.LINE_AA)
             
             frame = display_frame.copy()
             
@@ -547,80 +572,40 @@ def write_track_and_time_to_file(points, timestamps, basepath):
     # If file doesn't exist, we need to create it
     new_file = not os.path.isfile(trackpath)
     if new_file:
-        # Column names are 'track_i_d' where i is the 
-        # index of the track and d is the dimension
-        # (x or y)
-        x_label = 'track_0_x'
-        y_label = 'track_0_y'
-        df = pd.DataFrame(columns=[x_label, y_label])
-        df.loc[:, x_label] = [x for (x,_) in points]
-        df.loc[:, y_label] = [y for (_,y) in points]        
-        df.to_csv(trackpath)
+        # Tracks are labelled 'track_i' where i is the index of the track. In
+        # the CSV file each track has columns 'track_i_d' where d is the 
+        # dimension (x or y).
+        tracks = TrackSet.from_tracks(['track_0'], [points])
+        track_store.write_track_set(tracks, trackpath)
         print("New track file created at {}".format(trackpath))
 
-        time_label = 'track_0'
-        df = pd.DataFrame(columns=[time_label])
-        df.loc[:, time_label] = timestamps
-        df.to_csv(timepath)
+        times = TrackSet.from_tracks(['track_0'], [timestamps], suffixes=[''])
+        track_store.write_track_set(times, timepath)
         print("New timestamp file created at {}".format(timepath)) 
         return 
 
     #
-    # Otherwise, open file, determine track number, and write new data
-    # to dataframe.
+    # Otherwise, open file, determine track number, and add the new track
+    # to the set.
     #
-    df = pd.read_csv(trackpath, index_col=[0])
-    columns = df.columns.to_list()
-    track_idx = int(columns[-1].split("_")[1]) + 1
-    
-    x_col = 'track_{}_x'.format(track_idx)
-    y_col = 'track_{}_y'.format(track_idx)
-    xs = [x for (x,_) in points]
-    ys = [y for (_,y) in points]
-
-    new_cols = pd.DataFrame(columns=[x_col, y_col])
-    new_cols.loc[:, x_col] = xs
-    new_cols.loc[:, y_col] = ys
+    tracks = track_store.read_track_set(trackpath)
+    track_idx = int(tracks.labels[-1].split("_")[1]) + 1
+    track_label = 'track_{}'.format(track_idx)
 
-    # Add new columns to main dataframe.
-    df = ragged_join(df,new_cols)
-    df.to_csv(trackpath)
+    tracks = tracks.append(track_label, points)
+    track_store.write_track_set(tracks, trackpath)
 
     print("Track {} added to {}.".format(track_idx, trackpath))
 
     timefile_exists = os.path.exists(timepath)
     if not timefile_exists:
-        time_label = 'track_{}'.format(track_idx)
-        df = pd.DataFrame(columns=[time_label])
-        df.loc[:, time_label] = timestamps
-        df.to_csv(timepath)
+        times = TrackSet.from_tracks([track_label], [timestamps], suffixes=[''])
+        track_store.write_track_set(times, timepath)
         print("New timestamp file created at {}, starting from Track {}".format(timepath, track_idx)) 
         return
     
-    time_df = pd.read_csv(timepath, index_col=[0])
-    track_col = 'track_{}'.format(track_idx)
-    new_col = pd.DataFrame(columns=[track_col])
-    new_col.loc[:,track_col] = timestamps
-    df = ragged_join(time_df, new_col)
-    df.to_csv(timepath)
+    times = track_store.read_track_set(timepath)
+    times = times.append(track_label, timestamps)
+    track_store.write_track_set(times, timepath)
 
     print("Timestamps stored for track {}".format(track_idx))
-
-def ragged_join(dfA, dfB):
-    """
-    Implements a ragged horizontal join for dataframes.
-
-    Where two dataframes have different lengths of index, this function will
-    replace the index of the shorter dataframe with that of the longer one, then
-    join the two dataframes and return the new complete dataframe.
-
-    :param dfA: The main dataframe to which you want to add columns
-    :param dfB: The additional columns (also a DataFrame)
-    """
-    # If A longer, reindex B and join onto A
-    if len(dfA.index) > len(dfB.index):
-        return dfA.join(dfB.reindex(index=dfA.index))
-    
-    # If B longer, reindex A and join B onto A.
-    return dfA.reindex(index=dfB.index).join(dfB)
-
@@ -0,0 +1,251 @@
+"""
+batch_process.py
+
+Command line tool to process the tracks for many projects at once (e.g. every
+project from an experiment season). Each project is processed exactly as by
+process_tracks.py, in its own worker process, with several projects processed
+at the same time. A failure in one project does not stop the others.
+
+Usage:
+    python batch_process.py [--workers N] [--report FILE] [--no-plot]
+                            [--verbose | --quiet] [--log-file FILE]
+                            project_directory [project_directory ...]
+
+Project directories may be given as glob patterns (e.g. "season_2024/*").
+The log output from each project is written to processing_log.txt in that
+project's directory, and a report with the status and processing time of
+every project is written to batch_report.csv (see --report).
+
+Exit codes:
+    0 - Every project was processed.
+    1 - One or more projects could not be processed.
+    2 - No project directories were given.
+"""
+
+import argparse
+import contextlib
+import glob
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import parallel
+from project import project_filepath
+from process_tracks import process_project, ProcessingError,\
+    configure_logging, log_level, EXIT_SUCCESS, EXIT_FAILURE, EXIT_USAGE,\
+    LOG_FORMAT
+
+LOG_FILENAME = "processing_log.txt"
+REPORT_COLUMNS = ["Status", "Time (s)", "Message", "Log"]
+
+logger = logging.getLogger("batch_process")
+
+def find_projects(patterns):
+    """
+    Expand a list of project directories and/or glob patterns.
+
+    :param patterns: Directories or glob patterns.
+    :return: A list of unique directories (in the order given) which match
+             the patterns.
+    """
+    projects = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            logger.warning("No directories match %s", pattern)
+
+        for match in matches:
+            match = os.path.abspath(match)
+            if os.path.isdir(match) and (match not in projects):
+                projects.append(match)
+
+    return projects
+
+def project_size(project_directory):
+    """
+    :param project_directory: A project directory.
+    :return: The size of the project's raw track file in bytes (0 if it
+             does not have one).
+    """
+    try:
+        return os.path.getsize(os.path.join(project_directory,
+                                            "raw_tracks.csv"))
+    except OSError:
+        return 0
+
+def process_one(project_directory, plot=True, level=logging.INFO):
+    """
+    Process a single project in a worker process. Nothing is raised; any
+    failure is recorded in the result. The log output (and anything else
+    written to stdout or stderr) goes to the project's log file.
+
+    :param project_directory: The project directory.
+    :param plot: If True, the smoothed tracks are plotted and the plot saved.
+    :param level: The logging level for the project's log file.
+    :return: A dictionary with the status, processing time, message, and log
+             file for the project.
+    """
+    result = dict(Status="ok", Message="", Log="")
+    start = time.perf_counter()
+
+    if not os.path.exists(project_filepath(project_directory)):
+        result["Status"] = "failed"
+        result["Message"] = "Not a project directory (no project file found)."
+        result["Time (s)"] = 0.0
+        return result
+
+    log_filepath = os.path.join(project_directory, LOG_FILENAME)
+    result["Log"] = log_filepath
+
+    # Projects are already processed in parallel so each project is smoothed
+    # in its own worker rather than starting more processes.
+    options = {"options.processing.smoothing_workers": 1}
+
+    handler = logging.FileHandler(log_filepath, mode="w")
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(level)
+    logging.getLogger("matplotlib").setLevel(max(level, logging.INFO))
+
+    try:
+        with contextlib.redirect_stdout(handler.stream),\
+             contextlib.redirect_stderr(handler.stream):
+            process_project(project_directory, plot=plot, options=options)
+    except ProcessingError as e:
+        logger.error("%s", e)
+        result["Status"] = "failed"
+        result["Message"] = str(e)
+    except Exception as e:
+        logger.exception("Processing failed for %s", project_directory)
+        result["Status"] = "failed"
+        result["Message"] = "{}: {}".format(type(e).__name__, e)
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+
+    result["Time (s)"] = time.perf_counter() - start
+    return result
+
+def process_projects(projects, workers=0, plot=True, level=logging.INFO):
+    """
+    Process a list of projects using a pool of worker processes.
+
+    :param projects: A list of project directories.
+    :param workers: The number of projects to process at once (0 = one per
+                    CPU).
+    :param plot: If True, the smoothed tracks are plotted and the plot saved.
+    :param level: The logging level for the project log files.
+    :return: A DataFrame indexed by project with a row for every project (see
+             process_one()).
+    """
+    workers = min(parallel.worker_count(workers), max(len(projects), 1))
+
+    # Start the largest projects first so that a large project is not left
+    # running on its own at the end.
+    order = sorted(projects, key=project_size, reverse=True)
+
+    results = dict()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=context) as executor:
+        futures = {executor.submit(process_one, project, plot, level): project
+                   for project in order}
+
+        for future in as_completed(futures):
+            project = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker itself failed (e.g. it was killed).
+                result = dict(Status="failed",
+                              Message="{}: {}".format(type(e).__name__, e),
+                              Log="")
+                result["Time (s)"] = float("nan")
+            results[project] = result
+
+            log_level = logging.INFO if result["Status"] == "ok" else\
+                        logging.ERROR
+            logger.log(log_level,
+                       "[%d/%d] %s %s (%.1f s) %s",
+                       len(results),
+                       len(projects),
+                       result["Status"],
+                       project,
+                       result["Time (s)"],
+                       result["Message"])
+
+    report = pd.DataFrame.from_dict(results, orient="index")
+    report = report.loc[projects, REPORT_COLUMNS]
+    report.index.name = "Project"
+    return report
+
+def main(argv=None):
+    """
+    :param argv: Command line arguments (defaults to sys.argv[1:]).
+    :return: The exit code.
+    """
+    parser = argparse.ArgumentParser(
+        description="Process the tracks for several DungTrack 2 projects.")
+    parser.add_argument("projects",
+                        nargs="+",
+                        help="Project directories or glob patterns.")
+    parser.add_argument("-j", "--workers",
+                        type=int,
+                        default=0,
+                        help="Number of projects to process at once "
+                             "(default: one per CPU).")
+    parser.add_argument("--report",
+                        default="batch_report.csv",
+                        help="File to write the batch report to "
+                             "(default: batch_report.csv).")
+    parser.add_argument("--no-plot",
+                        action="store_true",
+                        help="Do not plot the processed tracks.")
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose",
+                           action="store_true",
+                           help="Show debug output (also in the project "
+                                "log files).")
+    verbosity.add_argument("-q", "--quiet",
+                           action="store_true",
+                           help="Only show warnings and errors (also in the "
+                                "project log files).")
+    parser.add_argument("--log-file",
+                        help="Also write the batch output to this file.")
+    args = parser.parse_args(argv)
+
+    level = log_level(args.verbose, args.quiet)
+    configure_logging(level, args.log_file)
+
+    projects = find_projects(args.projects)
+    if len(projects) == 0:
+        logger.error("No project directories found.")
+        return EXIT_USAGE
+
+    logger.info("Processing %d projects", len(projects))
+    start = time.perf_counter()
+    report = process_projects(projects,
+                              workers=args.workers,
+                              plot=not args.no_plot,
+                              level=level)
+    report.to_csv(args.report)
+
+    n_failed = (report["Status"] != "ok").sum()
+    logger.info("Processed %d of %d projects in %.1f s, report written to %s",
+                len(projects) - n_failed,
+                len(projects),
+                time.perf_counter() - start,
+                args.report)
+
+    return EXIT_SUCCESS if n_failed == 0 else EXIT_FAILURE
+
+# Guard so that worker processes (which re-import this module) do not start
+# processing.
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,75 @@ calibration.py
 
 Provides a class structure for camera calibration information and
 utilities to save and load calibration objects.
+
+Calibration files (.dt2c) are numpy npz files holding the calibration arrays
+and a small JSON header (format version, metadata, sizes, and reprojection
+error) which can be read without loading the arrays. Older versions of
+DungTrack pickled the Calibration object; these files can still be read and
+can be rewritten in the current format with migrate().
 """
 
+import json
+import os
 import pickle
+import zipfile
+
+import numpy as np
+import cv2
+
+FILE_FORMAT = "dt2c"
+FILE_VERSION = 2
+
+# Pickled calibration files have no header, they are reported as version 1.
+LEGACY_FILE_VERSION = 1
+
+# Current files are zip archives (npz), old files are pickles.
+ZIP_MAGIC = b"PK"
+
+# Calibration attributes stored in the file header.
+HEADER_FIELDS = ("metadata",
+                 "reprojection_error",
+                 "scale",
+                 "bbox_width",
+                 "bbox_height",
+                 "chessboard_size",
+                 "chessboard_square_size",
+                 "world_grid_step")
+
+# Calibration attributes stored as arrays.
+ARRAY_FIELDS = ("camera_matrix",
+                "distortion",
+                "opt_matrix",
+                "rvecs",
+                "tvecs",
+                "perspective_transform",
+                "corrective_transform",
+                "uncorrected_homography",
+                "adjustment",
+                "world_grid",
+                "per_view_errors",
+                "pruned_views")
+
+# Array fields which are sequences rather than arrays on the Calibration
+# object, with the conversion from the stored array.
+SEQUENCE_FIELDS = dict(rvecs=tuple,
+                       tvecs=tuple,
+                       pruned_views=lambda views: [int(v) for v in views])
+
+# The only globals an old (pickled) calibration file may refer to (other than
+# the Calibration class itself).
+LEGACY_PICKLE_GLOBALS = {("numpy", "ndarray"),
+                         ("numpy", "dtype"),
+                         ("numpy.core.multiarray", "_reconstruct"),
+                         ("numpy.core.multiarray", "scalar"),
+                         ("numpy._core.multiarray", "_reconstruct"),
+                         ("numpy._core.multiarray", "scalar"),
+                         # Arrays pickled with protocol 5
+                         ("numpy.core.numeric", "_frombuffer"),
+                         ("numpy._core.numeric", "_frombuffer")}
+
+# Calibrations read by from_file(), by path: ((mtime, size), Calibration).
+_loaded = dict()
 
 class Calibration():
     """
@@ -27,7 +93,11 @@ class Calibration():
                  metadata="",
                  corrective_transform=None,
                  uncorrected_homography=None,
-                 adjustment=None):
+                 adjustment=None,
+                 world_grid=None,
+                 world_grid_step=None,
+                 per_view_errors=None,
+                 pruned_views=None):
         """
         :param matrix: The camera matrix
         :param distortion: The distortion coefficients
@@ -49,6 +119,10 @@ class Calibration():
         :param corrective_transform=None: Additional perspective transformation to recentre the calibration board.
         :param uncorrected_homography: The original, unmodified perspective transform
         :param adjustment: Additive adjustment to be applied once the perspective transformation has occurred.
+        :param world_grid: Precomputed world coordinates (mm) for a grid of video pixels (see compute_world_grid)
+        :param world_grid_step: The spacing of the world_grid nodes in pixels
+        :param per_view_errors: The RMS reprojection error of each intrinsic calibration view
+        :param pruned_views: The indices of views which were removed from the intrinsic calibration
         """
 
         self.camera_matrix = matrix
@@ -66,29 +140,492 @@ class Calibration():
         self.corrective_transform=corrective_transform,
         self.uncorrected_homography=uncorrected_homography
         self.adjustment=adjustment
+        self.world_grid = world_grid
+        self.world_grid_step = world_grid_step
+        self.per_view_errors = per_view_errors
+        self.pruned_views = pruned_views
+
+        # Remap maps for rectify() (by scale), computed on first use.
+        self._rectification_maps = None
 
         # Information about the calibration which should be set by the user
         # on generation.
         self.__metadata = metadata
 
+    @property
+    def metadata(self):
+        """
+        :return: The textual information describing this calibration.
+        """
+        return self.__metadata
+
+    def __getstate__(self):
+        """
+        The rectification maps are large and quick to recompute, so they are
+        not stored when the calibration is saved.
+        """
+        state = self.__dict__.copy()
+        state['_rectification_maps'] = None
+        return state
+
+    def rectification_maps(self, scale=1.0):
+        """
+        Maps (for cv2.remap) which take a video frame straight to the
+        calibrated frame: the lens distortion is removed and the perspective
+        transformation applied in a single step. The maps are computed on first
+        use and kept for the lifetime of this object.
+
+        The undistorted image is the video frame viewed through opt_matrix and
+        the calibrated frame is the undistorted image transformed by the
+        perspective transform, so the two steps combine into one 'new camera
+        matrix' (perspective_transform @ opt_matrix).
+
+        :param scale: Scale factor for the calibrated frame (e.g. 0.5 for a
+                      frame of half the width and height).
+        :return: Multiple return, the two remap maps (CV_16SC2 format) for a
+                 calibrated frame of bbox_width x bbox_height (times scale).
+        """
+        # Calibrations stored before the maps were introduced will not have
+        # the attribute.
+        if getattr(self, '_rectification_maps', None) is None:
+            self._rectification_maps = dict()
+
+        maps = self._rectification_maps.get(scale)
+        if maps is None:
+            maps = cv2.initUndistortRectifyMap(self.camera_matrix,
+                                               self.distortion,
+                                               None,
+                                               self.__rectified_camera_matrix(scale),
+                                               self.rectified_size(scale),
+                                               cv2.CV_16SC2)
+            self._rectification_maps[scale] = maps
+
+        return maps
+
+    def rectified_size(self, scale=1.0):
+        """
+        :param scale: Scale factor for the calibrated frame.
+        :return: The size (width, height) of the calibrated frame.
+        """
+        return (max(int(round(self.bbox_width * scale)), 1),
+                max(int(round(self.bbox_height * scale)), 1))
+
+    def rectify(self, frame, scale=1.0, border_value=255):
+        """
+        Transform a video frame into the calibrated frame (undistorted and
+        perspective corrected, see rectification_maps()).
+
+        :param frame: A video frame (at the calibration video's resolution).
+        :param scale: Scale factor for the calibrated frame.
+        :param border_value: The value for pixels which are outside the video
+                             frame.
+        :return: The calibrated frame (see rectified_size()).
+        """
+        map_1, map_2 = self.rectification_maps(scale)
+        return cv2.remap(frame,
+                         map_1,
+                         map_2,
+                         cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_CONSTANT,
+                         borderValue=border_value)
+
+    def image_to_rectified(self, points, scale=1.0):
+        """
+        Transform points from video (pixel) coordinates into pixel coordinates
+        in the calibrated frame (see rectify()), e.g. to draw tracks on a
+        calibrated frame.
+
+        :param points: An N x 2 array of pixel coordinates.
+        :param scale: Scale factor for the calibrated frame.
+        :return: An N x 2 array of calibrated frame pixel coordinates.
+        """
+        points = np.reshape(np.asarray(points, dtype=np.float64), (-1, 2))
+        rectified = np.full(points.shape, np.nan)
+
+        valid = ~np.isnan(points).any(axis=1)
+        if not valid.any():
+            return rectified
+
+        # Undistort straight into the calibrated frame (P is applied to the
+        # normalised coordinates, including the homogeneous division).
+        undistorted = cv2.undistortPoints(points[valid].reshape(-1, 1, 2),
+                                          self.camera_matrix,
+                                          self.distortion)
+        homogeneous = np.hstack((undistorted.reshape(-1, 2),
+                                 np.ones((valid.sum(), 1))))
+        transformed = homogeneous @ self.__rectified_camera_matrix(scale).T
+        rectified[valid] = transformed[:, :2] / transformed[:, 2:]
+
+        return rectified
+
+    def __rectified_camera_matrix(self, scale=1.0):
+        """
+        :param scale: Scale factor for the calibrated frame.
+        :return: The matrix taking normalised camera coordinates to calibrated
+                 frame pixel coordinates.
+        """
+        scaling = np.diag([scale, scale, 1.0])
+        return scaling @ np.asarray(self.perspective_transform) @ self.opt_matrix
+
+    def image_to_world(self, points, exact=False):
+        """
+        Transform points from video (pixel) coordinates into world coordinates
+        (mm). 
+        
+        If this calibration has a world grid (see compute_world_grid) then
+        points inside the grid are converted by bilinear interpolation from the
+        grid. Otherwise, all points are transformed in a single batch: the 
+        intrinsic calibration (lens distortion) is removed, the perspective 
+        transformation is applied as one matrix product (with normalisation by
+        the homogeneous coordinate) and the result is scaled to mm.
+
+        :param points: An N x 2 array of pixel coordinates. Rows containing
+                       NaN are passed through as NaN.
+        :param exact: If True, ignore the world grid and always perform the
+                      full transformation.
+        :return: An N x 2 array of world coordinates in mm.
+        """
+        points = np.reshape(np.asarray(points, dtype=np.float64), (-1, 2))
+        world_points = np.full(points.shape, np.nan)
+
+        valid = ~np.isnan(points).any(axis=1)
+
+        # Calibrations stored before the world grid was introduced will not
+        # have the attribute.
+        world_grid = getattr(self, 'world_grid', None)
+        if (world_grid is not None) and (not exact):
+            step = self.world_grid_step
+            grid_max = (np.array(world_grid.shape[1::-1]) - 1) * step
+            in_grid = valid & (points >= 0).all(axis=1) &\
+                      (points <= grid_max).all(axis=1)
+
+            if in_grid.all():
+                return self.__grid_lookup(points)
+
+            world_points[in_grid] = self.__grid_lookup(points[in_grid])
+            valid = valid & ~in_grid
+
+        if not valid.any():
+            return world_points
+
+        # Intrinsic calibration (camera distortion), OpenCV wants Nx1x2
+        undistorted =\
+            cv2.undistortImagePoints(points[valid].reshape(-1, 1, 2),
+                                     cameraMatrix=self.camera_matrix,
+                                     distCoeffs=self.distortion)
+        undistorted = undistorted.reshape(-1, 2)
+
+        # Extrinsic calibration (camera perspective), each point is
+        # augmented to [x, y, 1] and transformed by the homography.
+        homogeneous = np.hstack((undistorted, np.ones((len(undistorted), 1))))
+        transformed = homogeneous @ np.asarray(self.perspective_transform).T
+        transformed = transformed[:, :2] / transformed[:, 2:]
+
+        # scale = px/mm -> (x px / scale) = y mm
+        world_points[valid] = transformed / self.scale
+
+        return world_points
+
+    def compute_world_grid(self, frame_size, step=4):
+        """
+        Precompute the world coordinates of a regular grid of video pixels so
+        that image_to_world can be performed by table lookup (with bilinear
+        interpolation between grid nodes). The grid is stored as float32 on
+        this calibration object.
+
+        :param frame_size: The video frame size (width, height) in pixels.
+        :param step: The grid spacing in pixels.
+        """
+        width, height = frame_size
+        n_x = int(np.ceil((width - 1) / step)) + 1
+        n_y = int(np.ceil((height - 1) / step)) + 1
+
+        xs, ys = np.meshgrid(np.arange(n_x) * step, np.arange(n_y) * step)
+        nodes = np.stack((xs.ravel(), ys.ravel()), axis=1)
+
+        world_nodes = self.image_to_world(nodes, exact=True)
+        self.world_grid = world_nodes.reshape(n_y, n_x, 2).astype(np.float32)
+        self.world_grid_step = step
+
+    def __grid_lookup(self, points):
+        """
+        Bilinear interpolation of world coordinates from the world grid. Points
+        must lie within the grid.
+
+        :param points: An N x 2 array of pixel coordinates.
+        :return: An N x 2 array of world coordinates in mm.
+        """
+        n_y, n_x = self.world_grid.shape[:2]
+        grid = self.world_grid.reshape(-1, 2)
+        scaled = points / self.world_grid_step
+
+        # Grid node at the top-left of the cell containing each point. Points
+        # on the far edges use the last cell.
+        cx = np.clip(scaled[:, 0].astype(np.int64), 0, n_x - 2)
+        cy = np.clip(scaled[:, 1].astype(np.int64), 0, n_y - 2)
+        tx = (scaled[:, 0] - cx)[:, None]
+        ty = (scaled[:, 1] - cy)[:, None]
+
+        node = cy * n_x + cx
+        top_left = grid[node]
+        top_right = grid[node + 1]
+        bottom_left = grid[node + n_x]
+        bottom_right = grid[node + n_x + 1]
+
+        top = top_left + (top_right - top_left) * tx
+        bottom = bottom_left + (bottom_right - bottom_left) * tx
+        return top + (bottom - top) * ty
+
+class CalibrationFileError(Exception):
+    """
+    Raised when a calibration file cannot be read.
+    """
+
+def _json_value(value):
+    """
+    :param value: A header value (possibly a numpy scalar or array).
+    :return: The value as plain Python types for JSON.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (tuple, list, np.ndarray)):
+        return [_json_value(x) for x in value]
+    return value
+
+def _to_fields(calib_object):
+    """
+    Split a calibration into the file header and its arrays.
+
+    :param calib_object: The Calibration.
+    :return: Multiple return, the header (dict) and the arrays (dict of name
+             to numpy array).
+    """
+    header = dict(format=FILE_FORMAT, version=FILE_VERSION)
+    for field in HEADER_FIELDS:
+        header[field] = _json_value(getattr(calib_object, field, None))
+
+    arrays = dict()
+    for field in ARRAY_FIELDS:
+        value = getattr(calib_object, field, None)
+
+        # corrective_transform is stored by the constructor inside a tuple.
+        if (field == "corrective_transform") and isinstance(value, tuple):
+            value = value[0] if len(value) == 1 else None
+
+        if value is not None:
+            arrays[field] = np.asarray(value)
+
+    header["arrays"] = sorted(arrays)
+    return header, arrays
+
+def _from_fields(header, arrays):
+    """
+    Build a calibration from a file header and its arrays (see _to_fields()).
+
+    :param header: The file header.
+    :param arrays: Dictionary of array name to numpy array.
+    :return: The Calibration.
+    """
+    kwargs = {field: header.get(field) for field in HEADER_FIELDS}
+    if kwargs["chessboard_size"] is not None:
+        kwargs["chessboard_size"] = tuple(kwargs["chessboard_size"])
+    if kwargs["metadata"] is None:
+        kwargs["metadata"] = ""
+
+    for field in ARRAY_FIELDS:
+        value = arrays.get(field)
+        if (value is not None) and (field in SEQUENCE_FIELDS):
+            value = SEQUENCE_FIELDS[field](value)
+        kwargs[field] = value
+
+    kwargs["matrix"] = kwargs.pop("camera_matrix")
+    return Calibration(**kwargs)
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """
+    Unpickler for old (pickled) calibration files which will only create
+    Calibration objects and numpy arrays, so that a file from someone else
+    cannot run arbitrary code when it is loaded.
+    """
+    def find_class(self, module, name):
+        if (module, name) == ("calibration", "Calibration"):
+            return Calibration
+        if (module, name) in LEGACY_PICKLE_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(
+            "Calibration file refers to {}.{}, which is not allowed."
+            .format(module, name))
+
+def is_legacy(filepath):
+    """
+    :param filepath: A calibration file.
+    :return: True if the file is an old (pickled) calibration file.
+    :raises CalibrationFileError: If the file cannot be read.
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            return f.read(len(ZIP_MAGIC)) != ZIP_MAGIC
+    except OSError as e:
+        raise CalibrationFileError(
+            "Could not read calibration file {} ({})".format(filepath, e)) from e
+
+def _load_legacy(filepath):
+    """
+    Read an old (pickled) calibration file.
+
+    :param filepath: The calibration file.
+    :return: The Calibration.
+    :raises CalibrationFileError: If the file cannot be read.
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            calib_object = _LegacyUnpickler(f).load()
+    except (OSError, ValueError, EOFError, AttributeError, ImportError,
+            pickle.UnpicklingError) as e:
+        raise CalibrationFileError(
+            "Could not read calibration file {} ({})".format(filepath, e)) from e
+
+    if not isinstance(calib_object, Calibration):
+        raise CalibrationFileError(
+            "{} does not contain a calibration.".format(filepath))
+
+    # Rebuild through the current fields so that attributes added since the
+    # file was written are present.
+    return _from_fields(*_to_fields(calib_object))
+
+def read_header(filepath):
+    """
+    Read the header of a calibration file (the calibration's metadata, sizes,
+    and reprojection error) without loading its arrays.
+
+    Old (pickled) calibration files have no separate header, so the whole
+    calibration is read (safely, see _LegacyUnpickler).
+
+    :param filepath: The calibration file.
+    :return: The header (a dict with the fields in HEADER_FIELDS, plus format,
+             version, and the names of the stored arrays).
+    :raises CalibrationFileError: If the file is not a calibration file or was
+                                  written by a newer version of DungTrack.
+    """
+    if is_legacy(filepath):
+        header, _ = _to_fields(_load_legacy(filepath))
+        header["version"] = LEGACY_FILE_VERSION
+        return header
+
+    try:
+        # npz members are only read when accessed.
+        with np.load(filepath, allow_pickle=False) as data:
+            header = json.loads(str(data["header"]))
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        raise CalibrationFileError(
+            "Could not read calibration file {} ({})".format(filepath, e)) from e
+
+    if (not isinstance(header, dict)) or (header.get("format") != FILE_FORMAT):
+        raise CalibrationFileError(
+            "{} is not a calibration file.".format(filepath))
+    if header.get("version", 0) > FILE_VERSION:
+        raise CalibrationFileError(
+            "{} was written by a newer version of DungTrack (format version {})."
+            .format(filepath, header.get("version")))
+
+    return header
+
+def _load(filepath):
+    """
+    Read a calibration file (either format).
+
+    :param filepath: The calibration file.
+    :return: The Calibration.
+    :raises CalibrationFileError: If the file cannot be read.
+    """
+    if is_legacy(filepath):
+        return _load_legacy(filepath)
+
+    header = read_header(filepath)
+    try:
+        with np.load(filepath, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in header["arrays"]}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        raise CalibrationFileError(
+            "Could not read calibration file {} ({})".format(filepath, e)) from e
+
+    return _from_fields(header, arrays)
+
 def from_file(filepath):
     """
-    Read a calibration object from a file.
+    Read a calibration object from a file. Calibrations are cached by path
+    and modification time, so reading the same file again is free until the
+    file changes. The returned object is shared between callers and should
+    not be modified.
+
+    :param filepath: The calibration file (current or old format).
+    :return: The Calibration.
+    :raises CalibrationFileError: If the file cannot be read.
     """
-    with open(filepath, 'rb') as f:
-        calib = pickle.load(f) 
+    key = os.path.abspath(filepath)
+    try:
+        stat = os.stat(key)
+    except OSError as e:
+        raise CalibrationFileError(
+            "Could not read calibration file {} ({})".format(filepath, e)) from e
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _loaded.get(key)
+    if (cached is not None) and (cached[0] == stamp):
+        return cached[1]
+
+    calib = _load(filepath)
+    _loaded[key] = (stamp, calib)
     return calib
 
 def save(calib_object, filepath):
     """
-    Pickle and store a calibration object.
+    Store a calibration object. The header is stored as JSON alongside the
+    arrays (in an uncompressed npz file) so that it can be read on its own,
+    and the file is replaced in one step so that an interrupted write never
+    leaves a partial file.
+
+    :param calib_object: The Calibration.
+    :param filepath: The calibration file.
     """
-    with open(filepath, 'wb') as f:
-        pickle.dump(calib_object, f)
+    header, arrays = _to_fields(calib_object)
+
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        np.savez(f, header=np.array(json.dumps(header)), **arrays)
+    os.replace(tmp_filepath, filepath)
+
+    _loaded.pop(os.path.abspath(filepath), None)
+
+def migrate(filepath):
+    """
+    Rewrite an old (pickled) calibration file in the current format. Files
+    which are already in the current format are left alone.
+
+    :param filepath: The calibration file.
+    :return: True if the file was rewritten.
+    :raises CalibrationFileError: If the file cannot be read or written.
+    """
+    if not is_legacy(filepath):
+        return False
+
+    try:
+        save(from_file(filepath), filepath)
+    except OSError as e:
+        raise CalibrationFileError(
+            "Could not write calibration file {} ({})".format(filepath, e)) from e
+    return True
 
 def verify_calibration(filepath):
     """
-    Check that the file at a given path was actually a calibration file.
+    Check that the file at a given path was actually a calibration file. Only
+    the header is read for current files.
+
+    :param filepath: The calibration file.
+    :return: True if the file is a calibration file which can be read.
     """
-    calib = from_file(filepath)
-    return isinstance(calib, Calibration)
\ No newline at end of file
+    try:
+        read_header(filepath)
+    except CalibrationFileError:
+        return False
+    return True
@@ -0,0 +1,130 @@
+"""
+calibration_cache.py
+
+Reading and writing the intrinsic calibration cache: the chessboard corners
+found in the frames selected from the calibration video.
+
+The cache is a single compressed numpy file (intrinsic/corners.npz in the
+calibration cache directory) which holds:
+- The corners for every selected frame.
+- The index of each frame in the calibration video.
+- The size of the video frames and the chessboard size.
+- Optionally, a small greyscale thumbnail of each frame.
+
+Caches written by older versions of DungTrack (one PNG image and one pickled
+.dat corner file per frame) can still be read.
+"""
+
+import os
+
+import numpy as np
+import cv2
+
+CACHE_FILENAME = "corners.npz"
+CACHE_VERSION = 1
+
+# Thumbnails are downscaled to this width.
+THUMBNAIL_WIDTH = 320
+
+def cache_filepath(frame_cache):
+    """
+    :param frame_cache: The calibration cache directory.
+    :return: The path of the intrinsic cache file.
+    """
+    return os.path.join(frame_cache, "intrinsic", CACHE_FILENAME)
+
+def make_thumbnail(frame, width=THUMBNAIL_WIDTH):
+    """
+    :param frame: A video frame.
+    :param width: The width of the thumbnail.
+    :return: A downscaled greyscale copy of the frame.
+    """
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    scale = min(width / frame.shape[1], 1.0)
+    return cv2.resize(frame, None, fx=scale, fy=scale,
+                      interpolation=cv2.INTER_AREA)
+
+def save(frame_cache,
+         corners,
+         frame_indices,
+         image_size,
+         chessboard_size,
+         thumbnails=None):
+    """
+    Write the intrinsic cache file. The file is replaced in one step so that
+    an interrupted write never leaves a partial cache.
+
+    :param frame_cache: The calibration cache directory.
+    :param corners: A list of corner arrays (N x 1 x 2), one per frame.
+    :param frame_indices: The index of each frame in the calibration video.
+    :param image_size: The size of the video frames (width, height).
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :param thumbnails: Optional list of thumbnails (see make_thumbnail()).
+    """
+    arrays = dict(version=np.array(CACHE_VERSION),
+                  corners=np.array(corners, dtype=np.float32),
+                  frame_indices=np.array(frame_indices, dtype=np.int64),
+                  image_size=np.array(image_size, dtype=np.int64),
+                  chessboard_size=np.array(chessboard_size, dtype=np.int64))
+    if thumbnails is not None:
+        arrays["thumbnails"] = np.array(thumbnails, dtype=np.uint8)
+
+    filepath = cache_filepath(frame_cache)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_filepath, filepath)
+
+def load(frame_cache):
+    """
+    Read the intrinsic cache.
+
+    :param frame_cache: The calibration cache directory.
+    :return: A dictionary with the corners (a list of N x 1 x 2 arrays),
+             frame_indices, image_size (width, height), chessboard_size, and
+             thumbnails (None if not stored). frame_indices and
+             chessboard_size are None for old caches. Returns None if there
+             is no cache.
+    """
+    filepath = cache_filepath(frame_cache)
+    if not os.path.exists(filepath):
+        return load_legacy(frame_cache)
+
+    with np.load(filepath, allow_pickle=False) as data:
+        cache = dict(corners=list(data["corners"]),
+                     frame_indices=data["frame_indices"],
+                     image_size=tuple(int(x) for x in data["image_size"]),
+                     chessboard_size=tuple(int(x) for x in data["chessboard_size"]),
+                     thumbnails=data["thumbnails"] if "thumbnails" in data else None)
+
+    return cache
+
+def load_legacy(frame_cache):
+    """
+    Read an old intrinsic cache (a PNG image and a pickled corner file for
+    each frame).
+
+    :param frame_cache: The calibration cache directory.
+    :return: The cache (see load()) or None if there is no old cache.
+    """
+    corner_directory = os.path.join(frame_cache, "intrinsic", "corners")
+    imagepath = os.path.join(frame_cache, "intrinsic", "000.png")
+    if not (os.path.exists(corner_directory) and os.path.exists(imagepath)):
+        return None
+
+    corners = []
+    for file in sorted(os.listdir(corner_directory)):
+        filepath = os.path.join(corner_directory, file)
+        corners.append(np.load(filepath, allow_pickle=True))
+
+    # Only the image size is needed from the images.
+    height, width = cv2.imread(imagepath).shape[:2]
+
+    return dict(corners=corners,
+                frame_indices=None,
+                image_size=(width, height),
+                chessboard_size=None,
+                thumbnails=None)
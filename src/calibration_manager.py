@@ -40,6 +40,10 @@ class CalibrationManager(tk.Toplevel):
         self.__frm_content = tk.Frame(self)
         
         self.__stv_calib_status = tk.StringVar()
+
+        # Header of the project's calibration file (see
+        # calibration.read_header()), set by __check_for_calibration.
+        self.__calib_header = None
         self.__lbl_calib_status = tk.Label(self.__frm_content,
                                            textvariable=self.__stv_calib_status)
         
@@ -106,7 +110,11 @@ class CalibrationManager(tk.Toplevel):
             self.__stv_calib_status.set("No calibration selected")
             self.__lbl_calib_status.configure(fg='#eb3a34')
         elif self.__calib_status == CalibStatus.EXISTS:
-            self.__stv_calib_status.set("This project has a calibration file!")
+            msg = "This project has a calibration file!"
+            error = self.__calib_header.get("reprojection_error")
+            if error is not None:
+                msg += " (reprojection error {:.2f} px)".format(error)
+            self.__stv_calib_status.set(msg)
             self.__lbl_calib_status.configure(fg='#007d02')
         elif self.__calib_status == CalibStatus.CORRUPT:
             self.__stv_calib_status.set("Selected calibration corrupt! You should generate a new calibration.")
@@ -160,6 +168,13 @@ class CalibrationManager(tk.Toplevel):
             
             messagebox.showerror(title="Same file error!",
                                  message=msg)
+        else:
+            # Old (pickled) calibration files are converted when imported.
+            try:
+                if calib.migrate(project_file["calibration_file"]):
+                    print("Calibration file converted to the current format.")
+            except calib.CalibrationFileError as e:
+                print(e)
 
         # Check file exists in the correct place and verify file integrity.
         self.__check_for_calibration()
@@ -181,11 +196,13 @@ class CalibrationManager(tk.Toplevel):
                   " import one."
             messagebox.showerror(title="Missing calibration file!",
                                  message=msg)
+            return
         elif calib_status == CalibStatus.CORRUPT:
             msg = "The calibration file associated with this project cannot be" +\
                   " properly decoded. Generate or import a new file."
             messagebox.showerror(title="Corrupted calibration file!",
                                  message=msg)
+            return
 
         # Check to see if we have an example extrinsic frame to use
         if not os.path.exists(ext_image_path):
@@ -216,10 +233,12 @@ class CalibrationManager(tk.Toplevel):
 
         1. Does calibration cache exist?
         2. Does calibration file exist?
-        3. If so, does it correspond to a Calibration object when loaded?
+        3. If so, is it a calibration file? (Only the file header is read.)
 
-        This will create a calibration cache directory if one does not already 
+        The calibration file is never modified. This will create a calibration cache directory if one does not already 
         exist.
+
+        :return: The CalibStatus.
         """
 
         directory = project_file["calibration_cache"]
@@ -230,13 +249,15 @@ class CalibrationManager(tk.Toplevel):
 
         if os.path.exists(directory):
             if os.path.exists(filepath):
-                if not calib.verify_calibration(filepath):
+                try:
+                    self.__calib_header = calib.read_header(filepath)
+                    self.__calib_status = CalibStatus.EXISTS
+                except calib.CalibrationFileError as e:
+                    print(e)
                     print("Warning! Calibration file found but file structure" +
                           " is not recognised. File may be corrupt or malicious." +
                           " Generate a new calibration.")
                     self.__calib_status = CalibStatus.CORRUPT
-                else:
-                    self.__calib_status = CalibStatus.EXISTS
             else:
                 self.__calib_status = CalibStatus.NOT_FOUND
         else:
@@ -246,4 +267,4 @@ class CalibrationManager(tk.Toplevel):
         
         self.__update_calib_message()
 
-
+        return self.__calib_status
@@ -0,0 +1,163 @@
+"""
+chessboard_detection.py
+
+Shared chessboard corner detection for all calibration code.
+
+Detection is performed coarse-to-fine: the chessboard is first found in a
+downscaled copy of the image (using OpenCV's fast check so that images without
+a chessboard are rejected quickly), the corners are then scaled back up to the
+full resolution and refined to sub-pixel accuracy with cv2.cornerSubPix.
+
+Corners are always returned as an N x 1 x 2 float32 array (the layout used
+by OpenCV 4), whichever OpenCV version is installed.
+"""
+
+import numpy as np
+import cv2
+
+# Images wider than this are downscaled to this width for the initial search.
+DETECTION_MAX_WIDTH = 960
+
+# Sub-pixel refinement search window (half-size, in pixels) limits. The window
+# is otherwise chosen from the spacing of the detected corners.
+SUBPIX_MIN_WINDOW = 2
+SUBPIX_MAX_WINDOW = 11
+
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+DETECTION_FLAGS = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE
+
+# Images are downscaled to this width before computing the sharpness score.
+SHARPNESS_MAX_WIDTH = 320
+
+def to_grey(image):
+    """
+    :param image: A colour (BGR) or greyscale image.
+    :return: The image in greyscale (8-bit).
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if image.dtype != np.uint8:
+        image = image.astype(np.uint8)
+    return image
+
+def frame_sharpness(image, max_width=SHARPNESS_MAX_WIDTH):
+    """
+    Cheap sharpness score for an image: the variance of the Laplacian of a
+    downscaled copy. Motion blur and defocus remove the fine detail (e.g. the
+    edges of the chessboard squares) so blurred frames score much lower than
+    sharp frames of the same scene. Scores are only comparable between
+    images of the same scene (e.g. frames from one video).
+
+    :param image: The image (colour or greyscale).
+    :param max_width: Images wider than this are downscaled to this width.
+    :return: The sharpness score (higher is sharper).
+    """
+    grey = to_grey(image)
+    width = grey.shape[1]
+    if width > max_width:
+        scale = max_width / width
+        grey = cv2.resize(grey, None, fx=scale, fy=scale,
+                          interpolation=cv2.INTER_AREA)
+
+    return float(cv2.Laplacian(grey, cv2.CV_32F).var())
+
+def subpixel_window(corners, chessboard_size):
+    """
+    Choose the cornerSubPix search window for a set of corners. The window
+    must be smaller than half a square, otherwise neighbouring corners pull
+    the refinement.
+
+    :param corners: The detected corners (N x 1 x 2).
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :return: The half-size of the search window (as a tuple).
+    """
+    grid = corners.reshape(chessboard_size[1], chessboard_size[0], 2)
+    spacing = np.linalg.norm(np.diff(grid, axis=1), axis=2).min()
+    half_size = int(np.clip(0.4 * spacing, SUBPIX_MIN_WINDOW, SUBPIX_MAX_WINDOW))
+    return (half_size, half_size)
+
+def grid_irregularity(corners, chessboard_size):
+    """
+    Measure how far a set of corners is from a smooth grid: the largest
+    second difference between neighbouring corners along the rows and columns,
+    relative to the mean corner spacing. Perspective and lens distortion bend
+    the grid smoothly and give small values (typically below 0.15), while a
+    misplaced corner gives a large value.
+
+    :param corners: The detected corners (N x 1 x 2).
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :return: The irregularity (0 for a perfectly regular grid).
+    """
+    grid = corners.reshape(chessboard_size[1], chessboard_size[0], 2)
+    spacing = np.linalg.norm(np.diff(grid, axis=1), axis=2).mean()
+
+    irregularity = 0.0
+    if chessboard_size[0] > 2:
+        rows = grid[:, 2:] - 2 * grid[:, 1:-1] + grid[:, :-2]
+        irregularity = max(irregularity, np.abs(rows).max())
+    if chessboard_size[1] > 2:
+        columns = grid[2:] - 2 * grid[1:-1] + grid[:-2]
+        irregularity = max(irregularity, np.abs(columns).max())
+
+    return float(irregularity / spacing)
+
+def refine_corners(grey, corners, chessboard_size):
+    """
+    Refine chessboard corners to sub-pixel accuracy.
+
+    :param grey: The full resolution greyscale image.
+    :param corners: Approximate corner positions.
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :return: The refined corners (N x 1 x 2, float32).
+    """
+    corners = np.ascontiguousarray(corners, dtype=np.float32).reshape(-1, 1, 2)
+    window = subpixel_window(corners, chessboard_size)
+    return cv2.cornerSubPix(grey, corners, window, (-1, -1), SUBPIX_CRITERIA)
+
+def find_chessboard(image,
+                    chessboard_size,
+                    max_width=DETECTION_MAX_WIDTH,
+                    full_resolution_fallback=False):
+    """
+    Find the inner corners of a chessboard in an image (coarse-to-fine).
+
+    :param image: The image (colour or greyscale).
+    :param chessboard_size: The dimensions of the chessboard (inner corners).
+    :param max_width: Images wider than this are downscaled to this width for
+                      the initial search (None = never downscale).
+    :param full_resolution_fallback: If True and the chessboard cannot be
+                                     found in the downscaled image, search the
+                                     full resolution image as well. Use this
+                                     where a single image matters more than
+                                     speed (e.g. the extrinsic image).
+    :return: Multiple return, True if the chessboard was found and the corners
+             (N x 1 x 2, float32) or None.
+    """
+    grey = to_grey(image)
+    width = grey.shape[1]
+
+    scale = 1.0
+    search_image = grey
+    if (max_width is not None) and (width > max_width):
+        scale = max_width / width
+        search_image = cv2.resize(grey, None, fx=scale, fy=scale,
+                                  interpolation=cv2.INTER_AREA)
+
+    found, corners = cv2.findChessboardCorners(
+        search_image,
+        chessboard_size,
+        flags=DETECTION_FLAGS + cv2.CALIB_CB_FAST_CHECK)
+
+    if found and (scale != 1.0):
+        # Map from downscaled pixel centres to full resolution pixel centres.
+        corners = (corners + 0.5) / scale - 0.5
+    elif (not found) and (scale != 1.0) and full_resolution_fallback:
+        found, corners = cv2.findChessboardCorners(grey,
+                                                   chessboard_size,
+                                                   flags=DETECTION_FLAGS)
+
+    if not found:
+        return False, None
+
+    return True, refine_corners(grey, corners, chessboard_size)
@@ -13,6 +13,7 @@ import cv2
 import numpy as np
 
 from old_calibration import make_checkerboard
+from chessboard_detection import find_chessboard
 from project import project_file
 
 class ChessboardSelector(tk.Toplevel):
@@ -166,8 +167,9 @@ class ChessboardSelector(tk.Toplevel):
         chessboard *= 255 # Make '1' entries white.
 
 
-        success, corners = cv2.findChessboardCorners(chessboard.astype(np.uint8), 
-                                                     chessboard_size)
+        success, corners = find_chessboard(chessboard.astype(np.uint8),
+                                           chessboard_size,
+                                           max_width=None)
         chessboard = cv2.cvtColor(chessboard.astype(np.uint8), cv2.COLOR_GRAY2BGR)        
         chessboard = cv2.drawChessboardCorners(chessboard.astype(np.uint8),
                                                patternSize=chessboard_size,
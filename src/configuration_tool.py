@@ -11,6 +11,7 @@ from tkinter import ttk, filedialog
 
 from dtrack_params import dtrack_params
 from project import project_file
+import smoothing
 
 class ConfigurationTool(tk.Toplevel):
     def __init__(self, parent, **kwargs):
@@ -132,12 +133,24 @@ class ConfigurationTool(tk.Toplevel):
         self.__blv_fix_k3 = tk.BooleanVar()
         self.__blv_fix_tangential = tk.BooleanVar()
         self.__blv_show_meta_text = tk.BooleanVar()
+        self.__blv_cache_images = tk.BooleanVar()
+        self.__stv_world_grid_step = tk.StringVar()
+        self.__stv_detection_workers = tk.StringVar()
+        self.__stv_min_frame_sharpness = tk.StringVar()
+        self.__stv_frame_selection = tk.StringVar()
+        self.__stv_max_view_error = tk.StringVar()
 
         self.__blv_fix_k1.set(dtrack_params["options.autocalibration.fix_k1"])
         self.__blv_fix_k2.set(dtrack_params["options.autocalibration.fix_k2"])
         self.__blv_fix_k3.set(dtrack_params["options.autocalibration.fix_k3"])
         self.__blv_show_meta_text.set(dtrack_params["options.autocalibration.show_meta_text"])
         self.__blv_fix_tangential.set(dtrack_params["options.autocalibration.fix_tangential"])
+        self.__blv_cache_images.set(dtrack_params["options.autocalibration.cache_images"])
+        self.__stv_world_grid_step.set(str(dtrack_params["options.autocalibration.world_grid_step"]))
+        self.__stv_detection_workers.set(str(dtrack_params["options.autocalibration.detection_workers"]))
+        self.__stv_min_frame_sharpness.set(str(dtrack_params["options.autocalibration.min_frame_sharpness"]))
+        self.__stv_frame_selection.set(dtrack_params["options.autocalibration.frame_selection"])
+        self.__stv_max_view_error.set(str(dtrack_params["options.autocalibration.max_view_error"]))
 
         chb_show_metainformation = tk.Checkbutton(lbf_autocalibration_options,
                                                   text="Show default metainformation text",
@@ -162,6 +175,54 @@ class ConfigurationTool(tk.Toplevel):
         chb_fix_tangential = tk.Checkbutton(lbf_autocalibration_options,
                                             text="Fix tangential",
                                             variable=self.__blv_fix_tangential)
+        chb_cache_images = tk.Checkbutton(lbf_autocalibration_options,
+                                          text="Save calibration frames as images",
+                                          variable=self.__blv_cache_images)
+        
+        frm_world_grid_step = tk.Frame(lbf_autocalibration_options)
+        lbl_world_grid_step = tk.Label(frm_world_grid_step,
+                                       text="Lookup grid spacing (px, 0 = off): ",
+                                       anchor='w')
+        spb_world_grid_step = ttk.Spinbox(frm_world_grid_step,
+                                          state='readonly',
+                                          from_=0,
+                                          to=32,
+                                          textvariable=self.__stv_world_grid_step)
+        lbl_detection_workers = tk.Label(frm_world_grid_step,
+                                         text="Chessboard detection processes (0 = one per CPU): ",
+                                         anchor='w')
+        spb_detection_workers = ttk.Spinbox(frm_world_grid_step,
+                                            state='readonly',
+                                            from_=0,
+                                            to=64,
+                                            textvariable=self.__stv_detection_workers)
+        lbl_min_frame_sharpness = tk.Label(frm_world_grid_step,
+                                           text="Minimum relative frame sharpness (0 = off): ",
+                                           anchor='w')
+        spb_min_frame_sharpness = ttk.Spinbox(frm_world_grid_step,
+                                              state='readonly',
+                                              from_=0,
+                                              to=1,
+                                              increment=0.05,
+                                              textvariable=self.__stv_min_frame_sharpness)
+        lbl_frame_selection = tk.Label(frm_world_grid_step,
+                                       text="Calibration frame selection: ",
+                                       anchor='w')
+        cmb_frame_selection = ttk.Combobox(frm_world_grid_step,
+                                           values=["spread",
+                                                   "diverse"],
+                                           state="readonly",
+                                           textvariable=self.__stv_frame_selection)
+        cmb_frame_selection.set(self.__stv_frame_selection.get())
+        lbl_max_view_error = tk.Label(frm_world_grid_step,
+                                      text="Outlier view reprojection error (px, 0 = off): ",
+                                      anchor='w')
+        spb_max_view_error = ttk.Spinbox(frm_world_grid_step,
+                                         state='readonly',
+                                         from_=0,
+                                         to=10,
+                                         increment=0.1,
+                                         textvariable=self.__stv_max_view_error)
         
         chb_show_metainformation.grid(row=0, column=0, sticky='nw')
         lbl_autocalibration_info.grid(row=1, column=0, sticky='nesw')
@@ -169,6 +230,18 @@ class ConfigurationTool(tk.Toplevel):
         chb_fix_k2.grid(row=3, column=0, sticky='nw')
         chb_fix_k3.grid(row=4, column=0, sticky='nw')
         chb_fix_tangential.grid(row=5, column=0, sticky='nw')
+        frm_world_grid_step.grid(row=6, column=0, sticky='nw')
+        chb_cache_images.grid(row=7, column=0, sticky='nw')
+        lbl_world_grid_step.grid(row=0, column=0, sticky='nw')
+        spb_world_grid_step.grid(row=0, column=1, sticky='nw')
+        lbl_detection_workers.grid(row=1, column=0, sticky='nw')
+        spb_detection_workers.grid(row=1, column=1, sticky='nw')
+        lbl_min_frame_sharpness.grid(row=2, column=0, sticky='nw')
+        spb_min_frame_sharpness.grid(row=2, column=1, sticky='nw')
+        lbl_frame_selection.grid(row=3, column=0, sticky='nw')
+        cmb_frame_selection.grid(row=3, column=1, sticky='nw')
+        lbl_max_view_error.grid(row=4, column=0, sticky='nw')
+        spb_max_view_error.grid(row=4, column=1, sticky='nw')
 
 
         #
@@ -286,20 +359,44 @@ class ConfigurationTool(tk.Toplevel):
         self.__stv_plot_filename = tk.StringVar()
         self.__stv_plot_filetype = tk.StringVar()
         self.__blv_plot_zero_tracks = tk.BooleanVar()
+        self.__blv_write_intermediate = tk.BooleanVar()
         self.__stv_smoothing_spline_degree = tk.StringVar()
         self.__stv_smoothing_scale_factor = tk.StringVar()
+        self.__stv_smoothing_workers = tk.StringVar()
+        self.__stv_smoothing_method = tk.StringVar()
+        self.__stv_smoothing_window = tk.StringVar()
+        self.__stv_smoothing_lambda = tk.StringVar()
+        self.__stv_smoothing_noise_ratio = tk.StringVar()
+        self.__stv_arena_radius = tk.StringVar()
+        self.__blv_truncate_at_exit = tk.BooleanVar()
+        self.__stv_resample_rate = tk.StringVar()
         self.__blv_flip_x_axis = tk.BooleanVar()
         self.__blv_flip_y_axis = tk.BooleanVar()
+        self.__stv_legend_max_tracks = tk.StringVar()
+        self.__stv_plot_max_points = tk.StringVar()
+        self.__blv_plot_rasterise = tk.BooleanVar()
 
         self.__blv_plot_grid.set(dtrack_params["options.processing.plot_grid"])
         self.__blv_include_legend.set(dtrack_params["options.processing.include_legend"])
         self.__stv_plot_filename.set(dtrack_params["options.processing.filename"])
         self.__stv_plot_filetype.set(dtrack_params["options.processing.filetype"])
         self.__blv_plot_zero_tracks.set(dtrack_params["options.processing.zero"])
+        self.__blv_write_intermediate.set(dtrack_params["options.processing.write_intermediate"])
         self.__stv_smoothing_spline_degree.set(str(dtrack_params["options.processing.smoothing_spline_degree"]))
         self.__stv_smoothing_scale_factor.set(str(dtrack_params["options.processing.smoothing_scale_factor"]))
+        self.__stv_smoothing_workers.set(str(dtrack_params["options.processing.smoothing_workers"]))
+        self.__stv_smoothing_method.set(dtrack_params["options.processing.smoothing_method"])
+        self.__stv_smoothing_window.set(str(dtrack_params["options.processing.smoothing_window"]))
+        self.__stv_smoothing_lambda.set(str(dtrack_params["options.processing.smoothing_lambda"]))
+        self.__stv_smoothing_noise_ratio.set(str(dtrack_params["options.processing.smoothing_noise_ratio"]))
+        self.__stv_arena_radius.set(str(dtrack_params["options.processing.arena_radius"]))
+        self.__blv_truncate_at_exit.set(dtrack_params["options.processing.truncate_at_exit"])
+        self.__stv_resample_rate.set(str(dtrack_params["options.processing.resample_rate"]))
         self.__blv_flip_x_axis.set(dtrack_params["options.processing.flip_x_axis"])
         self.__blv_flip_y_axis.set(dtrack_params["options.processing.flip_y_axis"])
+        self.__stv_legend_max_tracks.set(str(dtrack_params["options.processing.legend_max_tracks"]))
+        self.__stv_plot_max_points.set(str(dtrack_params["options.processing.plot_max_points"]))
+        self.__blv_plot_rasterise.set(dtrack_params["options.processing.plot_rasterise"])
         
 
         chb_plot_grid = tk.Checkbutton(lbf_processing_options,
@@ -347,12 +444,66 @@ class ConfigurationTool(tk.Toplevel):
                                                  to=1,
                                                  increment=0.01,
                                                  textvariable=self.__stv_smoothing_scale_factor)
+        lbl_smoothing_workers = tk.Label(lbf_processing_options,
+                                         text="Smoothing processes (0 = one per CPU): ")
+        spb_smoothing_workers = ttk.Spinbox(lbf_processing_options,
+                                            state='readonly',
+                                            from_=0,
+                                            to=64,
+                                            textvariable=self.__stv_smoothing_workers)
+        lbl_smoothing_method = tk.Label(lbf_processing_options,
+                                        text="Smoothing method: ")
+        cmb_smoothing_method = ttk.Combobox(lbf_processing_options,
+                                            values=smoothing.METHODS,
+                                            state='readonly',
+                                            textvariable=self.__stv_smoothing_method)
+        lbl_smoothing_window = tk.Label(lbf_processing_options,
+                                        text="Savitzky-Golay window (points): ")
+        spb_smoothing_window = ttk.Spinbox(lbf_processing_options,
+                                           state='readonly',
+                                           from_=3,
+                                           to=101,
+                                           increment=2,
+                                           textvariable=self.__stv_smoothing_window)
+        lbl_smoothing_lambda = tk.Label(lbf_processing_options,
+                                        text="Whittaker smoothing (lambda): ")
+        ent_smoothing_lambda = tk.Entry(lbf_processing_options,
+                                        textvariable=self.__stv_smoothing_lambda)
+        lbl_smoothing_noise_ratio = tk.Label(lbf_processing_options,
+                                             text="Kalman noise ratio: ")
+        ent_smoothing_noise_ratio = tk.Entry(lbf_processing_options,
+                                             textvariable=self.__stv_smoothing_noise_ratio)
+        lbl_arena_radius = tk.Label(lbf_processing_options,
+                                    text="Arena (exit) radius (cm): ")
+        ent_arena_radius = tk.Entry(lbf_processing_options,
+                                    textvariable=self.__stv_arena_radius)
+        chb_truncate_at_exit = tk.Checkbutton(lbf_processing_options,
+                                              text="Truncate tracks at exit radius for statistics",
+                                              variable=self.__blv_truncate_at_exit)
+        lbl_resample_rate = tk.Label(lbf_processing_options,
+                                     text="Resample rate (Hz, 0 = off): ")
+        ent_resample_rate = tk.Entry(lbf_processing_options,
+                                     textvariable=self.__stv_resample_rate)
         chb_flip_x_axis = tk.Checkbutton(lbf_processing_options,
                                          text="Flip plot X axis",
                                          variable=self.__blv_flip_x_axis)
         chb_flip_y_axis = tk.Checkbutton(lbf_processing_options,
                                          text="Flip plot Y axis",
                                          variable=self.__blv_flip_y_axis)
+        lbl_legend_max_tracks = tk.Label(lbf_processing_options,
+                                         text="Maximum tracks in legend: ")
+        ent_legend_max_tracks = tk.Entry(lbf_processing_options,
+                                         textvariable=self.__stv_legend_max_tracks)
+        lbl_plot_max_points = tk.Label(lbf_processing_options,
+                                       text="Maximum plotted points per track (0 = all): ")
+        ent_plot_max_points = tk.Entry(lbf_processing_options,
+                                       textvariable=self.__stv_plot_max_points)
+        chb_plot_rasterise = tk.Checkbutton(lbf_processing_options,
+                                            text="Rasterise tracks in vector plots",
+                                            variable=self.__blv_plot_rasterise)
+        chb_write_intermediate = tk.Checkbutton(lbf_processing_options,
+                                                text="Write intermediate track files (calibrated, zeroed)",
+                                                variable=self.__blv_write_intermediate)
         
 
         lbl_plot_filename.grid(row=0, column=0, sticky='nw')
@@ -368,6 +519,27 @@ class ConfigurationTool(tk.Toplevel):
         spb_smoothing_scale_factor.grid(row=6, column=1, sticky='nw')
         chb_flip_x_axis.grid(row=7, column=0, sticky='nw')
         chb_flip_y_axis.grid(row=8, column=0, sticky='nw')
+        chb_write_intermediate.grid(row=9, column=0, columnspan=2, sticky='nw')
+        lbl_smoothing_workers.grid(row=10, column=0, sticky='nw')
+        spb_smoothing_workers.grid(row=10, column=1, sticky='nw')
+        lbl_smoothing_method.grid(row=11, column=0, sticky='nw')
+        cmb_smoothing_method.grid(row=11, column=1, sticky='nw')
+        lbl_smoothing_window.grid(row=12, column=0, sticky='nw')
+        spb_smoothing_window.grid(row=12, column=1, sticky='nw')
+        lbl_smoothing_lambda.grid(row=13, column=0, sticky='nw')
+        ent_smoothing_lambda.grid(row=13, column=1, sticky='nw')
+        lbl_smoothing_noise_ratio.grid(row=14, column=0, sticky='nw')
+        ent_smoothing_noise_ratio.grid(row=14, column=1, sticky='nw')
+        lbl_arena_radius.grid(row=15, column=0, sticky='nw')
+        ent_arena_radius.grid(row=15, column=1, sticky='nw')
+        chb_truncate_at_exit.grid(row=16, column=0, columnspan=2, sticky='nw')
+        lbl_resample_rate.grid(row=17, column=0, sticky='nw')
+        ent_resample_rate.grid(row=17, column=1, sticky='nw')
+        lbl_legend_max_tracks.grid(row=18, column=0, sticky='nw')
+        ent_legend_max_tracks.grid(row=18, column=1, sticky='nw')
+        lbl_plot_max_points.grid(row=19, column=0, sticky='nw')
+        ent_plot_max_points.grid(row=19, column=1, sticky='nw')
+        chb_plot_rasterise.grid(row=20, column=0, columnspan=2, sticky='nw')
         
 
         
@@ -383,6 +555,12 @@ class ConfigurationTool(tk.Toplevel):
         dtrack_params["options.autocalibration.fix_k3"] = self.__blv_fix_k3.get()
         dtrack_params["options.autocalibration.fix_tangential"] = self.__blv_fix_tangential.get()
         dtrack_params["options.autocalibration.show_meta_text"] = self.__blv_show_meta_text.get()
+        dtrack_params["options.autocalibration.cache_images"] = self.__blv_cache_images.get()
+        dtrack_params["options.autocalibration.world_grid_step"] = int(self.__stv_world_grid_step.get())
+        dtrack_params["options.autocalibration.detection_workers"] = int(self.__stv_detection_workers.get())
+        dtrack_params["options.autocalibration.min_frame_sharpness"] = float(self.__stv_min_frame_sharpness.get())
+        dtrack_params["options.autocalibration.frame_selection"] = self.__stv_frame_selection.get()
+        dtrack_params["options.autocalibration.max_view_error"] = float(self.__stv_max_view_error.get())
         
         dtrack_params["options.autotracker.track_point"] = self.__stv_dtrack_track_point.get()
         dtrack_params["options.autotracker.cv_backend"] = self.__stv_cv_backend.get()
@@ -397,10 +575,22 @@ class ConfigurationTool(tk.Toplevel):
         dtrack_params["options.processing.filename"] = self.__stv_plot_filename.get()
         dtrack_params["options.processing.filetype"] = self.__stv_plot_filetype.get()
         dtrack_params["options.processing.zero"] = self.__blv_plot_zero_tracks.get()
+        dtrack_params["options.processing.write_intermediate"] = self.__blv_write_intermediate.get()
         dtrack_params["options.processing.smoothing_spline_degree"] = int(self.__stv_smoothing_spline_degree.get())
         dtrack_params["options.processing.smoothing_scale_factor"] = float(self.__stv_smoothing_scale_factor.get())
+        dtrack_params["options.processing.smoothing_workers"] = int(self.__stv_smoothing_workers.get())
+        dtrack_params["options.processing.smoothing_method"] = self.__stv_smoothing_method.get()
+        dtrack_params["options.processing.smoothing_window"] = int(self.__stv_smoothing_window.get())
+        dtrack_params["options.processing.smoothing_lambda"] = float(self.__stv_smoothing_lambda.get())
+        dtrack_params["options.processing.smoothing_noise_ratio"] = float(self.__stv_smoothing_noise_ratio.get())
+        dtrack_params["options.processing.arena_radius"] = float(self.__stv_arena_radius.get())
+        dtrack_params["options.processing.truncate_at_exit"] = self.__blv_truncate_at_exit.get()
+        dtrack_params["options.processing.resample_rate"] = float(self.__stv_resample_rate.get())
         dtrack_params["options.processing.flip_x_axis"] = self.__blv_flip_x_axis.get()
         dtrack_params["options.processing.flip_y_axis"] = self.__blv_flip_y_axis.get()
+        dtrack_params["options.processing.legend_max_tracks"] = int(self.__stv_legend_max_tracks.get())
+        dtrack_params["options.processing.plot_max_points"] = int(self.__stv_plot_max_points.get())
+        dtrack_params["options.processing.plot_rasterise"] = self.__blv_plot_rasterise.get()
 
         self.destroy()
 
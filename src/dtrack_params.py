@@ -18,6 +18,10 @@ class ParamFilePassthrough():
     def __init__(self):
         self.__fname = 'params.json'
 
+        # Values which are held in memory in place of those in the file (see
+        # override()).
+        self.__overrides = dict()
+
         # This feels overcomplicated just to store the previous project but
         # there's scope to add stuff.
         self.__valid_keys = ["project_directory",
@@ -35,13 +39,31 @@ class ParamFilePassthrough():
                              "options.autocalibration.fix_k3",
                              "options.autocalibration.fix_tangential",
                              "options.autocalibration.show_meta_text",
+                             "options.autocalibration.world_grid_step",
+                             "options.autocalibration.detection_workers",
+                             "options.autocalibration.min_frame_sharpness",
+                             "options.autocalibration.frame_selection",
+                             "options.autocalibration.cache_images",
+                             "options.autocalibration.max_view_error",
                              "options.processing.plot_grid",
                              "options.processing.include_legend",
+                             "options.processing.legend_max_tracks",
+                             "options.processing.plot_max_points",
+                             "options.processing.plot_rasterise",
                              "options.processing.filename",
                              "options.processing.filetype",
                              "options.processing.zero",
+                             "options.processing.resample_rate",
+                             "options.processing.write_intermediate",
+                             "options.processing.smoothing_method",
                              "options.processing.smoothing_spline_degree",
                              "options.processing.smoothing_scale_factor",
+                             "options.processing.smoothing_workers",
+                             "options.processing.smoothing_window",
+                             "options.processing.smoothing_lambda",
+                             "options.processing.smoothing_noise_ratio",
+                             "options.processing.arena_radius",
+                             "options.processing.truncate_at_exit",
                              "options.processing.flip_y_axis",
                              "options.processing.flip_x_axis"
                              ]
@@ -66,48 +88,70 @@ class ParamFilePassthrough():
         self.__defaults["options.autocalibration.fix_k3"] = True
         self.__defaults["options.autocalibration.fix_tangential"] = True
         self.__defaults["options.autocalibration.show_meta_text"] = True
+        self.__defaults["options.autocalibration.world_grid_step"] = 0
+        self.__defaults["options.autocalibration.detection_workers"] = 0
+        self.__defaults["options.autocalibration.min_frame_sharpness"] = 0.5
+        self.__defaults["options.autocalibration.frame_selection"] = "spread"
+        self.__defaults["options.autocalibration.cache_images"] = False
+        self.__defaults["options.autocalibration.max_view_error"] = 1.0
 
         self.__defaults["options.processing.plot_grid"] = True
         self.__defaults["options.processing.include_legend"] = True
+        self.__defaults["options.processing.legend_max_tracks"] = 20
+        self.__defaults["options.processing.plot_max_points"] = 0
+        self.__defaults["options.processing.plot_rasterise"] = False
         self.__defaults["options.processing.filename"] = "processed_tracks"
         self.__defaults["options.processing.filetype"] = "pdf"
         self.__defaults["options.processing.zero"] = False
+        self.__defaults["options.processing.resample_rate"] = 0
+        self.__defaults["options.processing.write_intermediate"] = True
+        self.__defaults["options.processing.smoothing_method"] = "spline"
         self.__defaults["options.processing.smoothing_spline_degree"] = 3
         self.__defaults["options.processing.smoothing_scale_factor"] = 0.03
+        self.__defaults["options.processing.smoothing_workers"] = 0
+        self.__defaults["options.processing.smoothing_window"] = 15
+        self.__defaults["options.processing.smoothing_lambda"] = 100
+        self.__defaults["options.processing.smoothing_noise_ratio"] = 0.01
+        self.__defaults["options.processing.arena_radius"] = 50
+        self.__defaults["options.processing.truncate_at_exit"] = False
         self.__defaults["options.processing.flip_y_axis"] = True
         self.__defaults["options.processing.flip_x_axis"] = True        
         
 
         # If parameter file does not exist, create it as an emtpy json file.
         if not os.path.exists(self.__fname):
-            with open(self.__fname, "w") as f:
-                params = dict.fromkeys(self.__valid_keys)
-                params = self.__set_defaults(params)
+            params = dict.fromkeys(self.__valid_keys)
+            params = self.__set_defaults(params)
 
-                # Set correct defaults
-                for k in self.__valid_keys:
-                    params[k] = self.__defaults[k]
+            # Set correct defaults
+            for k in self.__valid_keys:
+                params[k] = self.__defaults[k]
 
-                json.dump(params, f, indent=2)
+            self.__write(params)
         else:
             # If the file does exist, check that no elements are null.
             with open(self.__fname, "r") as f:
                 params = json.load(f)
-                
-                for k in self.__valid_keys:
-                    # Check all valid keys for sensible values
-                    try:
-                        if params[k] == None:
-                            params[k] = self.__defaults[k]
-                    except KeyError:
-                        # If there is a valid entry which currently isn't in the
-                        # file, then add it.
-                        params[k] = self.__defaults[k]
-                
-            with open(self.__fname, "w") as f:
-                json.dump(params, f, indent=2)
+
+            modified = False
+            for k in self.__valid_keys:
+                # Check all valid keys for sensible values
+                if params.get(k) is None:
+                    # If there is a valid entry which currently isn't in the
+                    # file (or is null), then add it.
+                    params[k] = self.__defaults[k]
+                    modified = True
+
+            # Only rewrite the file if something was added. Several processes
+            # may import this module at once (e.g. batch processing) and
+            # should not rewrite the file underneath each other.
+            if modified:
+                self.__write(params)
 
     def __getitem__(self,key):
+        if key in self.__overrides:
+            return self.__overrides[key]
+
         with open(self.__fname, "r") as f:
                 params = json.load(f)
         return params[key]
@@ -116,13 +160,47 @@ class ParamFilePassthrough():
         # Failing this assertion indicates programmer error.
         assert(key in self.__valid_keys)
 
+        if key in self.__overrides:
+            self.__overrides[key] = value
+            return
+
         with open(self.__fname, "r") as f:
             params = json.load(f)
 
         params[key] = value
 
-        with open(self.__fname, "w") as f:
+        self.__write(params)
+
+    def override(self, key, value):
+        """
+        Use a value for a parameter without writing it to the parameter file.
+        This allows a script to work on a particular project (or with
+        particular options) without changing the parameters used by the GUI.
+
+        :param key: The parameter to override.
+        :param value: The value to use until clear_overrides() is called.
+        """
+        # Failing this assertion indicates programmer error.
+        assert(key in self.__valid_keys)
+        self.__overrides[key] = value
+
+    def clear_overrides(self):
+        """
+        Remove all overrides so that parameters are read from file again.
+        """
+        self.__overrides = dict()
+
+    def __write(self, params):
+        """
+        Write the parameters to file. The file is replaced in a single step
+        so that other processes never read a partially written file.
+
+        :param params: The parameter dictionary.
+        """
+        tmp_fname = "{}.{}.tmp".format(self.__fname, os.getpid())
+        with open(tmp_fname, "w") as f:
             json.dump(params, f, indent=2)
+        os.replace(tmp_fname, self.__fname)
 
     def __set_defaults(self, params):
         for k in self.__valid_keys:
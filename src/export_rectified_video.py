@@ -0,0 +1,394 @@
+"""
+export_rectified_video.py
+
+Command line tool to export a project's tracking video in calibrated
+(ground plane) coordinates with the raw tracks drawn on top, e.g. for
+presentations or to check the tracking and calibration.
+
+Each frame is undistorted and perspective corrected in a single remap (see
+Calibration.rectify()). Decoding, rectifying and drawing, and encoding run
+at the same time: one thread reads frames from the video, a pool of threads
+rectifies them and draws the tracks, and the main thread writes the frames
+(in order) to the output video.
+
+Usage:
+    python export_rectified_video.py [--output FILE] [--scale S]
+                                     [--workers N] [--no-tracks] [--verbose]
+                                     project_directory
+
+The output frame size is the calibration's bounding box (bbox_width x
+bbox_height) times the scale. Tracks are drawn up to the current frame if
+the project has timestamps, otherwise whole tracks are drawn on every frame.
+
+Exit codes:
+    0 - The video was exported.
+    1 - The video could not be exported (e.g. no calibration file).
+    2 - Invalid arguments or project directory.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+import calibration as calib
+import parallel
+import track_store
+from dtrack_params import dtrack_params
+from project import project_file, project_filepath
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+
+OUTPUT_FILENAME = "rectified_tracks.mp4"
+OUTPUT_FOURCC = "mp4v"
+
+# Number of decoded frames which may wait to be rectified, and number of
+# rectified frames which may wait to be written, per worker thread. This
+# bounds the memory use when one stage is slower than the others.
+QUEUE_FRAMES_PER_WORKER = 4
+
+# Track colours (BGR), matplotlib's default colour cycle.
+TRACK_COLOURS = [(180, 119, 31), (14, 127, 255), (44, 160, 44),
+                 (40, 39, 214), (189, 103, 148), (75, 86, 140),
+                 (194, 119, 227), (127, 127, 127), (34, 189, 188),
+                 (207, 190, 23)]
+
+TRACK_THICKNESS = 2
+
+logger = logging.getLogger("export_rectified_video")
+
+class ExportError(Exception):
+    """
+    Raised when a video cannot be exported.
+    """
+
+class TrackOverlay():
+    """
+    Draws tracks (in calibrated frame coordinates) onto calibrated frames.
+    """
+    def __init__(self, track_set, time_set=None):
+        """
+        :param track_set: TrackSet of track points in calibrated frame pixel
+                          coordinates.
+        :param time_set: Optional TrackSet of timestamps (ms) for each point.
+                         If None, whole tracks are drawn on every frame.
+        """
+        self.__tracks = []
+        for idx, (label, points) in enumerate(track_set):
+            valid = ~np.isnan(points).any(axis=1)
+            times = None
+            if (time_set is not None) and (label in time_set):
+                times = np.ravel(time_set[label])[:len(points)]
+                valid = valid[:len(times)] & ~np.isnan(times)
+                times = times[valid]
+
+            # cv2.polylines uses fixed point, 4 fractional bits keeps the
+            # tracks smooth.
+            points = np.round(points[:len(valid)][valid] * 16).astype(np.int32)
+            colour = TRACK_COLOURS[idx % len(TRACK_COLOURS)]
+            self.__tracks.append((points, times, colour))
+
+    def draw(self, frame, time_ms=None):
+        """
+        Draw the tracks onto a frame (in place).
+
+        :param frame: The calibrated frame.
+        :param time_ms: The frame time (ms). Points after this time are not
+                        drawn. If None, whole tracks are drawn.
+        :return: The frame.
+        """
+        for points, times, colour in self.__tracks:
+            n_points = len(points)
+            if (times is not None) and (time_ms is not None):
+                n_points = int(np.searchsorted(times, time_ms, side='right'))
+
+            if n_points > 1:
+                cv2.polylines(frame,
+                              [points[:n_points]],
+                              False,
+                              colour,
+                              TRACK_THICKNESS,
+                              cv2.LINE_AA,
+                              shift=4)
+        return frame
+
+def load_overlay(project_directory, calibration, scale=1.0):
+    """
+    Load the raw tracks for a project and convert them to calibrated frame
+    coordinates.
+
+    :param project_directory: The project directory.
+    :param calibration: The Calibration.
+    :param scale: Scale factor for the calibrated frame.
+    :return: A TrackOverlay or None if the project has no tracks.
+    """
+    track_filepath = os.path.join(project_directory, "raw_tracks.csv")
+    time_filepath = os.path.join(project_directory, "timestamps.csv")
+    if not os.path.exists(track_filepath):
+        return None
+
+    track_set = track_store.read_track_set(track_filepath)
+    track_set = track_set.with_points(
+        calibration.image_to_rectified(track_set.points, scale=scale))
+
+    time_set = None
+    if os.path.exists(time_filepath):
+        time_set = track_store.read_track_set(time_filepath)
+
+    return TrackOverlay(track_set, time_set)
+
+def read_frames(cap, frames, stop):
+    """
+    Read every frame of a video onto a queue (run in its own thread). A None
+    item marks the end of the video.
+
+    :param cap: The OpenCV VideoCapture.
+    :param frames: The queue to put (time in ms, frame) pairs on.
+    :param stop: threading.Event, set to stop reading early.
+    """
+    try:
+        while not stop.is_set():
+            success, frame = cap.read()
+            if not success:
+                break
+            frames.put((cap.get(cv2.CAP_PROP_POS_MSEC), frame))
+    finally:
+        frames.put(None)
+
+def render_frame(calibration, overlay, frame, time_ms, scale):
+    """
+    Rectify a frame and draw the tracks on it.
+
+    :param calibration: The Calibration.
+    :param overlay: The TrackOverlay (or None).
+    :param frame: The video frame.
+    :param time_ms: The frame time (ms).
+    :param scale: Scale factor for the calibrated frame.
+    :return: The calibrated frame.
+    """
+    rectified = calibration.rectify(frame, scale=scale, border_value=0)
+    if overlay is not None:
+        overlay.draw(rectified, time_ms)
+    return rectified
+
+def export_video(video_path,
+                 calibration,
+                 output_path,
+                 overlay=None,
+                 scale=1.0,
+                 workers=0,
+                 progress_interval=500):
+    """
+    Export a video in calibrated frame coordinates.
+
+    :param video_path: The video to export.
+    :param calibration: The Calibration for the video.
+    :param output_path: The output video file.
+    :param overlay: Optional TrackOverlay to draw on each frame.
+    :param scale: Scale factor for the calibrated frame.
+    :param workers: The number of threads used to rectify frames (0 = one per
+                    CPU).
+    :param progress_interval: Log progress every this many frames.
+    :return: The number of frames written.
+    :raises ExportError: If the video cannot be read or written.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ExportError("Could not open video {}".format(video_path))
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    size = calibration.rectified_size(scale)
+
+    writer = cv2.VideoWriter(output_path,
+                             cv2.VideoWriter_fourcc(*OUTPUT_FOURCC),
+                             fps,
+                             size)
+    if not writer.isOpened():
+        cap.release()
+        raise ExportError("Could not write video {}".format(output_path))
+
+    # Compute the maps before starting so that the workers share them.
+    calibration.rectification_maps(scale)
+
+    workers = parallel.worker_count(workers)
+    max_pending = QUEUE_FRAMES_PER_WORKER * workers
+    frames = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_frames,
+                              args=(cap, frames, stop),
+                              daemon=True)
+
+    n_written = 0
+    start = time.perf_counter()
+    pending = collections.deque()
+    reader.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                item = frames.get()
+                if item is not None:
+                    time_ms, frame = item
+                    pending.append(executor.submit(render_frame,
+                                                   calibration,
+                                                   overlay,
+                                                   frame,
+                                                   time_ms,
+                                                   scale))
+
+                # Write frames in order once enough are queued (or at the end
+                # of the video).
+                while pending and ((item is None) or
+                                   (len(pending) >= max_pending) or
+                                   pending[0].done()):
+                    writer.write(pending.popleft().result())
+                    n_written += 1
+                    if n_written % progress_interval == 0:
+                        elapsed = time.perf_counter() - start
+                        logger.info("Written %d of %d frames (%.1f frames/s)",
+                                    n_written,
+                                    frame_count,
+                                    n_written / elapsed)
+
+                if item is None:
+                    break
+    finally:
+        stop.set()
+        # Unblock the reader if it is waiting on a full queue.
+        while reader.is_alive():
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                reader.join(timeout=0.1)
+        writer.release()
+        cap.release()
+
+    return n_written
+
+def export_project(project_directory,
+                   output_path=None,
+                   scale=1.0,
+                   workers=0,
+                   tracks=True):
+    """
+    Export the tracking video for a project in calibrated frame coordinates
+    without changing the project stored in params.json.
+
+    :param project_directory: The project directory.
+    :param output_path: The output video file (default: rectified_tracks.mp4
+                        in the project directory).
+    :param scale: Scale factor for the calibrated frame.
+    :param workers: The number of threads used to rectify frames (0 = one per
+                    CPU).
+    :param tracks: If True, the raw tracks are drawn on the video.
+    :return: The number of frames written.
+    :raises ExportError: If the video cannot be exported.
+    """
+    project_directory = os.path.abspath(project_directory)
+    if output_path is None:
+        output_path = os.path.join(project_directory, OUTPUT_FILENAME)
+
+    dtrack_params.override("project_directory", project_directory)
+    dtrack_params.override("project_file", project_filepath(project_directory))
+    try:
+        video_path = project_file["tracking_video"]
+        calibration_filepath = project_file["calibration_file"]
+    finally:
+        dtrack_params.clear_overrides()
+
+    if not os.path.exists(video_path):
+        raise ExportError("Tracking video {} not found.".format(video_path))
+    if not os.path.exists(calibration_filepath):
+        raise ExportError("Calibration file {} not found.".format(calibration_filepath))
+
+    try:
+        calibration = calib.from_file(calibration_filepath)
+    except calib.CalibrationFileError as e:
+        raise ExportError(str(e)) from e
+
+    overlay = None
+    if tracks:
+        overlay = load_overlay(project_directory, calibration, scale=scale)
+        if overlay is None:
+            logger.warning("No tracks found in %s", project_directory)
+
+    width, height = calibration.rectified_size(scale)
+    logger.info("Exporting %s (%d x %d) to %s",
+                video_path, width, height, output_path)
+    return export_video(video_path,
+                        calibration,
+                        output_path,
+                        overlay=overlay,
+                        scale=scale,
+                        workers=workers)
+
+def main(argv=None):
+    """
+    :param argv: Command line arguments (defaults to sys.argv[1:]).
+    :return: The exit code.
+    """
+    parser = argparse.ArgumentParser(
+        description="Export a DungTrack 2 project's tracking video in "
+                    "calibrated coordinates with the tracks drawn on.")
+    parser.add_argument("project_directory",
+                        help="The project directory.")
+    parser.add_argument("-o", "--output",
+                        help="Output video file (default: {} in the project "
+                             "directory).".format(OUTPUT_FILENAME))
+    parser.add_argument("--scale",
+                        type=float,
+                        default=1.0,
+                        help="Scale factor for the output frame size "
+                             "(default: 1, the calibration's bounding box).")
+    parser.add_argument("-j", "--workers",
+                        type=int,
+                        default=0,
+                        help="Number of threads used to rectify frames "
+                             "(default: one per CPU).")
+    parser.add_argument("--no-tracks",
+                        action="store_true",
+                        help="Do not draw the tracks.")
+    parser.add_argument("-v", "--verbose",
+                        action="store_true",
+                        help="Show debug output.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    if not os.path.exists(project_filepath(args.project_directory)):
+        logger.error("%s is not a project directory (no project file found).",
+                     args.project_directory)
+        return EXIT_USAGE
+    if args.scale <= 0:
+        logger.error("The scale must be greater than 0.")
+        return EXIT_USAGE
+
+    start = time.perf_counter()
+    try:
+        n_frames = export_project(args.project_directory,
+                                  output_path=args.output,
+                                  scale=args.scale,
+                                  workers=args.workers,
+                                  tracks=not args.no_tracks)
+    except ExportError as e:
+        logger.error("%s", e)
+        return EXIT_FAILURE
+
+    elapsed = time.perf_counter() - start
+    logger.info("Exported %d frames in %.1f s (%.1f frames/s)",
+                n_frames, elapsed, n_frames / max(elapsed, 1e-9))
+    return EXIT_SUCCESS
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,7 @@ Entry point which defines the main window, made of a project frame and a
 tool frame.
 """
 
+import logging
 import tkinter as tk
 from project_frame import ProjectFrame
 from tool_frame import ToolFrame
@@ -18,33 +19,39 @@ window_height = 400
 x_padding = 10
 y_padding = 0
 
-root = tk.Tk()
-root.title('DungTrack 2: DungTrack Harder')
+# Guard so that worker processes (which re-import this module) do not open
+# the main window.
+if __name__ == "__main__":
+    # Processing output is logged, show it in the terminal as before.
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-# Lock frame size for ease at the moment
-root.minsize(window_width,window_height)
-#root.maxsize(window_width, window_height)
+    root = tk.Tk()
+    root.title('DungTrack 2: DungTrack Harder')
 
-# Support resizability for future development
-n_columns = 1
-n_rows = 2
-root.columnconfigure(0, weight=1)
-root.rowconfigure(0, weight=1) 
-content = tk.Frame(root)
-for i in range(n_rows):
-    for j in range(n_columns):
-        content.columnconfigure(j, weight=1)
-        content.rowconfigure(i, weight=1)
+    # Lock frame size for ease at the moment
+    root.minsize(window_width,window_height)
+    #root.maxsize(window_width, window_height)
 
-p_frame = ProjectFrame(content)
+    # Support resizability for future development
+    n_columns = 1
+    n_rows = 2
+    root.columnconfigure(0, weight=1)
+    root.rowconfigure(0, weight=1) 
+    content = tk.Frame(root)
+    for i in range(n_rows):
+        for j in range(n_columns):
+            content.columnconfigure(j, weight=1)
+            content.rowconfigure(i, weight=1)
 
-tool_frame = ToolFrame(content)
+    p_frame = ProjectFrame(content)
 
+    tool_frame = ToolFrame(content)
 
-content.grid(column=0, row=0, sticky="nesw")
-p_frame.grid(row=0, column=0, sticky='nesw')
-tool_frame.grid(row=1, column=0, sticky='nesw')
 
-root.bind('<Control-c>', lambda e: root.destroy())
-root.mainloop()
+    content.grid(column=0, row=0, sticky="nesw")
+    p_frame.grid(row=0, column=0, sticky='nesw')
+    tool_frame.grid(row=1, column=0, sticky='nesw')
+
+    root.bind('<Control-c>', lambda e: root.destroy())
+    root.mainloop()
 
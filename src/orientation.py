@@ -0,0 +1,342 @@
+"""
+orientation.py
+
+Provides orientation analysis for sets of tracks: exit bearings, heading time
+series, turning angles, and circular statistics (mean vector length, Rayleigh
+test). Everything is computed for all tracks at once from the concatenated
+point array of a TrackSet (see track_set.py).
+
+Angles are measured anticlockwise from the positive x axis of the calibrated
+(world) coordinate system. Note that this is the coordinate system of the
+track data, so any axis flips applied when plotting are not applied here.
+Angles are returned in radians by the functions in this module and reported
+in degrees in the output tables.
+
+The exit point of a track is the first point at which it crosses a circle of
+a given radius centred on the first point of the track (i.e. where the beetle
+was placed). The crossing position is found exactly by intersecting the
+segment between the last point inside the circle and the first point outside
+with the circle.
+"""
+
+import numpy as np
+import pandas as pd
+
+from track_set import TrackSet
+
+def step_vectors(track_set):
+    """
+    Compute the displacement between consecutive points in each track.
+
+    :param track_set: The tracks.
+    :return: A tuple (steps, valid) where steps[i] is the difference between
+             point i-1 and point i (n_points x n_dims) and valid[i] is False
+             for the first point of each track (which has no step).
+    """
+    steps = np.zeros(track_set.points.shape)
+    valid = np.ones(track_set.n_points, dtype=bool)
+    valid[track_set.offsets[:-1][track_set.lengths > 0]] = False
+
+    if track_set.n_points > 1:
+        steps[1:] = np.diff(track_set.points, axis=0)
+    steps[~valid] = 0
+
+    return steps, valid
+
+def headings(track_set):
+    """
+    Compute the heading (direction of travel) of every step in every track.
+    Steps with no movement have no heading (NaN).
+
+    :param track_set: The tracks.
+    :return: A TrackSet (one dimension) giving the heading of each step in
+             radians. Each track has one fewer value than the input track.
+    """
+    steps, valid = step_vectors(track_set)
+    steps = steps[valid]
+
+    heading = np.arctan2(steps[:, 1], steps[:, 0])
+    heading[(steps[:, 0] == 0) & (steps[:, 1] == 0)] = np.nan
+
+    lengths = np.maximum(track_set.lengths - 1, 0)
+    offsets = np.zeros(len(track_set) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    return TrackSet(heading, offsets, track_set.labels, suffixes=[''])
+
+def turning_angles(heading_set):
+    """
+    Compute the turning angle between consecutive headings in each track,
+    wrapped to [-pi, pi). Positive angles are anticlockwise turns.
+
+    :param heading_set: The headings (see headings())
+    :return: A TrackSet (one dimension) giving the turning angle between
+             consecutive steps in radians. Each track has one fewer value
+             than the heading track.
+    """
+    changes, valid = step_vectors(heading_set)
+    turns = np.mod(changes[valid, 0] + np.pi, 2 * np.pi) - np.pi
+
+    lengths = np.maximum(heading_set.lengths - 1, 0)
+    offsets = np.zeros(len(heading_set) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    return TrackSet(turns, offsets, heading_set.labels, suffixes=[''])
+
+def first_crossings(track_set, radius):
+    """
+    Find where each track first crosses a circle centred on its first point.
+
+    :param track_set: The tracks.
+    :param radius: The radius of the circle (same units as the tracks).
+    :return: A tuple (crossed, segment, fraction, position) where for each
+             track, crossed is True if the track leaves the circle, segment is
+             the index (into track_set.points) of the first point outside the
+             circle, fraction is the position of the crossing along the
+             segment leading to that point (0-1), and position is the
+             crossing point (n_tracks x 2). Values are -1 or NaN for tracks
+             which do not cross.
+    """
+    n_tracks = len(track_set)
+    lengths = track_set.lengths
+    points = track_set.points[:, :2]
+
+    crossed = np.zeros(n_tracks, dtype=bool)
+    segment = np.full(n_tracks, -1, dtype=np.int64)
+    fraction = np.full(n_tracks, np.nan)
+    position = np.full((n_tracks, 2), np.nan)
+
+    nonempty = np.flatnonzero(lengths > 0)
+    if nonempty.size == 0:
+        return crossed, segment, fraction, position
+
+    starts = track_set.offsets[:-1][nonempty]
+    centres = np.repeat(track_set.first_points()[:, :2], lengths, axis=0)
+    relative = points - centres
+    outside = (relative[:, 0]**2 + relative[:, 1]**2) >= radius**2
+
+    # First point outside the circle in each track (or n_points if none).
+    n_points = track_set.n_points
+    candidates = np.where(outside, np.arange(n_points), n_points)
+    first = np.minimum.reduceat(candidates, starts)
+    first[first >= track_set.offsets[1:][nonempty]] = n_points
+
+    has_crossing = first < n_points
+    tracks = nonempty[has_crossing]
+    first = first[has_crossing]
+
+    crossed[tracks] = True
+    segment[tracks] = first
+
+    # Intersect the segment (previous point -> first point outside) with the
+    # circle: |m + f d| = radius with m inside the circle.
+    previous = np.maximum(first - 1, track_set.offsets[:-1][tracks])
+    m = relative[previous]
+    d = relative[first] - m
+    a = d[:, 0]**2 + d[:, 1]**2
+    b = m[:, 0] * d[:, 0] + m[:, 1] * d[:, 1]
+    c = m[:, 0]**2 + m[:, 1]**2 - radius**2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = (-b + np.sqrt(np.maximum(b**2 - a * c, 0))) / a
+    f = np.where(a > 0, np.clip(f, 0, 1), 1)
+
+    fraction[tracks] = f
+    position[tracks] = points[previous] + f[:, None] * d
+
+    return crossed, segment, fraction, position
+
+def interpolate_at_crossings(track_set, values, segment, fraction):
+    """
+    Interpolate per-point values (e.g. timestamps) at the crossing points
+    found by first_crossings().
+
+    :param track_set: The tracks.
+    :param values: The value at each point (n_points) or (n_points x k)
+    :param segment: The crossing segments (see first_crossings)
+    :param fraction: The crossing fractions (see first_crossings)
+    :return: The interpolated value at each crossing (NaN for tracks which do
+             not cross).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full((len(track_set),) + values.shape[1:], np.nan)
+
+    tracks = np.flatnonzero(segment >= 0)
+    first = segment[tracks]
+    previous = np.maximum(first - 1, track_set.offsets[:-1][tracks])
+    f = fraction[tracks].reshape((-1,) + (1,) * (values.ndim - 1))
+
+    result[tracks] = values[previous] + f * (values[first] - values[previous])
+    return result
+
+def truncate_at_crossings(track_set, segment, fraction, values=None):
+    """
+    Truncate tracks at their crossing points (see first_crossings). Points
+    after the crossing are removed and the crossing point itself becomes the
+    last point of the track. Tracks which do not cross are unchanged.
+
+    :param track_set: The tracks.
+    :param segment: The crossing segments (see first_crossings)
+    :param fraction: The crossing fractions (see first_crossings)
+    :param values: Optional per-point values (n_points) to truncate alongside
+                   the tracks; these are interpolated at the crossing.
+    :return: A tuple (truncated TrackSet, truncated values or None)
+    """
+    n_points = track_set.n_points
+    track_idx = track_set.track_index()
+
+    # Keep every point before the first point outside the circle.
+    cutoff = np.where(segment >= 0, segment, track_set.offsets[1:])
+    keep = np.arange(n_points) < cutoff[track_idx]
+
+    crossing_points = interpolate_at_crossings(track_set,
+                                               track_set.points,
+                                               segment,
+                                               fraction)
+    tracks = np.flatnonzero(segment >= 0)
+
+    # The crossing is inserted after the kept points of each crossing track.
+    kept_lengths = np.bincount(track_idx[keep], minlength=len(track_set))
+    kept_ends = np.cumsum(kept_lengths)[tracks]
+
+    points = np.insert(track_set.points[keep],
+                       kept_ends,
+                       crossing_points[tracks],
+                       axis=0)
+
+    lengths = kept_lengths.copy()
+    lengths[tracks] += 1
+    offsets = np.zeros(len(track_set) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    truncated = TrackSet(points, offsets, track_set.labels,
+                         suffixes=track_set.suffixes)
+
+    if values is None:
+        return truncated, None
+
+    values = np.asarray(values, dtype=np.float64)
+    crossing_values = interpolate_at_crossings(track_set,
+                                               values,
+                                               segment,
+                                               fraction)
+    values = np.insert(values[keep], kept_ends, crossing_values[tracks], axis=0)
+
+    return truncated, values
+
+def exit_bearings(track_set, radius):
+    """
+    Compute the bearing at which each track leaves a circle centred on its
+    first point.
+
+    :param track_set: The tracks.
+    :param radius: The radius of the circle (same units as the tracks).
+    :return: A tuple (bearing, position); the bearing of each exit point from
+             the start of the track in radians (NaN if the track does not
+             leave the circle) and the exit position (n_tracks x 2).
+    """
+    _, _, _, position = first_crossings(track_set, radius)
+    relative = position - track_set.first_points()[:, :2]
+    bearing = np.arctan2(relative[:, 1], relative[:, 0])
+    return bearing, position
+
+def circular_statistics(angles, offsets=None):
+    """
+    Compute circular summary statistics for one or more groups of angles.
+    Missing angles (NaN) are ignored.
+
+    :param angles: The angles in radians.
+    :param offsets: The start of each group in angles (n_groups + 1). If None,
+                    all angles are treated as one group.
+    :return: A dictionary of arrays (one value per group): 'n' (number of
+             angles), 'mean' (mean direction), 'r' (mean vector length),
+             'std' (circular standard deviation), 'rayleigh_z' and
+             'rayleigh_p' (Rayleigh test of uniformity).
+    """
+    angles = np.asarray(angles, dtype=np.float64).reshape(-1)
+    if offsets is None:
+        offsets = np.array([0, angles.size])
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    n_groups = len(offsets) - 1
+    group = np.repeat(np.arange(n_groups), np.diff(offsets))
+    present = ~np.isnan(angles)
+
+    n = np.bincount(group[present], minlength=n_groups).astype(np.float64)
+    sum_cos = np.bincount(group[present],
+                          weights=np.cos(angles[present]),
+                          minlength=n_groups)
+    sum_sin = np.bincount(group[present],
+                          weights=np.sin(angles[present]),
+                          minlength=n_groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        resultant = np.sqrt(sum_cos**2 + sum_sin**2)
+        r = resultant / n
+        mean = np.where(n > 0, np.arctan2(sum_sin, sum_cos), np.nan)
+        std = np.sqrt(np.abs(2 * np.log(np.minimum(r, 1))))
+
+        # Rayleigh test (p-value approximation from Zar, Biostatistical
+        # Analysis)
+        rayleigh_z = resultant**2 / n
+        rayleigh_p = np.exp(np.sqrt(1 + 4 * n + 4 * (n**2 - resultant**2)) -
+                            (1 + 2 * n))
+        rayleigh_p = np.minimum(rayleigh_p, 1)
+
+    return dict(n=n,
+                mean=mean,
+                r=r,
+                std=std,
+                rayleigh_z=rayleigh_z,
+                rayleigh_p=rayleigh_p)
+
+def analyse_orientation(track_set, radius):
+    """
+    Compute per-track orientation statistics.
+
+    :param track_set: The tracks (calibrated, in mm)
+    :param radius: The exit radius in mm.
+    :return: A DataFrame with one row per track. The exit position is not
+             included as it is given in the summary statistics (see
+             track_processing.analyse_track_set()).
+    """
+    bearing, _ = exit_bearings(track_set, radius)
+
+    heading_set = headings(track_set)
+    heading_stats = circular_statistics(heading_set.points,
+                                        heading_set.offsets)
+
+    turn_set = turning_angles(heading_set)
+    turn_stats = circular_statistics(turn_set.points, turn_set.offsets)
+
+    return pd.DataFrame({"Exit bearing (deg)": np.degrees(bearing),
+                         "Mean heading (deg)":
+                             np.degrees(heading_stats['mean']),
+                         "Heading vector length": heading_stats['r'],
+                         "Mean turning angle (deg)":
+                             np.degrees(turn_stats['mean']),
+                         "Turning angle std (deg)":
+                             np.degrees(turn_stats['std'])},
+                        index=list(track_set.labels))
+
+def summarise_orientation(orientation):
+    """
+    Compute project-level circular statistics from the per-track orientation
+    statistics (see analyse_orientation).
+
+    :param orientation: The per-track orientation table.
+    :return: A DataFrame with one row per summarised quantity.
+    """
+    rows = ["Exit bearing (deg)", "Mean heading (deg)"]
+    angles = np.radians(orientation[rows].to_numpy(dtype=np.float64).T)
+    offsets = np.arange(len(rows) + 1) * len(orientation)
+
+    stats = circular_statistics(angles.reshape(-1), offsets)
+
+    return pd.DataFrame({"N": stats['n'].astype(int),
+                         "Mean direction (deg)": np.degrees(stats['mean']),
+                         "Mean vector length": stats['r'],
+                         "Circular std (deg)": np.degrees(stats['std']),
+                         "Rayleigh z": stats['rayleigh_z'],
+                         "Rayleigh p": stats['rayleigh_p']},
+                        index=rows)
@@ -0,0 +1,18 @@
+"""
+parallel.py
+
+Small helpers shared by the parts of the software which spread work over
+processes or threads (track smoothing, batch processing, chessboard detection
+and video export).
+"""
+
+import os
+
+def worker_count(requested):
+    """
+    :param requested: The requested number of workers (0 = one per CPU)
+    :return: The number of workers to use.
+    """
+    if requested <= 0:
+        return os.cpu_count() or 1
+    return requested
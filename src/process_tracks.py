@@ -0,0 +1,150 @@
+"""
+process_tracks.py
+
+Command line entry point for track processing. This runs the same processing
+as option 5 in the tool panel (calibrate, zero, smooth, analyse, and plot) for
+a given project directory without any windows, so it can be used in scripts
+or on machines without a display.
+
+Usage:
+    python process_tracks.py [--no-plot] [--verbose | --quiet]
+                             [--log-file FILE] project_directory
+
+Processing options are read from params.json in the working directory (as
+with the GUI). The project directory and project file stored there are not
+changed. All output is logged (to stderr, and to a file with --log-file).
+
+Exit codes:
+    0 - Processing finished.
+    1 - The project could not be processed (e.g. no calibration file).
+    2 - Invalid arguments or project directory.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+# Select a non-interactive backend before pyplot is imported (by
+# track_processing) so that no display is needed.
+import matplotlib
+matplotlib.use("Agg")
+
+from dtrack_params import dtrack_params
+from project import project_filepath
+from track_processing import calibrate_and_smooth_tracks, ProcessingError
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+
+LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s: %(message)s"
+
+logger = logging.getLogger("process_tracks")
+
+def log_level(verbose=False, quiet=False):
+    """
+    :param verbose: If True, debug output is shown.
+    :param quiet: If True, only warnings and errors are shown.
+    :return: The logging level for the command line options.
+    """
+    if verbose:
+        return logging.DEBUG
+    if quiet:
+        return logging.WARNING
+    return logging.INFO
+
+def configure_logging(level=logging.INFO, log_filepath=None):
+    """
+    Send log output to stderr and, optionally, a log file.
+
+    :param level: The logging level.
+    :param log_filepath: Optional file to also write the log to.
+    """
+    handlers = [logging.StreamHandler()]
+    if log_filepath is not None:
+        handlers.append(logging.FileHandler(log_filepath, mode="w"))
+
+    logging.basicConfig(level=level, format=LOG_FORMAT, handlers=handlers)
+
+    # Matplotlib's debug output is not useful here.
+    logging.getLogger("matplotlib").setLevel(max(level, logging.INFO))
+
+def process_project(project_directory, plot=True, options=None):
+    """
+    Process the tracks for a project without changing the project stored in
+    params.json.
+
+    :param project_directory: The project directory.
+    :param plot: If True, the smoothed tracks are plotted and the plot saved.
+    :param options: Optional dictionary of parameters (see dtrack_params) to
+                    use for this run in place of those in params.json.
+    :raises ProcessingError: If the project cannot be processed.
+    """
+    project_directory = os.path.abspath(project_directory)
+    project_file = project_filepath(project_directory)
+
+    if not os.path.exists(project_file):
+        msg = "{} is not a project directory (no project file found)."
+        raise ProcessingError(msg.format(project_directory))
+
+    dtrack_params.override("project_directory", project_directory)
+    dtrack_params.override("project_file", project_file)
+    for key, value in (options or dict()).items():
+        dtrack_params.override(key, value)
+    try:
+        calibrate_and_smooth_tracks(plot=plot, show=False)
+    finally:
+        dtrack_params.clear_overrides()
+
+def main(argv=None):
+    """
+    :param argv: Command line arguments (defaults to sys.argv[1:]).
+    :return: The exit code.
+    """
+    parser = argparse.ArgumentParser(
+        description="Process the tracks for a DungTrack 2 project.")
+    parser.add_argument("project_directory",
+                        help="The project directory to process.")
+    parser.add_argument("--no-plot",
+                        action="store_true",
+                        help="Do not plot the processed tracks.")
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-v", "--verbose",
+                           action="store_true",
+                           help="Show debug output.")
+    verbosity.add_argument("-q", "--quiet",
+                           action="store_true",
+                           help="Only show warnings and errors.")
+    parser.add_argument("--log-file",
+                        help="Also write the output to this file.")
+    args = parser.parse_args(argv)
+
+    configure_logging(log_level(args.verbose, args.quiet), args.log_file)
+
+    if not os.path.exists(project_filepath(args.project_directory)):
+        logger.error("%s is not a project directory (no project file found).",
+                     args.project_directory)
+        return EXIT_USAGE
+
+    logger.info("Processing %s", args.project_directory)
+    start = time.perf_counter()
+    try:
+        process_project(args.project_directory, plot=not args.no_plot)
+    except ProcessingError as e:
+        logger.error("%s", e)
+        return EXIT_FAILURE
+    except Exception:
+        logger.exception("Processing failed for %s", args.project_directory)
+        return EXIT_FAILURE
+
+    logger.info("Finished %s in %.1f s",
+                args.project_directory,
+                time.perf_counter() - start)
+    return EXIT_SUCCESS
+
+# Guard so that worker processes (which re-import this module) do not start
+# processing.
+if __name__ == "__main__":
+    sys.exit(main())
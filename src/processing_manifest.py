@@ -0,0 +1,146 @@
+"""
+processing_manifest.py
+
+Keeps a record of what went into the last track processing run so that later
+runs only need to process tracks which are new or have changed.
+
+The manifest is a small JSON file in the project directory which stores:
+- A fingerprint of everything which affects every track (the calibration file
+  and the relevant processing options).
+- A content hash for each raw track (including its timestamps, if any).
+- The output files which were written.
+
+If the fingerprint changes, every track has to be reprocessed. Otherwise, only
+tracks whose hash has changed (or which have no hash) are reprocessed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from dtrack_params import dtrack_params
+from project import project_file
+
+MANIFEST_FILENAME = "processing_manifest.json"
+MANIFEST_VERSION = 2
+
+# Options which change the processing output for every track. Any option
+# which affects the output of a processing stage must be listed here.
+FINGERPRINT_PARAMS = ["options.processing.resample_rate",
+                      "options.processing.zero",
+                      "options.processing.arena_radius",
+                      "options.processing.truncate_at_exit",
+                      "options.processing.smoothing_method",
+                      "options.processing.smoothing_spline_degree",
+                      "options.processing.smoothing_scale_factor",
+                      "options.processing.smoothing_window",
+                      "options.processing.smoothing_lambda",
+                      "options.processing.smoothing_noise_ratio"]
+
+logger = logging.getLogger("processing_manifest")
+
+def manifest_path(project_directory):
+    """
+    :param project_directory: The project directory.
+    :return: The path of the processing manifest for the project.
+    """
+    return os.path.join(project_directory, MANIFEST_FILENAME)
+
+def fingerprint(calibration_filepath):
+    """
+    Compute a fingerprint for the calibration and processing options.
+
+    :param calibration_filepath: The calibration file used for processing.
+    :return: A hex digest which changes whenever the calibration file or any
+             of the processing options in FINGERPRINT_PARAMS change.
+    """
+    digest = hashlib.sha1()
+    with open(calibration_filepath, 'rb') as f:
+        digest.update(f.read())
+
+    params = {key: dtrack_params[key] for key in FINGERPRINT_PARAMS}
+    params["track_fps"] = project_file["track_fps"]
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+
+    return digest.hexdigest()
+
+def track_hashes(raw_data, time_data=None):
+    """
+    Compute a content hash for each raw track.
+
+    :param raw_data: The raw TrackSet.
+    :param time_data: The timestamp TrackSet (or None).
+    :return: A dictionary mapping track labels to hex digests.
+    """
+    hashes = dict()
+    for label, track in raw_data:
+        digest = hashlib.sha1(np.ascontiguousarray(track).tobytes())
+        if (time_data is not None) and (label in time_data):
+            digest.update(np.ascontiguousarray(time_data[label]).tobytes())
+        hashes[label] = digest.hexdigest()
+
+    return hashes
+
+def load(project_directory):
+    """
+    Load the processing manifest for a project.
+
+    :param project_directory: The project directory.
+    :return: The manifest dictionary or None if there is no (readable)
+             manifest.
+    """
+    filepath = manifest_path(project_directory)
+    if not os.path.exists(filepath):
+        return None
+
+    try:
+        with open(filepath, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        logger.warning("Could not read %s, all tracks will be reprocessed.",
+                       filepath)
+        return None
+
+    if manifest.get("version", 0) != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+def save(project_directory, fingerprint, hashes, outputs):
+    """
+    Write the processing manifest for a project.
+
+    :param project_directory: The project directory.
+    :param fingerprint: The fingerprint for this run (see fingerprint()).
+    :param hashes: The track hashes for this run (see track_hashes()).
+    :param outputs: A dictionary mapping stage names to the output files
+                    written by this run.
+    """
+    manifest = dict(version=MANIFEST_VERSION,
+                    fingerprint=fingerprint,
+                    tracks=hashes,
+                    outputs=outputs)
+
+    filepath = manifest_path(project_directory)
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+def unchanged_tracks(manifest, fingerprint, hashes):
+    """
+    Work out which tracks have not changed since the manifest was written.
+
+    :param manifest: The manifest from the previous run (or None).
+    :param fingerprint: The fingerprint for this run.
+    :param hashes: The track hashes for this run.
+    :return: A list of the labels of tracks which are unchanged.
+    """
+    if (manifest is None) or (manifest["fingerprint"] != fingerprint):
+        return []
+
+    previous = manifest["tracks"]
+    return [label for label, h in hashes.items() if previous.get(label) == h]
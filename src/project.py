@@ -14,6 +14,14 @@ import os
 
 from dtrack_params import dtrack_params
 
+def project_filepath(project_directory):
+    """
+    :param project_directory: A project directory.
+    :return: The path of the project file for that directory.
+    """
+    filename = os.path.basename(os.path.normpath(project_directory)) + ".dt2p"
+    return os.path.join(project_directory, filename)
+
 class ProjectFilePassthrough():
     """
     Class to act as an interaction layer with project files. This abstracts
@@ -10,6 +10,7 @@ import tkinter as tk
 import os
 from tkinter import filedialog, messagebox
 from dtrack_params import dtrack_params
+from project import project_filepath
 
 import json
 
@@ -162,7 +163,5 @@ class ProjectFrame(tk.Frame):
         :param project_directory:
         """
         dtrack_params["project_directory"] = project_directory
-        filename = os.path.basename(project_directory) + ".dt2p"
-        filepath = os.path.join(project_directory,filename)
-        dtrack_params["project_file"] = filepath
+        dtrack_params["project_file"] = project_filepath(project_directory)
 
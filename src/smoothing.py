@@ -0,0 +1,533 @@
+"""
+smoothing.py
+
+Provides the track smoothing methods used by track processing. Functions in
+this module work directly on the concatenated points and offsets arrays of a
+TrackSet (see track_set.py) so that they can be used without the rest of the
+software (e.g. in worker processes).
+
+Available methods:
+- 'spline': Fits a UnivariateSpline to each coordinate of each track. This
+  cannot be batched, so the tracks can instead be spread over a process pool.
+  Tracks are grouped into chunks of similar total size and every track is
+  smoothed by exactly the same code as in the serial case, so the output is
+  identical regardless of the number of workers.
+- 'savgol': Savitzky-Golay filter; a local polynomial is fitted around every
+  point (by least squares over a fixed number of neighbours). All local fits
+  are solved as one batch.
+- 'whittaker': Whittaker smoother; penalised least squares with a second
+  difference penalty. All tracks are smoothed by solving a single sparse
+  (block diagonal) linear system.
+- 'kalman': Constant velocity Kalman filter followed by a Rauch-Tung-Striebel
+  smoother. Tracks of similar length are padded to a common length and
+  filtered together.
+
+The spline method works in sample units. The other methods take timestamps
+into account where they are available: times are expressed in units of each
+track's median sampling interval, so the parameters behave the same
+regardless of frame rate and irregular sampling (e.g. dropped frames) is
+handled correctly.
+"""
+
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.interpolate import UnivariateSpline
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+from parallel import worker_count
+
+METHODS = ['spline', 'savgol', 'whittaker', 'kalman']
+
+# Number of chunks per worker; more chunks gives better load balancing at the
+# cost of more inter-process communication.
+CHUNKS_PER_WORKER = 4
+
+# Below this many points, starting worker processes costs more than it saves.
+MIN_PARALLEL_POINTS = 20000
+
+# Polynomial order used by the Savitzky-Golay filter.
+SAVGOL_ORDER = 2
+
+# Local fits are solved in blocks of this many points to bound memory use.
+SAVGOL_BLOCK_SIZE = 65536
+
+# Sampling intervals shorter than this fraction of the median interval (e.g.
+# repeated timestamps) are clamped to it.
+MIN_INTERVAL = 1e-3
+
+# Initial velocity variance for the Kalman filter (effectively unknown).
+KALMAN_INITIAL_VELOCITY_VARIANCE = 1e6
+
+# Tracks are Kalman filtered in groups of similar length, padded to the
+# longest track in the group. A group's padded size is at most this many
+# times its number of points, and groups hold at most KALMAN_BLOCK_SIZE
+# points (unless a single track is longer), to bound memory use.
+KALMAN_MAX_PADDING = 2
+KALMAN_BLOCK_SIZE = 262144
+
+def spline_smooth_track(track, degree, smoothing_scale):
+    """
+    Smooth a single track using a smoothing spline for each coordinate.
+
+    :param track: The track points (n x 2)
+    :param degree: The spline degree (k)
+    :param smoothing_scale: Scale factor for the smoothing condition s
+    :return: The smoothed track points (n x 2). Tracks with no more points
+             than the spline degree cannot be fitted and are returned
+             unchanged.
+    """
+    if len(track) <= degree:
+        return np.array(track, dtype=np.float64)
+
+    x_data = track[:, 0]
+    y_data = track[:, 1]
+
+    # Work in arbitrary time units. Can combine with FPS later to get
+    # true time.
+    duration = x_data.size
+    t = np.arange(duration)
+
+    # Create a smoothing spline for the data
+    sf_x = smoothing_scale * (np.std(x_data) * len(x_data))
+    sf_y = smoothing_scale * (np.std(y_data) * len(y_data))
+
+    x_spline = UnivariateSpline(t, x_data, k=degree, s=sf_x)
+    y_spline = UnivariateSpline(t, y_data, k=degree, s=sf_y)
+
+    # Compute spline for given time points.
+    smoothed = np.zeros(track.shape)
+    smoothed[:, 0] = x_spline(t)
+    smoothed[:, 1] = y_spline(t)
+
+    return smoothed
+
+def spline_smooth_chunk(points, offsets, degree, smoothing_scale):
+    """
+    Smooth every track in a chunk of concatenated tracks (serially).
+
+    :param points: The concatenated track points (n_points x 2)
+    :param offsets: The start of each track in points (n_tracks + 1)
+    :param degree: The spline degree (k)
+    :param smoothing_scale: Scale factor for the smoothing condition s
+    :return: The smoothed points (n_points x 2)
+    """
+    smoothed = np.zeros(points.shape)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        smoothed[start:end] =\
+            spline_smooth_track(points[start:end], degree, smoothing_scale)
+
+    return smoothed
+
+def balanced_chunks(lengths, n_chunks):
+    """
+    Partition tracks into chunks with roughly equal numbers of points. Tracks
+    are assigned longest first, each to the chunk with the fewest points so
+    far.
+
+    :param lengths: The number of points in each track.
+    :param n_chunks: The number of chunks to create.
+    :return: A list of chunks, each a sorted array of track indices.
+    """
+    heap = [(0, c) for c in range(n_chunks)]
+    chunks = [[] for _ in range(n_chunks)]
+
+    # Stable sort so the partition is deterministic for equal lengths.
+    for idx in np.argsort(-np.asarray(lengths), kind='stable'):
+        size, c = heapq.heappop(heap)
+        chunks[c].append(idx)
+        heapq.heappush(heap, (size + lengths[idx], c))
+
+    return [np.sort(chunk) for chunk in chunks if len(chunk) > 0]
+
+def spline_smooth(points, offsets, degree, smoothing_scale, workers=1):
+    """
+    Smooth every track in a set of concatenated tracks using smoothing
+    splines, optionally using a pool of worker processes.
+
+    :param points: The concatenated track points (n_points x 2)
+    :param offsets: The start of each track in points (n_tracks + 1)
+    :param degree: The spline degree (k)
+    :param smoothing_scale: Scale factor for the smoothing condition s
+    :param workers: The number of worker processes (1 = smooth in this
+                    process, 0 = one per CPU).
+    :return: The smoothed points (n_points x 2)
+    """
+    lengths = np.diff(offsets)
+    workers = min(worker_count(workers), len(lengths))
+
+    if (workers <= 1) or (len(points) < MIN_PARALLEL_POINTS):
+        return spline_smooth_chunk(points, offsets, degree, smoothing_scale)
+
+    chunks = balanced_chunks(lengths, workers * CHUNKS_PER_WORKER)
+
+    # Each chunk is sent as its own concatenated array with local offsets.
+    def chunk_arrays(chunk):
+        tracks = [points[offsets[i]:offsets[i+1]] for i in chunk]
+        chunk_offsets = np.zeros(len(chunk) + 1, dtype=np.int64)
+        chunk_offsets[1:] = np.cumsum(lengths[chunk])
+        return np.concatenate(tracks), chunk_offsets
+
+    # Worker processes are spawned rather than forked; other threads (e.g.
+    # file writers) may be running and forking would copy their locks.
+    smoothed = np.zeros(points.shape)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=context) as executor:
+        futures = []
+        for chunk in chunks:
+            chunk_points, chunk_offsets = chunk_arrays(chunk)
+            futures.append(executor.submit(spline_smooth_chunk,
+                                           chunk_points,
+                                           chunk_offsets,
+                                           degree,
+                                           smoothing_scale))
+
+        # Results are placed by track index, so output order does not depend
+        # on the order in which chunks finish.
+        for chunk, future in zip(chunks, futures):
+            chunk_smoothed = future.result()
+            start = 0
+            for i in chunk:
+                end = start + lengths[i]
+                smoothed[offsets[i]:offsets[i+1]] = chunk_smoothed[start:end]
+                start = end
+
+    return smoothed
+
+def normalised_times(offsets, times=None):
+    """
+    Compute the time of each point relative to the start of its track, in
+    units of the track's median sampling interval.
+
+    :param offsets: The start of each track in points (n_tracks + 1)
+    :param times: The timestamp of each point (any unit) or None, in which
+                  case samples are assumed to be evenly spaced.
+    :return: The normalised time of each point (n_points)
+    """
+    n_points = offsets[-1]
+    lengths = np.diff(offsets)
+
+    if times is None:
+        return (np.arange(n_points) - np.repeat(offsets[:-1], lengths))\
+               .astype(np.float64)
+
+    times = np.asarray(times, dtype=np.float64).reshape(-1)
+    normalised = np.zeros(n_points)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        if end - start < 2:
+            continue
+
+        intervals = np.diff(times[start:end])
+        positive = intervals[intervals > 0]
+        step = np.median(positive) if positive.size > 0 else 1.0
+        intervals = np.maximum(intervals, MIN_INTERVAL * step) / step
+        normalised[start+1:end] = np.cumsum(intervals)
+
+    return normalised
+
+def savgol_smooth(points, offsets, times, window):
+    """
+    Savitzky-Golay smoothing. A polynomial of order SAVGOL_ORDER is fitted
+    (least squares) to the window of points around each point and evaluated
+    at that point. Windows are shifted at the ends of a track so they stay
+    within the track.
+
+    :param points: The concatenated track points (n_points x n_dims)
+    :param offsets: The start of each track in points (n_tracks + 1)
+    :param times: The normalised time of each point (see normalised_times)
+    :param window: The number of points in each local fit (odd).
+    :return: The smoothed points (n_points x n_dims)
+    """
+    window = max(int(window) | 1, SAVGOL_ORDER + 1)
+    half = window // 2
+    n_coeffs = SAVGOL_ORDER + 1
+
+    lengths = np.diff(offsets)
+    starts = np.repeat(offsets[:-1], lengths)
+    ends = np.repeat(offsets[1:], lengths)
+
+    smoothed = points.copy()
+    for block in range(0, len(points), SAVGOL_BLOCK_SIZE):
+        idx = np.arange(block, min(block + SAVGOL_BLOCK_SIZE, len(points)))
+        s = starts[idx]
+        e = ends[idx]
+
+        # Window of neighbours for each point (clipped to its track). Slots
+        # beyond the end of a short track are given zero weight.
+        window_start = np.clip(idx - half, s, np.maximum(e - window, s))
+        neighbours = window_start[:, None] + np.arange(window)
+        valid = neighbours < e[:, None]
+        neighbours = np.where(valid, neighbours, idx[:, None])
+
+        # Local polynomial centred on the point; the fitted value at the
+        # point is the constant coefficient.
+        dt = (times[neighbours] - times[idx][:, None]) / max(half, 1)
+        vander = dt[:, :, None] ** np.arange(n_coeffs)
+        weighted = vander * valid[:, :, None]
+
+        weighted = weighted.transpose(0, 2, 1)
+        normal = weighted @ vander
+        rhs = weighted @ points[neighbours]
+
+        # Tracks too short to fit the polynomial are left unsmoothed.
+        solvable = valid.sum(axis=1) > SAVGOL_ORDER
+        coeffs = np.linalg.solve(normal[solvable], rhs[solvable])
+        smoothed[idx[solvable]] = coeffs[:, 0, :]
+
+    return smoothed
+
+def whittaker_smooth(points, offsets, times, penalty):
+    """
+    Whittaker smoothing. Minimises the squared distance to the data plus
+    penalty times the sum of squared second derivatives (divided differences
+    so irregular sampling is accounted for). Every track is smoothed by a
+    single sparse solve as the tracks are independent (block diagonal).
+
+    :param points: The concatenated track points (n_points x n_dims)
+    :param offsets: The start of each track in points (n_tracks + 1)
+    :param times: The normalised time of each point (see normalised_times)
+    :param penalty: The smoothing parameter (lambda); larger is smoother.
+    :return: The smoothed points (n_points x n_dims)
+    """
+    n_points = len(points)
+
+    # Second differences are taken around every point which has a neighbour
+    # on either side in the same track.
+    interior = np.ones(n_points, dtype=bool)
+    interior[offsets[:-1]] = False
+    interior[np.maximum(offsets[1:] - 1, 0)] = False
+    centre = np.flatnonzero(interior)
+
+    if (centre.size == 0) or (penalty <= 0):
+        return points.copy()
+
+    h0 = times[centre] - times[centre - 1]
+    h1 = times[centre + 1] - times[centre]
+    values = np.concatenate((2 / (h0 * (h0 + h1)),
+                             -2 / (h0 * h1),
+                             2 / (h1 * (h0 + h1))))
+    rows = np.tile(np.arange(centre.size), 3)
+    columns = np.concatenate((centre - 1, centre, centre + 1))
+    differences = sparse.csc_matrix((values, (rows, columns)),
+                                    shape=(centre.size, n_points))
+
+    system = sparse.identity(n_points, format='csc') +\
+             penalty * (differences.T @ differences)
+
+    return splu(system.tocsc()).solve(np.asarray(points, dtype=np.float64))
+
+def kalman_groups(lengths):
+    """
+    Split tracks into groups of similar length for Kalman filtering (see
+    KALMAN_MAX_PADDING and KALMAN_BLOCK_SIZE).
+
+    :param lengths: The number of points in each track.
+    :return: A list of arrays of track indices, one per group.
+    """
+    order = np.argsort(lengths, kind='stable')[::-1]
+    groups = []
+    start = 0
+    n_points = 0
+    for end, idx in enumerate(order):
+        length = lengths[idx]
+        longest = lengths[order[start]]
+        if (end > start) and\
+           (((end - start + 1) * longest > KALMAN_MAX_PADDING * (n_points + length)) or
+            (n_points + length > KALMAN_BLOCK_SIZE)):
+            groups.append(order[start:end])
+            start = end
+            n_points = 0
+        n_points += length
+
+    if start < len(order):
+        groups.append(order[start:])
+    return groups
+
+def kalman_smooth(points, offsets, times, noise_ratio):
+    """
+    Constant velocity Kalman filter and Rauch-Tung-Striebel smoother. Each
+    coordinate of each track is treated as an independent position/velocity
+    state with white noise acceleration. Tracks of similar length are
+    filtered together (see kalman_groups()) so that memory use scales with
+    the number of points rather than the longest track.
+
+    :param points: The concatenated track points (n_points x n_dims)
+    :param offsets: The start of each track in points (n_tracks + 1)
+    :param times: The normalised time of each point (see normalised_times)
+    :param noise_ratio: Ratio of process noise (acceleration) variance to
+                        measurement noise variance; smaller is smoother.
+    :return: The smoothed points (n_points x n_dims)
+    """
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)
+    smoothed = np.zeros(points.shape)
+
+    for group in kalman_groups(lengths):
+        group_lengths = lengths[group]
+        group_offsets = np.zeros(len(group) + 1, dtype=np.int64)
+        group_offsets[1:] = np.cumsum(group_lengths)
+        if group_offsets[-1] == 0:
+            continue
+
+        # Indices of the group's points in the full set of points
+        index = np.arange(group_offsets[-1]) +\
+                np.repeat(offsets[group] - group_offsets[:-1], group_lengths)
+
+        smoothed[index] = kalman_smooth_padded(points[index],
+                                               group_offsets,
+                                               times[index],
+                                               noise_ratio)
+
+    return smoothed
+
+def kalman_smooth_padded(points, offsets, times, noise_ratio):
+    """
+    Kalman smoothing (see kalman_smooth()) of a set of tracks which are padded
+    to a common length so that every track (and coordinate) is filtered at
+    once; steps beyond the end of a track leave its state unchanged.
+
+    :param points: The concatenated track points (n_points x n_dims)
+    :param offsets: The start of each track in points (n_tracks + 1)
+    :param times: The normalised time of each point (see normalised_times)
+    :param noise_ratio: Ratio of process noise (acceleration) variance to
+                        measurement noise variance; smaller is smoother.
+    :return: The smoothed points (n_points x n_dims)
+    """
+    n_tracks = len(offsets) - 1
+    n_dims = points.shape[1]
+    if n_tracks == 0:
+        return points.copy()
+
+    lengths = np.diff(offsets)
+    n_steps = int(lengths.max())
+    track_idx = np.repeat(np.arange(n_tracks), lengths)
+    row_idx = np.arange(len(points)) - np.repeat(offsets[:-1], lengths)
+
+    # Padded (step, track x dimension) layout
+    n_series = n_tracks * n_dims
+    z = np.zeros((n_steps, n_tracks, n_dims))
+    z[row_idx, track_idx] = points
+    z = z.reshape(n_steps, n_series)
+
+    dt = np.zeros((n_steps, n_tracks))
+    dt[row_idx[row_idx > 0], track_idx[row_idx > 0]] =\
+        np.diff(times)[row_idx[1:] > 0]
+    dt = np.repeat(dt, n_dims, axis=1)
+
+    valid = np.zeros((n_steps, n_tracks), dtype=bool)
+    valid[row_idx, track_idx] = True
+    valid = np.repeat(valid, n_dims, axis=1)
+
+    q = noise_ratio
+    r = 1.0
+
+    # Filtered (f) and predicted (p) means and covariances for every step.
+    shape = (n_steps, n_series)
+    pos_f, vel_f = np.zeros(shape), np.zeros(shape)
+    p00_f, p01_f, p11_f = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    pos_p, vel_p = np.zeros(shape), np.zeros(shape)
+    p00_p, p01_p, p11_p = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+
+    pos_f[0] = z[0]
+    p00_f[0] = r
+    p11_f[0] = KALMAN_INITIAL_VELOCITY_VARIANCE
+
+    for k in range(1, n_steps):
+        h = dt[k]
+
+        # Predict
+        pos_p[k] = pos_f[k-1] + h * vel_f[k-1]
+        vel_p[k] = vel_f[k-1]
+        p00_p[k] = p00_f[k-1] + 2 * h * p01_f[k-1] + h**2 * p11_f[k-1] +\
+                   q * h**3 / 3
+        p01_p[k] = p01_f[k-1] + h * p11_f[k-1] + q * h**2 / 2
+        p11_p[k] = p11_f[k-1] + q * h
+
+        # Update (only where the track has a measurement at this step)
+        gain0 = np.where(valid[k], p00_p[k] / (p00_p[k] + r), 0)
+        gain1 = np.where(valid[k], p01_p[k] / (p00_p[k] + r), 0)
+        innovation = z[k] - pos_p[k]
+
+        pos_f[k] = pos_p[k] + gain0 * innovation
+        vel_f[k] = vel_p[k] + gain1 * innovation
+        p00_f[k] = (1 - gain0) * p00_p[k]
+        p01_f[k] = (1 - gain0) * p01_p[k]
+        p11_f[k] = p11_p[k] - gain1 * p01_p[k]
+
+    # Backward (RTS) pass
+    pos_s = pos_f.copy()
+    vel_s = vel_f.copy()
+    for k in range(n_steps - 2, -1, -1):
+        h = dt[k+1]
+
+        # Smoother gain G = P_f F^T inv(P_p)
+        a = p00_f[k] + h * p01_f[k]
+        b = p01_f[k]
+        c = p01_f[k] + h * p11_f[k]
+        d = p11_f[k]
+        det = p00_p[k+1] * p11_p[k+1] - p01_p[k+1]**2
+        i00 = p11_p[k+1] / det
+        i01 = -p01_p[k+1] / det
+        i11 = p00_p[k+1] / det
+
+        dpos = pos_s[k+1] - pos_p[k+1]
+        dvel = vel_s[k+1] - vel_p[k+1]
+        pos_s[k] = pos_f[k] + (a * i00 + b * i01) * dpos +\
+                   (a * i01 + b * i11) * dvel
+        vel_s[k] = vel_f[k] + (c * i00 + d * i01) * dpos +\
+                   (c * i01 + d * i11) * dvel
+
+    pos_s = pos_s.reshape(n_steps, n_tracks, n_dims)
+    return pos_s[row_idx, track_idx]
+
+def smooth(points,
+           offsets,
+           method='spline',
+           times=None,
+           degree=3,
+           smoothing_scale=0.03,
+           window=15,
+           penalty=100,
+           noise_ratio=0.01,
+           workers=1):
+    """
+    Smooth a set of concatenated tracks with the chosen method.
+
+    :param points: The concatenated track points (n_points x n_dims)
+    :param offsets: The start of each track in points (n_tracks + 1)
+    :param method: One of METHODS
+    :param times: The timestamp of each point (any unit) or None. Ignored by
+                  the spline method.
+    :param degree: Spline degree (spline)
+    :param smoothing_scale: Smoothing condition scale factor (spline)
+    :param window: Points per local fit (savgol)
+    :param penalty: Smoothing parameter lambda (whittaker)
+    :param noise_ratio: Process to measurement noise ratio (kalman)
+    :param workers: Worker processes (spline, see spline_smooth)
+    :return: The smoothed points (n_points x n_dims)
+    """
+    # Failing this assertion indicates programmer error.
+    assert method in METHODS
+
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    if method == 'spline':
+        return spline_smooth(points,
+                             offsets,
+                             degree,
+                             smoothing_scale,
+                             workers=workers)
+
+    times = normalised_times(offsets, times)
+
+    if method == 'savgol':
+        return savgol_smooth(points, offsets, times, window)
+    if method == 'whittaker':
+        return whittaker_smooth(points, offsets, times, penalty)
+
+    return kalman_smooth(points, offsets, times, noise_ratio)
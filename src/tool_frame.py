@@ -5,6 +5,7 @@ Provides a Tkinter UI for selecting and running different tools.
 """
 
 import tkinter as tk
+from tkinter import messagebox
 import webbrowser
 import os
 
@@ -15,7 +16,7 @@ from chessboard_selector import ChessboardSelector
 from autotrack import autotracker
 from old_calibration import calib
 from calibration_manager import CalibrationManager
-from track_processing import calibrate_and_smooth_tracks
+from track_processing import calibrate_and_smooth_tracks, ProcessingError
 from configuration_tool import ConfigurationTool
 
 
@@ -185,7 +186,11 @@ class ToolFrame(tk.Frame):
         elif var == 4:
             autotracker()
         elif var == 5:
-            calibrate_and_smooth_tracks()
+            try:
+                calibrate_and_smooth_tracks()
+            except ProcessingError as e:
+                messagebox.showerror(title="Could not process tracks",
+                                     message=str(e))
 
     def __run_configuration(self):
         """
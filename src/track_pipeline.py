@@ -0,0 +1,254 @@
+"""
+track_pipeline.py
+
+Provides a small pipeline object for chaining track processing stages in
+memory. Each stage takes a TrackSet and returns a new TrackSet which is passed
+directly to the next stage, so there is no file I/O between stages. Analyses
+can be attached at any point in the chain; these take a TrackSet and return a
+DataFrame without modifying the tracks.
+
+Output files are only written for stages which are given an output filepath.
+Files are written by background threads as soon as the relevant stage has
+finished so that writing overlaps with later stages. Call wait() to make sure
+all files have been written.
+
+The pipeline can also be run incrementally. Given the results of a previous
+run and the labels of tracks which have not changed since, only the remaining
+tracks are processed and the new results are merged with the old ones.
+
+Example:
+    pipeline = TrackPipeline()
+    pipeline.add_stage('calibrated', calibrate, output='calibrated_tracks.csv')
+    pipeline.add_stage('smoothed', smooth)
+    pipeline.add_analysis('statistics', analyse, output='summary_statistics.csv')
+    smoothed = pipeline.run(raw_tracks)
+    pipeline.wait()
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import track_store
+from track_set import TrackSet
+
+logger = logging.getLogger("track_pipeline")
+
+def merge_track_sets(labels, previous, new):
+    """
+    Merge two TrackSets, taking each track from new if it is present there and
+    from previous otherwise.
+
+    :param labels: The labels of the tracks in the merged set (in order).
+    :param previous: The TrackSet from a previous run.
+    :param new: The newly computed TrackSet.
+    :return: The merged TrackSet.
+    """
+    source = lambda label: new if label in new else previous
+    return TrackSet.from_tracks(labels,
+                                [source(l)[l] for l in labels],
+                                suffixes=new.suffixes)
+
+def merge_tables(labels, previous, new):
+    """
+    Merge two per-track tables (indexed by track label), taking each row from
+    new if it is present there and from previous otherwise.
+
+    :param labels: The labels of the tracks in the merged table (in order).
+    :param previous: The table from a previous run.
+    :param new: The newly computed table.
+    :return: The merged table.
+    """
+    reused = [l for l in labels if l not in new.index]
+    merged = pd.concat([previous.loc[reused], new.loc[new.index.isin(labels)]])
+    return merged.loc[labels]
+
+class TrackPipeline():
+    """
+    Chain of in-memory track processing stages.
+    """
+    def __init__(self, max_writers=2):
+        """
+        :param max_writers: The maximum number of files written concurrently.
+        """
+        self.__stages = []
+        self.__max_writers = max_writers
+        self.__executor = None
+        self.__pending = []
+
+        # Output of each stage/analysis, accessible by name after run().
+        self.results = dict()
+
+    def add_stage(self, name, function, output=None):
+        """
+        Add a processing stage to the end of the pipeline.
+
+        :param name: The name of the stage (used to access the result).
+        :param function: A function which takes a TrackSet and returns a
+                         TrackSet.
+        :param output: If set, the stage output is written to this (CSV)
+                       filepath.
+        :return: The pipeline (so calls can be chained).
+        """
+        self.__stages.append((name, function, output, None))
+        return self
+
+    def add_analysis(self, name, function, output=None, merge=merge_tables):
+        """
+        Add an analysis to the end of the pipeline. Analyses receive the
+        output of the previous stage and do not modify the tracks which are
+        passed on.
+
+        :param name: The name of the analysis (used to access the result).
+        :param function: A function which takes a TrackSet and returns a
+                         DataFrame.
+        :param output: If set, the analysis output is written to this CSV
+                       filepath.
+        :param merge: The function used to merge results from a previous run
+                      with new results when running incrementally. Takes the
+                      track labels, the previous result and the new result.
+        :return: The pipeline (so calls can be chained).
+        """
+        self.__stages.append((name, function, output, merge))
+        return self
+
+    def stage_names(self):
+        """
+        :return: The names of all stages and analyses in order.
+        """
+        return [stage[0] for stage in self.__stages]
+
+    def analysis_names(self):
+        """
+        :return: The names of all analyses in order.
+        """
+        return [stage[0] for stage in self.__stages if stage[3] is not None]
+
+    def outputs(self):
+        """
+        :return: A dictionary mapping stage names to output filepaths (None if
+                 the stage output is not written).
+        """
+        return {stage[0]: stage[2] for stage in self.__stages}
+
+    def reusable_labels(self, track_set, previous, unchanged):
+        """
+        Work out which tracks can be taken from a previous run. A track can
+        only be reused if it has not changed and it is present in the previous
+        result of every stage which produces an output (and the final stage).
+
+        :param track_set: The input TrackSet.
+        :param previous: A dictionary mapping stage names to results from a
+                         previous run.
+        :param unchanged: The labels of the tracks which have not changed.
+        :return: The set of reusable labels.
+        """
+        reusable = set(unchanged) & set(track_set.labels)
+
+        required = [name for name, _, output, merge in self.__stages
+                    if (output is not None) or (merge is not None)]
+        required.append(self.__final_stage())
+
+        for name in required:
+            if name not in previous:
+                return set()
+
+            result = previous[name]
+            present = result.labels if isinstance(result, TrackSet) else\
+                      result.index
+            reusable &= set(present)
+
+        return reusable
+
+    def run(self, track_set, previous=None, unchanged=()):
+        """
+        Run every stage of the pipeline in order.
+
+        :param track_set: The input TrackSet.
+        :param previous: Optional dictionary mapping stage names to results
+                         from a previous run (see unchanged).
+        :param unchanged: The labels of tracks which have not changed since
+                          the previous run. Where possible, these tracks are
+                          not reprocessed and their previous results are used.
+        :return: The TrackSet produced by the final stage.
+        """
+        if self.__executor is None:
+            self.__executor =\
+                ThreadPoolExecutor(max_workers=self.__max_writers)
+
+        labels = list(track_set.labels)
+        reused = set()
+        if previous is not None:
+            reused = self.reusable_labels(track_set, previous, unchanged)
+
+        if len(reused) > 0:
+            logger.info("Reusing previous results for %d of %d tracks.",
+                        len(reused), len(labels))
+            track_set = track_set.subset(
+                [i for i, l in enumerate(labels) if l not in reused])
+
+        for name, function, output, merge in self.__stages:
+            is_analysis = merge is not None
+
+            if len(track_set) > 0:
+                result = function(track_set)
+            else:
+                # Nothing new to process
+                result = None
+
+            if not is_analysis:
+                track_set = result if result is not None else track_set
+
+            if (len(reused) > 0) and (name in previous):
+                if result is None:
+                    result = previous[name]
+                elif is_analysis:
+                    result = merge(labels, previous[name], result)
+                else:
+                    result = merge_track_sets(labels, previous[name], result)
+
+            # Stages without previous results (i.e. those which are not
+            # written out) only hold the reprocessed tracks.
+            self.results[name] = result
+
+            if (output is not None) and (result is not None):
+                self.__pending.append(
+                    self.__executor.submit(self.__write, result, output))
+
+        return self.results[self.__final_stage()]
+
+    def __final_stage(self):
+        """
+        :return: The name of the last stage which modifies the tracks.
+        """
+        return [name for name, _, _, merge in self.__stages
+                if merge is None][-1]
+
+    def wait(self):
+        """
+        Block until all output files have been written. Any exception raised
+        while writing is re-raised here.
+        """
+        try:
+            for future in self.__pending:
+                future.result()
+        finally:
+            self.__pending = []
+            if self.__executor is not None:
+                self.__executor.shutdown()
+                self.__executor = None
+
+    def __write(self, result, filepath):
+        """
+        Write a stage or analysis result to file.
+
+        :param result: A TrackSet or DataFrame
+        :param filepath: The destination CSV filepath.
+        """
+        if hasattr(result, 'to_csv'):
+            result.to_csv(filepath)
+        else:
+            track_store.write_track_set(result, filepath)
+
+        logger.info("Written: %s", filepath)
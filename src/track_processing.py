@@ -10,22 +10,50 @@ depend heavily on the calibration being good.
 
 """
 
-from tkinter import messagebox
-
+import logging
 import os
+import warnings
+from functools import partial
+
 import numpy as np
 import numpy.ma as ma
 import pandas as pd
-import cv2
-from scipy.interpolate import UnivariateSpline
 
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 
 
 from dtrack_params import dtrack_params
 from project import project_file
 
 import calibration as calib
+import smoothing
+import track_store
+from track_set import TrackSet
+from track_pipeline import TrackPipeline, merge_tables
+import processing_manifest
+import orientation
+
+logger = logging.getLogger("track_processing")
+
+class ProcessingError(Exception):
+    """
+    Raised when a project cannot be processed (e.g. it has no calibration
+    file). The message is intended to be shown to the user.
+    """
+
+def calibrate_track_set(calibration: calib.Calibration,
+                        track_set: TrackSet):
+    """
+    Calibrate a set of raw tracks to give the points in world coordinates (mm).
+
+    :param calibration: A calibration object (see calibration.py)
+    :param track_set: The raw tracks in pixel coordinates
+    :return: A TrackSet containing the calibrated tracks.
+    """
+    # All points from all tracks are calibrated as a single batch.
+    return track_set.with_points(calibration.image_to_world(track_set.points))
 
 def calibrate_tracks(calibration: calib.Calibration, 
                      raw_track_filepath: str, 
@@ -38,191 +66,424 @@ def calibrate_tracks(calibration: calib.Calibration,
     :param raw_track_file: The raw track in pixelcoordinates (csv)
     :param dest_filepath: The output file for the calibrated tracks
     """
-    camera_matrix = calibration.camera_matrix
-    homography = calibration.perspective_transform
-    distortion_coefficients = calibration.distortion
-    scale = calibration.scale
-
-    raw_data = pd.read_csv(raw_track_filepath, index_col=[0])
-    calibrated_data = pd.DataFrame(columns=raw_data.columns, 
-                                   index=raw_data.index)
-    columns = list(raw_data.columns)
-
-    # Iterate over raw data and calibrate each set of x,y points
-    col_idx = 0
-    while col_idx < len(columns):
-        # Extract datapoints and convert to numpy arrays
-        x_data = raw_data.loc[:,columns[col_idx]]
-        y_data = raw_data.loc[:,columns[col_idx+1]]
-        x_data = x_data.to_numpy(dtype=np.float64, na_value=np.nan)
-        y_data = y_data.to_numpy(dtype=np.float64, na_value=np.nan)
-
-        # Check lengths match (fail otherwise)
-        assert len(x_data) == len(y_data)
-
-        #
-        # Intrinsic calibration (camera distortion)
-        #  
-
-        # Pack into 2xN array for calibration
-        points = np.stack((x_data, y_data))
-
-        # Calibrate points, returns Nx1x2
-        
-        calibrated_points =\
-              cv2.undistortImagePoints(points, 
-                                       cameraMatrix=camera_matrix,
-                                       distCoeffs=distortion_coefficients)
-        
-        # Remove dimension added by OpenCV and transpose to 2XN
-        calibrated_points = np.squeeze(calibrated_points)
-        calibrated_points = calibrated_points.T
-
-        #
-        # Extrinsic calibration (camera perspective)
-        # 
-
-        # Generate sequence of 1s to be added to each point
-        ones = np.ones((1,calibrated_points.shape[1]))
-
-        # Each coordinate now [x,y,1], full structure is Nx3
-        calibrated_points = np.concatenate((calibrated_points, ones)).T
-        
-        # Map the homography transformation onto every point
-        # Should return a 3xN matrix of the transformed points
-        
-        calibrated_points =\
-            np.array(list(map(lambda x: np.dot(homography, x), 
-                              calibrated_points)))
-
-        calibrated_points = calibrated_points.T
-
-        # scale = px/mm -> (x px / scale) = y mm
-        # These coordinates should be in mm.
-        scaled_calibrated_points = calibrated_points / scale
-
-        # Insert calibrated x and y values into new dataframe.
-        calibrated_data.loc[:, columns[col_idx]] = scaled_calibrated_points[0]
-        calibrated_data.loc[:, columns[col_idx+1]] = scaled_calibrated_points[1]
-
-        col_idx += 2 # Iterate over pairs of columns
-
-    # Write out new dataframe.
-    calibrated_data.to_csv(dest_filepath)
+    raw_data = track_store.read_track_set(raw_track_filepath)
+    calibrated_data = calibrate_track_set(calibration, raw_data)
+
+    # Write out new tracks.
+    track_store.write_track_set(calibrated_data, dest_filepath)
+
+def align_timestamps(track_set, time_data):
+    """
+    Build an array giving the timestamp of every point in a TrackSet. Tracks
+    without (matching) timestamps are assumed to be evenly sampled.
+
+    :param track_set: The tracks.
+    :param time_data: A TrackSet storing the time information for each track
+                      or None if there is no time information.
+    :return: The timestamp of each point (n_points) or None if there is no
+             time information.
+    """
+    if time_data is None:
+        return None
+
+    times = np.zeros(track_set.n_points)
+    for idx, label in enumerate(track_set.labels):
+        start, end = track_set.offsets[idx], track_set.offsets[idx+1]
+        if (label in time_data) and (len(time_data[label]) == end - start):
+            times[start:end] = time_data[label][:, 0]
+        else:
+            times[start:end] = np.arange(end - start)
+
+    return times
+
+def smooth_track_set(track_set, time_data=None):
+    """
+    Smooth each track in a TrackSet using the method selected in the
+    processing options (see smoothing.py). Spline smoothing may be done in
+    parallel (see options.processing.smoothing_workers); the result does not
+    depend on the number of workers.
+
+    :param track_set: The tracks to smooth.
+    :param time_data: A TrackSet storing the time information for each track
+                      or None if there is no time information.
+    :return: A TrackSet containing the smoothed tracks.
+    """
+    smoothed = smoothing.smooth(
+        track_set.points,
+        track_set.offsets,
+        method=dtrack_params["options.processing.smoothing_method"],
+        times=align_timestamps(track_set, time_data),
+        degree=dtrack_params["options.processing.smoothing_spline_degree"],
+        smoothing_scale=dtrack_params["options.processing.smoothing_scale_factor"],
+        window=dtrack_params["options.processing.smoothing_window"],
+        penalty=dtrack_params["options.processing.smoothing_lambda"],
+        noise_ratio=dtrack_params["options.processing.smoothing_noise_ratio"],
+        workers=dtrack_params["options.processing.smoothing_workers"])
+
+    return track_set.with_points(smoothed)
 
 def smooth_tracks(track_file, 
-                  dest_filepath):
+                  dest_filepath,
+                  timestamp_filepath=None):
     """
     Apply smoothing to tracks.
 
-    If dest_file == None then the destination filename will be based on the
-    track_file.    
-
     :param track_file: The csv track file you wish to use
     :param dest_file: A destination file
+    :param timestamp_filepath: The csv file storing the time information for
+                               each track (optional)
     """
-    data = pd.read_csv(track_file, index_col=[0])
+    data = track_store.read_track_set(track_file)
 
-    smoothed_index = np.arange(data.index.size)
-    smoothed_data = pd.DataFrame(columns=data.columns, index=smoothed_index)
+    time_data = None
+    if (timestamp_filepath is not None) and os.path.exists(timestamp_filepath):
+        time_data = track_store.read_track_set(timestamp_filepath)
 
-    columns = list(data.columns)    
+    smoothed_data = smooth_track_set(data, time_data)
 
-    degree = dtrack_params["options.processing.smoothing_spline_degree"]
-    smoothing_scale = dtrack_params["options.processing.smoothing_scale_factor"]
+    # Write out new tracks.
+    track_store.write_track_set(smoothed_data, dest_filepath)
 
-    # Iterate over raw data and calibrate each set of x,y points
-    col_idx = 0
-    while col_idx < len(columns):
-        # Extract datapoints and convert to numpy arrays
-        x_data = data.loc[:,columns[col_idx]]
-        y_data = data.loc[:,columns[col_idx+1]]
-        x_data = x_data.to_numpy(dtype=np.float64, na_value=np.nan)
-        y_data = y_data.to_numpy(dtype=np.float64, na_value=np.nan)
-
-        # Filter out NaN values, but retain count for re-augmentation
-        full_len_x = x_data.size
-
-        x_data = x_data[~np.isnan(x_data)]
-        y_data = y_data[~np.isnan(y_data)]
+def zero_track_set(track_set, origin=(0,0)):
+    """
+    Translate every track in a TrackSet such that it starts from origin. The
+    first point in a track is assumed to be the origin.
 
-        # Check lengths match (fail otherwise)
-        assert len(x_data) == len(y_data)
+    :param track_set: The tracks to zero.
+    :param origin: The desired origin point
+    :return: A TrackSet containing the zeroed tracks.
+    """
+    # Determine X and Y offset of each track from desired origin and
+    # translate all points.
+    offsets = track_set.first_points() - np.asarray(origin, dtype=np.float64)
+    zeroed = track_set.points - np.repeat(offsets, track_set.lengths, axis=0)
+    return track_set.with_points(zeroed)
 
-        # Work in arbitrary time units. Can combine with FPS later to get
-        # true time.
-        duration = x_data.size
-        t = np.arange(duration)
+def zero_tracks(raw_track_file, dest_filepath, origin=(0,0)):
+    """
+    Normalise all tracks in a file such that they start from origin. The first
+    point in a track is assumed to be the origin.
 
-        # Create a smoothing spline for the data
-        sf_x = smoothing_scale * (np.std(x_data) * len(x_data))
-        sf_y = smoothing_scale * (np.std(y_data) * len(y_data))
+    :param track_file: The csv track file you wish to use
+    :param dest_file: A destination file
+    :param origin: The desired origin point
+    """
+    data = track_store.read_track_set(raw_track_file)
+    zeroed_data = zero_track_set(data, origin=origin)
 
-        x_spline = UnivariateSpline(t, x_data, k=degree, s=sf_x)
-        y_spline = UnivariateSpline(t, y_data, k=degree, s=sf_y)
+    # Write out new tracks.
+    track_store.write_track_set(zeroed_data, dest_filepath)
 
-        # Compute spline for given time points.
-        x_smooth = x_spline(t)
-        y_smooth = y_spline(t)
+def relative_times(track_data, time_data=None):
+    """
+    Compute the time of every point relative to the start of its track.
+    Times are taken from the millisecond timestamps if we have them and
+    inferred from the fps if we don't. If we don't know either then they
+    will be NaN.
+
+    :param track_data: The tracks.
+    :param time_data: A TrackSet storing the time information for each track
+                      or None if there is no time information.
+    :return: The time of each point in seconds (n_points)
+    """
+    times = np.full(track_data.n_points, np.nan)
 
-        # Re-augment tracks with NaN values to preserve length and avoid index
-        # problems with pandas.
-        padding_size = (full_len_x - x_data.size)
-        padding = np.array([np.nan for n in range(padding_size)])
+    fps = project_file["track_fps"]
+    if fps != -1:
+        row = np.arange(track_data.n_points) -\
+              np.repeat(track_data.offsets[:-1], track_data.lengths)
+        times = row / fps
 
-        x_smooth = np.concatenate((x_smooth, padding))
-        y_smooth = np.concatenate((y_smooth, padding))
+    if time_data is not None:
+        for idx, label in enumerate(track_data.labels):
+            start, end = track_data.offsets[idx], track_data.offsets[idx+1]
+            if (label in time_data) and (len(time_data[label]) == end - start):
+                ts = time_data[label][:, 0]
+                times[start:end] = (ts - ts[0]) / 1000
 
-        # Insert x with smoothed y values
-        smoothed_data.loc[:, columns[col_idx]] = x_smooth
-        smoothed_data.loc[:, columns[col_idx+1]] = y_smooth
+    return times
 
-        col_idx += 2 # Iterate over pairs of columns    
-    
-    # Write out new dataframe.
-    smoothed_data.to_csv(dest_filepath)        
+def min_resampled_length():
+    """
+    :return: The minimum number of points in a resampled track, enough for the
+             smoothing spline (which needs more points than its degree).
+    """
+    return dtrack_params["options.processing.smoothing_spline_degree"] + 1
 
-def zero_tracks(raw_track_file, dest_filepath, origin=(0,0)):
+def resample_track_set(track_set, time_data, rate, min_length=1):
     """
-    Normalise all tracks in a file such that they start from origin. The first
-    point in a track is assumed to be the origin.
+    Resample every track onto a uniform time base using the stored timestamps
+    (or the fps if a track has no timestamps). Points are linearly
+    interpolated. Tracks whose timing is unknown are left unchanged.
+
+    Tracks which are too short to give min_length points at this rate are
+    resampled to min_length points evenly spaced over the track (i.e. at a
+    higher rate) so that they can still be smoothed.
+
+    All tracks are interpolated at once: tracks are shifted in time so that
+    they follow one another without overlapping and a single interpolation is
+    performed over the concatenated tracks.
+
+    :param track_set: The tracks to resample.
+    :param time_data: A TrackSet storing the time information for each track
+                      or None if there is no time information.
+    :param rate: The sample rate in Hz.
+    :param min_length: The minimum number of points in a resampled track.
+                       Tracks with fewer original points are not lengthened.
+    :return: A tuple (resampled TrackSet, TrackSet of resampled timestamps in
+             milliseconds).
+    """
+    n_tracks = len(track_set)
+    lengths = track_set.lengths
+    track_idx = track_set.track_index()
+    times = relative_times(track_set, time_data)
+
+    # Tracks with no time information (or only one point) are not resampled.
+    last_times = np.full(n_tracks, np.nan)
+    nonempty = lengths > 0
+    last_times[nonempty] = times[track_set.offsets[1:][nonempty] - 1]
+    known = np.bincount(track_idx,
+                        weights=np.isnan(times),
+                        minlength=n_tracks) == 0
+    resample = known & (lengths > 1)
+    last_times[~resample] = 0
+
+    # Number of samples on the new time base for each track
+    new_lengths = np.where(resample,
+                           np.floor(last_times * rate + 1e-9).astype(np.int64) + 1,
+                           lengths)
+    intervals = np.full(n_tracks, 1 / rate)
+
+    # Short tracks are sampled more often to keep min_length points.
+    short = resample & (new_lengths < np.minimum(min_length, lengths))
+    new_lengths[short] = np.minimum(min_length, lengths[short])
+    intervals[short] = last_times[short] / (new_lengths[short] - 1)
+
+    # Shift each track so it starts one second after the previous track ends.
+    shifts = np.zeros(n_tracks)
+    shifts[1:] = np.cumsum(last_times + 1)[:-1]
+    shifted = times + shifts[track_idx]
+    # Guard against out-of-order timestamps within a track.
+    shifted[np.isnan(shifted)] = 0
+    shifted = np.maximum.accumulate(shifted)
+
+    new_offsets = np.zeros(n_tracks + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(new_lengths)
+    new_track_idx = np.repeat(np.arange(n_tracks), new_lengths)
+    new_row = np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1],
+                                                     new_lengths)
+    new_times = new_row * intervals[new_track_idx]
+
+    resampled = np.zeros((new_offsets[-1], track_set.n_dims))
+    target = resample[new_track_idx]
+    source = resample[track_idx]
+    query = new_times[target] + shifts[new_track_idx[target]]
+    for d in range(track_set.n_dims):
+        resampled[target, d] = np.interp(query,
+                                         shifted[source],
+                                         track_set.points[source, d])
+    resampled[~target] = track_set.points[~source]
+
+    # Timestamps (ms) keep the start time of the original track.
+    start_ms = np.zeros(n_tracks)
+    if time_data is not None:
+        for idx, label in enumerate(track_set.labels):
+            if (label in time_data) and (len(time_data[label]) > 0):
+                start_ms[idx] = time_data[label][0, 0]
+
+    new_times[~target] = times[~source]
+    timestamps = TrackSet(start_ms[new_track_idx] + new_times * 1000,
+                          new_offsets,
+                          track_set.labels,
+                          suffixes=[''])
+
+    # Tracks with unknown timing have no timestamps.
+    if not known.all():
+        timestamps = timestamps.subset(np.flatnonzero(known))
+
+    return (TrackSet(resampled, new_offsets, track_set.labels,
+                     suffixes=track_set.suffixes),
+            timestamps)
+
+def resample_tracks(track_file,
+                    timestamp_filepath,
+                    dest_filepath,
+                    dest_timestamp_filepath,
+                    rate):
+    """
+    Resample tracks onto a uniform time base (see resample_track_set). Tracks
+    keep enough points to be smoothed with the selected spline degree.
 
     :param track_file: The csv track file you wish to use
-    :param dest_file: A destination file
-    :param origin: The desired origin point
+    :param timestamp_filepath: The csv file storing the time information for
+                               each track
+    :param dest_filepath: A destination file for the resampled tracks
+    :param dest_timestamp_filepath: A destination file for the resampled
+                                    timestamps
+    :param rate: The sample rate in Hz.
     """
-    data = pd.read_csv(raw_track_file, index_col=[0])
-    zeroed_data = pd.DataFrame(columns=data.columns, index=data.index)
-    columns = list(data.columns)
+    data = track_store.read_track_set(track_file)
 
-    # Iterate over raw data and calibrate each set of x,y points
-    col_idx = 0
-    while col_idx < len(columns):
-        # Extract datapoints and convert to numpy arrays
-        x_data = data.loc[:,columns[col_idx]]
-        y_data = data.loc[:,columns[col_idx+1]]
-        x_data = x_data.to_numpy(dtype=np.float64, na_value=np.nan)
-        y_data = y_data.to_numpy(dtype=np.float64, na_value=np.nan)
+    time_data = None
+    if os.path.exists(timestamp_filepath):
+        time_data = track_store.read_track_set(timestamp_filepath)
 
-        # Check lengths match (fail otherwise)
-        assert len(x_data) == len(y_data)
+    resampled_data, resampled_times =\
+        resample_track_set(data, time_data, rate, min_length=min_resampled_length())
 
-        # Determine X and Y offset from desired origin
-        x_offset = x_data[0] - origin[0]
-        y_offset = y_data[0] - origin[1]
-        
-        # Apply translate all points
-        norm_x = x_data - x_offset
-        norm_y = y_data - y_offset
+    # Write out new tracks.
+    track_store.write_track_set(resampled_data, dest_filepath)
+    track_store.write_track_set(resampled_times, dest_timestamp_filepath)
+
+def analyse_track_set(track_data,
+                      time_data=None,
+                      exit_radius=None,
+                      truncate=False):
+    """
+    Compute some basic summary stats on a set of tracks. Currently computing 
+    path length, displacement, straightness, duration, time to exit, exit
+    position, and speed.
+
+    The exit is the first point at which a track crosses a circle of radius
+    exit_radius centred on the first point of the track (interpolated between
+    samples). Time to exit is the time from the start of the track to the
+    exit.
+
+    Every statistic is computed for all tracks at once from the concatenated
+    point array (see track_set.py).
+
+    :param track_data: The TrackSet to analyse (calibrated, in mm).
+    :param time_data: A TrackSet storing the time information for each track
+                      or None if there is no time information.
+    :param exit_radius: The exit radius in mm (None to skip exit detection).
+    :param truncate: If True, tracks are truncated at their exit before any
+                     other statistics are computed.
+    :return: A DataFrame containing the statistics for each track.
+    """
+    n_tracks = len(track_data)
+
+    # Exit detection
+    times = relative_times(track_data, time_data)
+    exit_time = np.full(n_tracks, np.nan)
+    exit_position = np.full((n_tracks, 2), np.nan)
+    if exit_radius is not None:
+        _, segment, fraction, exit_position =\
+            orientation.first_crossings(track_data, exit_radius)
+        exit_time = orientation.interpolate_at_crossings(track_data,
+                                                         times,
+                                                         segment,
+                                                         fraction)
+        if truncate:
+            track_data, times = orientation.truncate_at_crossings(track_data,
+                                                                  segment,
+                                                                  fraction,
+                                                                  times)
+
+    lengths = track_data.lengths
+    nonempty = lengths > 0
+    starts = track_data.offsets[:-1][nonempty]
+    ends = track_data.offsets[1:][nonempty] - 1
+    points = track_data.points
+
+    # Distance from each point to the previous point in the same track (zero
+    # for the first point of each track).
+    steps = np.zeros(track_data.n_points)
+    if track_data.n_points > 1:
+        diffs = np.diff(points, axis=0)
+        steps[1:] = np.sqrt(diffs[:, 0]**2 + diffs[:, 1]**2)
+        steps[starts] = 0
+
+    # Calibrated tracks are stored in mm
+    path_length = np.full(n_tracks, np.nan)
+    displacement = np.full(n_tracks, np.nan)
+    if starts.size > 0:
+        path_length[nonempty] = np.add.reduceat(steps, starts) / 1000
+        offset = points[ends] - points[starts]
+        displacement[nonempty] =\
+            np.sqrt(offset[:, 0]**2 + offset[:, 1]**2) / 1000
+
+    # Durations are taken from the millisecond timestamps if we have them and
+    # inferred from the fps if we don't. If we don't know either then they
+    # will be NaN.
+    duration = np.full(n_tracks, np.nan)
+
+    fps = project_file["track_fps"]
+    if fps != -1:
+        duration = lengths / fps
+
+    if time_data is not None:
+        time_index = {label: idx for idx, label in enumerate(time_data.labels)}
+        time_lengths = time_data.lengths
+        timed = [(idx, time_index[label])
+                 for idx, label in enumerate(track_data.labels)
+                 if (label in time_index) and\
+                    (time_lengths[time_index[label]] > 0)]
+        if len(timed) > 0:
+            track_idx, time_idx = np.array(timed).T
+            time_for_track = time_data.last_points()[time_idx, 0] -\
+                             time_data.first_points()[time_idx, 0]
+            duration[track_idx] = time_for_track / 1000 # Time in seconds
+
+    # Truncated tracks end at the exit.
+    if truncate:
+        duration = np.where(np.isnan(exit_time), duration, exit_time)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        straightness = displacement / path_length
+        speed = path_length / duration
+
+    stats = pd.DataFrame({"Length (m)": path_length,
+                          "Displacement (m)": displacement,
+                          "Straightness": straightness,
+                          "Duration (s)": duration,
+                          "Time to exit (s)": exit_time,
+                          "Speed (m/s)": speed,
+                          "Exit x (mm)": exit_position[:, 0],
+                          "Exit y (mm)": exit_position[:, 1]},
+                         index=list(track_data.labels))
+
+    stats = summarise_statistics(stats)
 
-        # Insert calibrated x and y values into new dataframe.
-        zeroed_data.loc[:, columns[col_idx]] = norm_x
-        zeroed_data.loc[:, columns[col_idx+1]] = norm_y
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None): 
+        logger.info("Summary statistics:\n%s", stats.to_string())
+
+    return stats
+
+def summarise_statistics(stats):
+    """
+    Add the mean and standard deviation rows to a table of per-track
+    statistics. These are computed over the track rows only, ignoring any
+    missing (NaN) values.
+
+    :param stats: The per-track statistics (see analyse_track_set)
+    :return: The statistics with "Mean" and "Std. Dev." rows appended.
+    """
+    values = stats.to_numpy(dtype=np.float64)
 
-        col_idx += 2 # Iterate over pairs of columns
+    # Columns with no values (e.g. no time information) are left as NaN.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        summary = pd.DataFrame([np.nanmean(values, axis=0),
+                                np.nanstd(values, axis=0)],
+                               index=["Mean", "Std. Dev."],
+                               columns=stats.columns)
 
-    # Write out new dataframe.
-    zeroed_data.to_csv(dest_filepath)
+    return pd.concat([stats, summary])
+
+def merge_statistics(labels, previous, new):
+    """
+    Merge per-track statistics from a previous processing run with newly
+    computed statistics and recompute the summary rows.
+
+    :param labels: The track labels in the merged table (in order).
+    :param previous: The statistics table from the previous run.
+    :param new: The newly computed statistics table.
+    :return: The merged statistics table.
+    """
+    track_rows = lambda table: table.drop(index=["Mean", "Std. Dev."],
+                                          errors='ignore')
+    merged = merge_tables(labels, track_rows(previous), track_rows(new))
+    return summarise_statistics(merged)
 
 def analyse_tracks(input_filepath, timestamp_filepath, dest_filepath):
     """
@@ -234,134 +495,89 @@ def analyse_tracks(input_filepath, timestamp_filepath, dest_filepath):
                                for each track
     :param dest_filepath: The path where you want to store the statistics file.
     """
-    track_data = pd.read_csv(input_filepath, index_col=[0])
-    columns = list(track_data.columns)
-    
-    # Generate index for new dataframe
-    n_tracks = int(len(columns)/2)
-    track_indices = np.arange(0, n_tracks)
-    track_labels = ["track_" + str(x) for x in track_indices]
-    track_labels.append("Mean")
-    track_labels.append("Std. Dev.")
-
-    # Generate analysis columns for new dataframe
-    headers = ["Length (m)", 
-               "Displacement (m)", 
-               "Straightness", 
-               "Time to exit (s)", 
-               "Speed (m/s)"]
-
-    stats = pd.DataFrame(index=track_labels, columns=headers)
-
-    time_file_exists = os.path.exists(timestamp_filepath)
-    if time_file_exists:
-        time_data = pd.read_csv(timestamp_filepath, index_col=[0])
-
-    col_idx = 0
-    while col_idx < len(columns):
-        track_no = columns[col_idx].split("_")[1]
-        track_label = "track_" + track_no
-        
-        xs = track_data.loc[:, columns[col_idx]].to_numpy()
-        ys = track_data.loc[:, columns[col_idx+1]].to_numpy()
-
-        assert(len(xs[~np.isnan(xs)])  == len(ys[~np.isnan(ys)]))
-
-        # Strip out NaN values
-        xs = xs[~np.isnan(xs)]
-        ys = ys[~np.isnan(ys)]
-
-        # Path length
-        x_dists = np.power(np.ediff1d(xs), 2)
-        y_dists = np.power(np.ediff1d(ys), 2)
-        dists = np.sqrt(np.add(x_dists, y_dists))
-
-        # Calibrated tracks are stored in mm
-        path_length = np.sum(dists) / 1000 
-        stats.loc[track_label, 'Length (m)'] = path_length
-
-        # Displacement
-        euc_dist = lambda p, q: np.sqrt((p[0] - q[0])**2 + (p[1] - q[1])**2)
-        start_point = (xs[0], ys[0])
-        end_point = (xs[-1], ys[-1])
-        displacement = euc_dist(start_point, end_point) / 1000
-        stats.loc[track_label, 'Displacement (m)'] = displacement
-
-        # Straightness
-        straightness = displacement/path_length
-        stats.loc[track_label, 'Straightness'] = straightness
-
-        # Fill in time-based statistics if we know them.
-        if time_file_exists:
-            time_for_track = np.nan
-            speed = np.nan
-
-            # If the timeseries information exists
-            try:
-                # Try to extract timeseries for this track
-                ts = time_data.loc[:, track_label].to_numpy()
-                ts = ts[~np.isnan(ts)]
-
-                time_for_track = (ts[-1] - ts[0]) / 1000 # Time in seconds
-                speed = path_length/time_for_track
-            except KeyError:
-                # If track doesn't exist in timeseries file, check that we know
-                # the fps of the video and then use that to infer the time information.
-                
-                if project_file["track_fps"] != -1:
-                    time_for_track = len(xs) / project_file["track_fps"] 
-                    speed = path_length / time_for_track
-
-            # These will be based on the millisecond data if we have it, inferred
-            # from the fps if we don't, and if we don't know that then it will 
-            # be NaN.
-            stats.loc[track_label, 'Time to exit (s)'] = time_for_track
-            stats.loc[track_label, 'Speed (m/s)'] = speed                    
-        elif project_file["track_fps"] != -1:
-
-            # No time file exists, check for fps and infer timing from that.
-            # Time in s
-            time_for_track = len(xs) / project_file["track_fps"] 
-            stats.loc[track_label, 'Time to exit (s)'] = time_for_track
-
-            # Speed in m/s
-            speed = path_length / time_for_track
-            stats.loc[track_label, 'Speed (m/s)'] = speed
-
-        col_idx += 2
-    
-    # Compute means and standard deviations
-    for col in stats.columns:
-        stats.loc['Mean', col] = np.mean(stats.loc[:, col])
-        stats.loc['Std. Dev.', col] = np.std(stats.loc[:, col])
-
-    with pd.option_context('display.max_rows', None, 'display.max_columns', None): 
-        print(stats)
-
+    track_data = track_store.read_track_set(input_filepath)
+
+    time_data = None
+    if os.path.exists(timestamp_filepath):
+        time_data = track_store.read_track_set(timestamp_filepath)
+
+    # Arena radius is given in cm, tracks are in mm.
+    stats = analyse_track_set(
+        track_data,
+        time_data,
+        exit_radius=dtrack_params['options.processing.arena_radius'] * 10,
+        truncate=dtrack_params['options.processing.truncate_at_exit'])
     stats.to_csv(dest_filepath)
 
-    print("Summary statistics stored in: {}".format(dest_filepath))
-    
-    
+    logger.info("Summary statistics stored in: %s", dest_filepath)
 
-def plot_tracks(input_file, 
-                draw_arena=False, 
-                arena_radius=50, 
-                draw_mean_displacement=False,
-                scale=1000):
+
+def decimate_track_set(track_set, max_points):
+    """
+    Reduce the number of points in long tracks (for plotting). Tracks with
+    more than max_points points keep every n-th point (and their last point)
+    so that they have at most max_points + 1 points; shorter tracks are
+    unchanged.
+
+    :param track_set: The TrackSet to decimate.
+    :param max_points: The maximum number of points per track (0 = keep all
+                       points).
+    :return: The decimated TrackSet.
+    """
+    if (max_points <= 0) or (len(track_set) == 0):
+        return track_set
+
+    lengths = track_set.lengths
+    if lengths.max() <= max_points:
+        return track_set
+
+    # Position of each point within its track and the step for its track.
+    track_index = track_set.track_index()
+    position = np.arange(track_set.n_points) - track_set.offsets[track_index]
+    steps = np.maximum(-(-lengths // max_points), 1)
+
+    keep = (position % steps[track_index]) == 0
+    keep[track_set.offsets[1:] - 1] = True
+
+    offsets = np.zeros(len(track_set) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.add.reduceat(keep.astype(np.int64),
+                                             track_set.offsets[:-1]))
+    return TrackSet(track_set.points[keep],
+                    offsets,
+                    track_set.labels,
+                    suffixes=track_set.suffixes)
+
+def plot_track_set(data,
+                   name="",
+                   draw_arena=False, 
+                   arena_radius=50, 
+                   draw_mean_displacement=False,
+                   scale=1000):
     """
     Helper method to test calibration, this is only intended to check distance
     tranformations have been performed successfully, this is not for any 
     formal analysis.
 
-    :param input_file: The CSV file you want to use as the underlying data.
+    All tracks are drawn as a single LineCollection so plotting time does not
+    grow much with the number of tracks.
+
+    :param data: The TrackSet to plot.
+    :param name: A name for the data used in terminal output.
     :param draw_arena: Draw a circle on the plot of the same radius as the
                        arena used in the experiment.
     :param arena_radius: The radius of the arena in cm.
     """
-
-    data = pd.read_csv(input_file, index_col=[0])
-    columns = list(data.columns)
+    # Read all plot options up front.
+    plot_grid = dtrack_params["options.processing.plot_grid"]
+    include_legend = dtrack_params["options.processing.include_legend"]
+    legend_max_tracks = dtrack_params["options.processing.legend_max_tracks"]
+    max_points = dtrack_params["options.processing.plot_max_points"]
+    rasterise = dtrack_params["options.processing.plot_rasterise"]
+    flip_x = dtrack_params["options.processing.flip_x_axis"]
+    flip_y = dtrack_params["options.processing.flip_y_axis"]
+    filetype = dtrack_params["options.processing.filetype"]
+    filename = dtrack_params["options.processing.filename"]
+    project_directory = dtrack_params["project_directory"]
 
     # Convert to metres
     arena_radius = arena_radius * 10
@@ -384,80 +600,99 @@ def plot_tracks(input_file,
         ax.plot(starter[0], starter[1], color='k')
         ax.set_aspect('equal') # If we're drawing the arena, fair assumption
 
-    if dtrack_params["options.processing.plot_grid"]:
+    if plot_grid:
         ax.grid()
-        
-    displacements = []
-
-    col_idx = 0    
-    while col_idx < len(columns):
-        # Extract datapoints and convert to numpy arrays
-        x_data = data.loc[:,columns[col_idx]]
-        y_data = data.loc[:,columns[col_idx+1]]
-        x_data = x_data.to_numpy(dtype=np.float64, na_value=np.nan)
-        y_data = y_data.to_numpy(dtype=np.float64, na_value=np.nan)
-
-        if dtrack_params["options.processing.flip_x_axis"]:
-            x_data *= -1
-
-        if dtrack_params["options.processing.flip_y_axis"]:
-            y_data *= -1
-
-        # Check lengths match (fail otherwise)
-        assert len(x_data) == len(y_data)
-        x_data /= scale
-        y_data /= scale
 
-        roll_no = columns[col_idx].split("_")[1]
-        ax.plot(x_data, y_data, alpha=0.5, label="Track {}".format(roll_no))
-        
-        # Track average displacement
+    data = decimate_track_set(data, max_points)
+
+    # Flip and scale all points at once; tracks are then views into the
+    # transformed points.
+    flip = np.array([-1 if flip_x else 1, -1 if flip_y else 1])
+    points = data.points[:, :2] * flip / scale
+    segments = np.split(points, data.offsets[1:-1])
+
+    # Use the same colours as individual ax.plot() calls would.
+    cycle = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    colours = [cycle[i % len(cycle)] for i in range(len(data))]
+
+    tracks = LineCollection(segments,
+                            colors=colours,
+                            alpha=0.5,
+                            rasterized=rasterise)
+    ax.add_collection(tracks)
+    ax.autoscale_view()
+
+    if include_legend:
+        if len(data) <= legend_max_tracks:
+            handles = [Line2D([], [],
+                              color=colour,
+                              alpha=0.5,
+                              label="Track {}".format(label.split("_")[1]))
+                       for label, colour in zip(data.labels, colours)]
+            ax.legend(handles=handles)
+        else:
+            logger.info("Legend omitted (%d tracks, maximum is %d)",
+                        len(data), legend_max_tracks)
+
+    logger.info("Plotted: %s", name)
 
-        # Find last non NaN element 
-        x_end = x_data[~np.isnan(x_data)][-1]        
-        y_end = y_data[~np.isnan(y_data)][-1]        
-        x_disp = (x_data[0] - x_end)**2
-        y_disp = (y_data[0] - y_end)**2
-
-        # Compute and store displacement
-        disp = np.sqrt(x_disp + y_disp)
-        displacements.append(disp)
-
-        col_idx += 2 # Iterate over pairs of columns
-
-    if dtrack_params["options.processing.include_legend"]:
-        ax.legend()
-
-    print("Plotted: {}".format(input_file))
-
-    filetype = dtrack_params["options.processing.filetype"]
     if filetype == "png (400dpi)":
         filetype = "png"
 
-    filename = dtrack_params["options.processing.filename"] + "." +\
-               filetype
-    filepath = os.path.join(dtrack_params["project_directory"], filename)
+    filename = filename + "." + filetype
+    filepath = os.path.join(project_directory, filename)
 
     plt.savefig(filepath, dpi=400, bbox_inches="tight")
 
-    print("Plot saved as {}".format(filepath))
+    logger.info("Plot saved as %s", filepath)
+
+def plot_tracks(input_file, 
+                draw_arena=False, 
+                arena_radius=50, 
+                draw_mean_displacement=False,
+                scale=1000):
+    """
+    Plot the tracks stored in a file (see plot_track_set) and show the plot.
+
+    :param input_file: The CSV file you want to use as the underlying data.
+    :param draw_arena: Draw a circle on the plot of the same radius as the
+                       arena used in the experiment.
+    :param arena_radius: The radius of the arena in cm.
+    """
+    plot_track_set(track_store.read_track_set(input_file),
+                   name=input_file,
+                   draw_arena=draw_arena,
+                   arena_radius=arena_radius,
+                   draw_mean_displacement=draw_mean_displacement,
+                   scale=scale)
 
     plt.show()
 
 
-def calibrate_and_smooth_tracks():
+def calibrate_and_smooth_tracks(plot=True, show=True):
+    """
+    Run the full processing pipeline (calibrate, zero, smooth, analyse, and
+    plot) for the current project. This does not depend on the GUI so it can
+    be called from scripts (see process_tracks.py) as well as the tool panel.
+
+    :param plot: If True, plot the smoothed tracks and save the plot.
+    :param show: If True, show the plot once processing has finished. This
+                 blocks until the plot window is closed.
+    :raises ProcessingError: If the project cannot be processed.
+    """
     calibration_filepath = project_file["calibration_file"]
     
     # Check for calibration file
     if not os.path.exists(calibration_filepath):
         msg = "This project has no calibration file, use the calibration manager" +\
               " to generate or import one."
-        messagebox.showerror(title="No calibration file!",
-                             message=msg)
-        return
+        raise ProcessingError(msg)
 
     # Load calibration file
-    calibration = calib.from_file(calibration_filepath)
+    try:
+        calibration = calib.from_file(calibration_filepath)
+    except calib.CalibrationFileError as e:
+        raise ProcessingError(str(e)) from e
     
     raw_data_filepath = os.path.join(dtrack_params["project_directory"],
                                      'raw_tracks.csv')
@@ -467,22 +702,167 @@ def calibrate_and_smooth_tracks():
                                      'smoothed_tracks.csv')
     stats_filepath = os.path.join(dtrack_params["project_directory"],
                                   "summary_statistics.csv")
+    orientation_filepath = os.path.join(dtrack_params["project_directory"],
+                                        "orientation_statistics.csv")
+    orientation_summary_filepath =\
+        os.path.join(dtrack_params["project_directory"],
+                     "orientation_summary.csv")
+    headings_filepath = os.path.join(dtrack_params["project_directory"],
+                                     "headings.csv")
+    turning_angles_filepath = os.path.join(dtrack_params["project_directory"],
+                                           "turning_angles.csv")
     
     timestamp_filepath = os.path.join(dtrack_params["project_directory"],
                                       "timestamps.csv")
+    resampled_timestamp_filepath =\
+        os.path.join(dtrack_params["project_directory"],
+                     "resampled_timestamps.csv")
+
+    if not os.path.exists(raw_data_filepath):
+        msg = "This project has no tracks ({} does not exist), use the" +\
+              " autotracker to track your videos."
+        raise ProcessingError(msg.format(raw_data_filepath))
+
+    raw_data = track_store.read_track_set(raw_data_filepath)
+
+    time_data = None
+    if os.path.exists(timestamp_filepath):
+        time_data = track_store.read_track_set(timestamp_filepath)
+
+    # Hashes are taken from the tracks as stored so that changes are detected
+    # regardless of processing options.
+    hashes = processing_manifest.track_hashes(raw_data, time_data)
+
+    # Tracks are resampled before processing so that every stage works on
+    # the uniform time base.
+    resample_rate = dtrack_params['options.processing.resample_rate']
+    if resample_rate > 0:
+        raw_data, time_data = resample_track_set(raw_data,
+                                                 time_data,
+                                                 resample_rate,
+                                                 min_length=min_resampled_length())
+        track_store.write_track_set(time_data, resampled_timestamp_filepath)
+        logger.info("Written: %s", resampled_timestamp_filepath)
+
+    # Intermediate stages are passed between in memory and only written out
+    # if the user wants them.
+    write_intermediate = dtrack_params['options.processing.write_intermediate']
+    intermediate_output = lambda filepath: filepath if write_intermediate else None
+
+    pipeline = TrackPipeline()
+    pipeline.add_stage('calibrated',
+                       partial(calibrate_track_set, calibration),
+                       output=intermediate_output(calibrated_filepath))
 
-    calibrate_tracks(calibration,
-                     raw_data_filepath,
-                     calibrated_filepath)
-    
-    zeroed_filepath = calibrated_filepath
     if dtrack_params['options.processing.zero']:
         zeroed_filepath = os.path.join(dtrack_params["project_directory"],
-                                       'zeroed_tracks.csv')    
-        zero_tracks(calibrated_filepath, zeroed_filepath)
-    
-    smooth_tracks(zeroed_filepath, smoothed_filepath)
-
-    analyse_tracks(smoothed_filepath, timestamp_filepath, stats_filepath)
-
-    plot_tracks(smoothed_filepath)
+                                       'zeroed_tracks.csv')
+        pipeline.add_stage('zeroed',
+                           zero_track_set,
+                           output=intermediate_output(zeroed_filepath))
+
+    pipeline.add_stage('smoothed',
+                       partial(smooth_track_set, time_data=time_data),
+                       output=smoothed_filepath)
+    # Arena radius is given in cm, tracks are in mm.
+    exit_radius = dtrack_params['options.processing.arena_radius'] * 10
+    truncate = dtrack_params['options.processing.truncate_at_exit']
+    pipeline.add_analysis('statistics',
+                          partial(analyse_track_set,
+                                  time_data=time_data,
+                                  exit_radius=exit_radius,
+                                  truncate=truncate),
+                          output=stats_filepath,
+                          merge=merge_statistics)
+
+    pipeline.add_analysis('orientation',
+                          partial(orientation.analyse_orientation,
+                                  radius=exit_radius),
+                          output=orientation_filepath)
+
+    # Only tracks which are new or have changed since the last run need to be
+    # processed; everything else can be taken from the previous output files.
+    project_directory = dtrack_params["project_directory"]
+    fingerprint = processing_manifest.fingerprint(calibration_filepath)
+    outputs = {name: output for name, output in pipeline.outputs().items()
+               if output is not None}
+
+    manifest = processing_manifest.load(project_directory)
+    unchanged = processing_manifest.unchanged_tracks(manifest,
+                                                     fingerprint,
+                                                     hashes)
+    previous = None
+    if len(unchanged) > 0:
+        previous = load_previous_outputs(manifest,
+                                         outputs,
+                                         pipeline.analysis_names())
+
+    smoothed_data = pipeline.run(raw_data,
+                                 previous=previous,
+                                 unchanged=unchanged)
+
+    # Project-level orientation statistics are computed from the per-track
+    # table (which includes any tracks taken from the previous run).
+    orientation_summary =\
+        orientation.summarise_orientation(pipeline.results['orientation'])
+    logger.info("Orientation summary:\n%s", orientation_summary.to_string())
+    orientation_summary.to_csv(orientation_summary_filepath)
+    logger.info("Written: %s", orientation_summary_filepath)
+
+    # Heading and turning angle time series (degrees) for every track. These
+    # are quick to compute for all tracks so are not taken from the previous
+    # run.
+    heading_data = orientation.headings(smoothed_data)
+    turning_data = orientation.turning_angles(heading_data)
+    heading_data = heading_data.with_points(np.degrees(heading_data.points))
+    track_store.write_track_set(heading_data, headings_filepath)
+    logger.info("Written: %s", headings_filepath)
+    turning_data = turning_data.with_points(np.degrees(turning_data.points))
+    track_store.write_track_set(turning_data, turning_angles_filepath)
+    logger.info("Written: %s", turning_angles_filepath)
+
+    if plot:
+        plot_track_set(smoothed_data, name=smoothed_filepath)
+
+    # Make sure all files are written before handing control back to the user.
+    pipeline.wait()
+
+    processing_manifest.save(project_directory, fingerprint, hashes, outputs)
+
+    if plot and show:
+        plt.show()
+    else:
+        plt.close('all')
+
+def load_previous_outputs(manifest, outputs, tables):
+    """
+    Load the outputs of a previous processing run so that they can be reused.
+    Outputs are only loaded if the previous run wrote them to the same file
+    this run will; anything which cannot be loaded is skipped (the pipeline
+    will then reprocess the affected tracks).
+
+    :param manifest: The processing manifest from the previous run.
+    :param outputs: A dictionary mapping stage names to output files for this
+                    run.
+    :param tables: The names of stages whose outputs are tables (analyses)
+                   rather than tracks.
+    :return: A dictionary mapping stage names to previous results.
+    """
+    previous = dict()
+    for name, filepath in outputs.items():
+        if manifest["outputs"].get(name) != filepath:
+            continue
+
+        if not os.path.exists(filepath):
+            continue
+
+        try:
+            if name in tables:
+                previous[name] = pd.read_csv(filepath, index_col=[0])
+            else:
+                previous[name] = track_store.read_track_set(filepath)
+        except (OSError, ValueError, AssertionError):
+            logger.warning("Could not load %s, tracks will be reprocessed.",
+                           filepath)
+
+    return previous
@@ -0,0 +1,242 @@
+"""
+track_set.py
+
+Provides a compact in-memory representation for a collection of tracks. All
+points from all tracks are stored in one concatenated array and an offsets
+array gives the start of each track (CSR-style), so memory use is proportional
+to the number of real points rather than the length of the longest track.
+
+Batch operations (calibration, zeroing, etc.) can be performed on the whole
+concatenated array at once. Per-track views are available by indexing.
+
+The CSV files used by the software store tracks as a wide, NaN padded table;
+TrackSet.from_dataframe() and TrackSet.to_dataframe() convert between the
+two representations.
+"""
+
+import numpy as np
+import pandas as pd
+
+class TrackSet():
+    """
+    Ragged collection of tracks.
+    """
+    def __init__(self, points, offsets, labels, suffixes=('_x', '_y')):
+        """
+        :param points: The concatenated points from all tracks (n_points x n_dims)
+        :param offsets: The start index of each track in points, with a final
+                        entry giving the total number of points (n_tracks + 1)
+        :param labels: The label of each track (e.g. 'track_0')
+        :param suffixes: The column suffix for each dimension when the tracks
+                         are written out as a table. ('_x', '_y') for tracks,
+                         ('',) for timestamps.
+        """
+        self.suffixes = list(suffixes)
+        self.points = np.reshape(np.asarray(points, dtype=np.float64),
+                                 (-1, len(self.suffixes)))
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.labels = list(labels)
+
+        # Failing these assertions indicates programmer error.
+        assert len(self.offsets) == len(self.labels) + 1
+        assert self.offsets[-1] == len(self.points)
+
+    @classmethod
+    def empty(cls, suffixes=('_x', '_y')):
+        """
+        Create a TrackSet with no tracks.
+
+        :param suffixes: The column suffixes (see __init__)
+        """
+        return cls(np.zeros((0, len(suffixes))), [0], [], suffixes=suffixes)
+
+    @classmethod
+    def from_tracks(cls, labels, tracks, suffixes=('_x', '_y')):
+        """
+        Create a TrackSet from a list of individual tracks.
+
+        :param labels: The label of each track
+        :param tracks: A list of arrays (one n_i x n_dims array per track)
+        :param suffixes: The column suffixes (see __init__)
+        """
+        n_dims = len(suffixes)
+        tracks = [np.reshape(np.asarray(t, dtype=np.float64), (-1, n_dims))
+                  for t in tracks]
+        offsets = np.zeros(len(tracks) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(t) for t in tracks])
+        points = np.concatenate(tracks) if len(tracks) > 0 else\
+                 np.zeros((0, n_dims))
+        return cls(points, offsets, labels, suffixes=suffixes)
+
+    @classmethod
+    def from_dataframe(cls, data):
+        """
+        Convert a wide (NaN padded) track DataFrame into a TrackSet. Track
+        points are taken to be the non-NaN rows of the first dimension of each
+        track. Track files have two columns per track ('track_i_x',
+        'track_i_y') whereas timestamp files have one ('track_i').
+
+        :param data: The wide DataFrame (as stored in the CSV files).
+        """
+        columns = list(data.columns)
+        suffixes = ['']
+        if (len(columns) > 0) and columns[0].endswith('_x'):
+            suffixes = ['_x', '_y']
+        n_dims = len(suffixes)
+
+        # Check column structure (fail otherwise)
+        assert (len(columns) % n_dims) == 0
+
+        labels = [c[:len(c) - len(suffixes[0])] for c in columns[::n_dims]]
+        n_tracks = len(labels)
+
+        values = data.to_numpy(dtype=np.float64, na_value=np.nan)
+
+        # (rows, tracks, dimensions) -> (tracks, rows, dimensions)
+        values =\
+            values.reshape(values.shape[0], n_tracks, n_dims).transpose(1,0,2)
+        mask = ~np.isnan(values[:, :, 0])
+
+        offsets = np.zeros(n_tracks + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(mask.sum(axis=1))
+
+        return cls(values[mask], offsets, labels, suffixes=suffixes)
+
+    def to_dataframe(self):
+        """
+        Construct the wide, NaN padded DataFrame representation of this
+        TrackSet (as stored in the CSV files).
+
+        :return: The wide DataFrame.
+        """
+        n_tracks = len(self)
+        n_dims = self.n_dims
+        lengths = self.lengths
+        n_rows = int(lengths.max()) if n_tracks > 0 else 0
+
+        # Row within each track and track index for every point.
+        track_idx = self.track_index()
+        row_idx = np.arange(self.n_points) - np.repeat(self.offsets[:-1],
+                                                       lengths)
+
+        # Fill column-major so pandas can take ownership of the array without
+        # another copy.
+        padded = np.full(n_tracks * n_dims * n_rows, np.nan)
+        for d in range(n_dims):
+            padded[(track_idx * n_dims + d) * n_rows + row_idx] =\
+                self.points[:, d]
+        padded = padded.reshape(n_tracks * n_dims, n_rows)
+
+        columns = [l + s for l in self.labels for s in self.suffixes]
+        return pd.DataFrame(padded.T, columns=columns, copy=False)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, track):
+        """
+        :param track: The track label or the index of the track in this set.
+        :return: A view of the points belonging to the track.
+        """
+        if isinstance(track, str):
+            track = self.index(track)
+        return self.points[self.offsets[track]:self.offsets[track+1]]
+
+    def __iter__(self):
+        """
+        Iterate over (label, points) pairs.
+        """
+        for idx, label in enumerate(self.labels):
+            yield label, self[idx]
+
+    def __contains__(self, label):
+        return label in self.labels
+
+    def index(self, label):
+        """
+        :param label: A track label
+        :return: The index of the track within this set.
+        """
+        return self.labels.index(label)
+
+    @property
+    def n_points(self):
+        return self.points.shape[0]
+
+    @property
+    def n_dims(self):
+        return self.points.shape[1]
+
+    @property
+    def lengths(self):
+        """
+        The number of points in each track.
+        """
+        return np.diff(self.offsets)
+
+    def track_index(self):
+        """
+        :return: The index of the track to which each point belongs.
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def first_points(self):
+        """
+        :return: The first point of each track (n_tracks x n_dims). Empty
+                 tracks have a NaN row.
+        """
+        return self.__points_at(self.offsets[:-1])
+
+    def last_points(self):
+        """
+        :return: The last point of each track (n_tracks x n_dims). Empty
+                 tracks have a NaN row.
+        """
+        return self.__points_at(self.offsets[1:] - 1)
+
+    def __points_at(self, index):
+        """
+        :param index: One point index per track.
+        :return: The points at the indices (n_tracks x n_dims), NaN for empty
+                 tracks.
+        """
+        nonempty = self.lengths > 0
+        points = np.full((len(self), self.n_dims), np.nan)
+        points[nonempty] = self.points[index[nonempty]]
+        return points
+
+    def with_points(self, points):
+        """
+        Create a new TrackSet with the same structure (tracks, labels) but
+        different points, e.g. the output of a batch operation on self.points.
+
+        :param points: The new point array (n_points x n_dims)
+        """
+        return TrackSet(points, self.offsets.copy(), self.labels,
+                        suffixes=self.suffixes)
+
+    def append(self, label, points):
+        """
+        Create a new TrackSet with an additional track at the end.
+
+        :param label: The label of the new track
+        :param points: The points in the new track.
+        """
+        points = np.reshape(np.asarray(points, dtype=np.float64),
+                            (-1, self.n_dims))
+        offsets = np.append(self.offsets, self.offsets[-1] + len(points))
+        return TrackSet(np.concatenate((self.points, points)),
+                        offsets,
+                        self.labels + [label],
+                        suffixes=self.suffixes)
+
+    def subset(self, indices):
+        """
+        Create a new TrackSet containing only the selected tracks.
+
+        :param indices: The indices of the tracks to keep (in output order).
+        """
+        indices = list(indices)
+        return TrackSet.from_tracks([self.labels[i] for i in indices],
+                                    [self[i] for i in indices],
+                                    suffixes=self.suffixes)
@@ -0,0 +1,188 @@
+"""
+track_store.py
+
+Provides a compact binary (columnar) storage format for track files. The CSV
+files produced by the autotracker and track processing are convenient to look
+at but slow to parse. Each CSV track file is shadowed by a binary '.dt2t' file
+with the same name which stores all points from all tracks in one contiguous
+array, along with an offset index which gives the start of each track.
+
+File layout:
+- 4 byte magic string (DT2T)
+- 2 byte format version (uint16)
+- 4 byte header length (uint32)
+- JSON header (track labels, column suffixes, array sizes and locations)
+- Offsets (int64, n_tracks + 1)
+- Points (float64, n_points x n_dimensions)
+
+Because the point data are stored uncompressed at a fixed location, a single
+track can be read lazily by memory-mapping the file.
+
+The CSV files are still written as the user-facing output. When loading, the
+binary file is used if it is at least as new as the CSV file, otherwise the CSV
+is parsed (and the binary file rebuilt so the next load is fast).
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+from track_set import TrackSet
+
+MAGIC = b'DT2T'
+VERSION = 1
+EXTENSION = '.dt2t'
+
+# Arrays are aligned to this boundary within the file.
+ALIGNMENT = 64
+
+# Magic string, version, header length
+PREAMBLE = struct.Struct('<4sHI')
+
+def store_path(filepath):
+    """
+    Return the binary store path which shadows a given CSV track file.
+
+    :param filepath: The CSV filepath (e.g. raw_tracks.csv)
+    :return: The binary store filepath (e.g. raw_tracks.dt2t)
+    """
+    return os.path.splitext(filepath)[0] + EXTENSION
+
+def read_header(filepath):
+    """
+    Read the header from a binary track file.
+
+    :param filepath: The binary track file.
+    :return: The header dictionary.
+    """
+    with open(filepath, 'rb') as f:
+        magic, version, header_length = PREAMBLE.unpack(f.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a DTrack2 track file.".format(filepath))
+        if version > VERSION:
+            raise ValueError("{} was written by a newer version of DTrack2 ({})."
+                             .format(filepath, version))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+
+    return header
+
+def write_binary(track_set, filepath):
+    """
+    Write a TrackSet to a binary track file. The file is written to a
+    temporary location and then moved into place so an interrupted write
+    cannot leave a corrupt file behind.
+
+    :param track_set: The TrackSet to store.
+    :param filepath: The destination binary track file.
+    """
+    offsets = np.ascontiguousarray(track_set.offsets, dtype='<i8')
+    points = np.ascontiguousarray(track_set.points, dtype='<f8')
+
+    align = lambda x: ALIGNMENT * int(np.ceil(x / ALIGNMENT))
+
+    # Header size depends on the array locations which depend on the header
+    # size, so leave plenty of room for the location fields.
+    header = dict(labels=list(track_set.labels),
+                  suffixes=list(track_set.suffixes),
+                  n_points=int(points.shape[0]),
+                  offsets_start=0,
+                  points_start=0)
+    header_size = len(json.dumps(header).encode('utf-8')) + 64
+    header['offsets_start'] = align(PREAMBLE.size + header_size)
+    header['points_start'] = align(header['offsets_start'] + offsets.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        f.seek(header['offsets_start'])
+        f.write(offsets.tobytes())
+        f.seek(header['points_start'])
+        f.write(points.tobytes())
+    os.replace(tmp_filepath, filepath)
+
+def read_binary(filepath, mmap=False):
+    """
+    Read all tracks from a binary track file.
+
+    :param filepath: The binary track file.
+    :param mmap: If True, the points array is memory-mapped rather than read.
+    :return: The TrackSet.
+    """
+    header = read_header(filepath)
+    n_tracks = len(header['labels'])
+    n_dims = len(header['suffixes'])
+
+    offsets = np.fromfile(filepath,
+                          dtype='<i8',
+                          count=n_tracks + 1,
+                          offset=header['offsets_start'])
+
+    if mmap and header['n_points'] > 0:
+        points = np.memmap(filepath,
+                           dtype='<f8',
+                           mode='r',
+                           offset=header['points_start'],
+                           shape=(header['n_points'], n_dims))
+    else:
+        points = np.fromfile(filepath,
+                             dtype='<f8',
+                             count=header['n_points'] * n_dims,
+                             offset=header['points_start'])
+        points = points.reshape(header['n_points'], n_dims)
+
+    return TrackSet(points, offsets, header['labels'],
+                    suffixes=header['suffixes'])
+
+def read_track(filepath, track):
+    """
+    Lazily read a single track from a binary track file. Only the requested
+    track is read from disk.
+
+    :param filepath: The binary track file.
+    :param track: The track label (e.g. 'track_3') or index within the file.
+    :return: The track points as a (read-only) n x d array.
+    """
+    return read_binary(filepath, mmap=True)[track]
+
+def write_track_set(track_set, filepath):
+    """
+    Write a TrackSet to a CSV file and its binary shadow.
+
+    :param track_set: The TrackSet to store.
+    :param filepath: The CSV filepath.
+    """
+    track_set.to_dataframe().to_csv(filepath)
+    write_binary(track_set, store_path(filepath))
+
+def read_track_set(filepath):
+    """
+    Read a track file as a TrackSet. The binary file is preferred where it is
+    up to date, otherwise the CSV is parsed and the binary file is rebuilt.
+
+    :param filepath: The CSV filepath.
+    :return: The TrackSet.
+    """
+    binary_filepath = store_path(filepath)
+
+    binary_current = os.path.exists(binary_filepath)
+    if binary_current and os.path.exists(filepath):
+        binary_current =\
+            os.path.getmtime(binary_filepath) >= os.path.getmtime(filepath)
+
+    if binary_current:
+        return read_binary(binary_filepath)
+
+    track_set = TrackSet.from_dataframe(pd.read_csv(filepath, index_col=[0]))
+    try:
+        write_binary(track_set, binary_filepath)
+    except OSError:
+        # The binary file is only an accelerator; failing to write it is not
+        # fatal (e.g. read-only project directories).
+        pass
+
+    return track_set
@@ -0,0 +1,42 @@
+"""
+conftest.py
+
+Test setup shared by all tests. The DungTrack modules are run from (and
+import each other from) src.
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
+
+# The parameter file (params.json) is read and created in the working
+# directory when the DungTrack modules are imported, so the tests are run
+# from a temporary directory.
+os.chdir(tempfile.mkdtemp(prefix="dtrack_tests_"))
+
+from dtrack_params import dtrack_params
+from project import project_filepath
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """
+    An empty project (in a temporary directory) selected for the test. The
+    parameter file is written to the temporary directory too.
+
+    :return: The project directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    project_directory = str(tmp_path / "project")
+    os.mkdir(project_directory)
+    with open(project_filepath(project_directory), "w") as f:
+        json.dump(dict(), f)
+
+    dtrack_params.override("project_directory", project_directory)
+    dtrack_params.override("project_file", project_filepath(project_directory))
+    yield project_directory
+    dtrack_params.clear_overrides()
@@ -0,0 +1,96 @@
+"""
+test_calibration.py
+
+Calibration file reading and writing.
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import calibration
+
+def make_calibration():
+    rng = np.random.default_rng(0)
+    return calibration.Calibration(
+        matrix=np.array([[1000.0, 0, 640], [0, 1000.0, 360], [0, 0, 1]]),
+        distortion=np.array([[-0.1, 0.01, 0, 0, 0]]),
+        opt_matrix=np.array([[950.0, 0, 630], [0, 950.0, 350], [0, 0, 1]]),
+        rvecs=tuple(rng.normal(size=(3, 1)) for _ in range(4)),
+        tvecs=tuple(rng.normal(size=(3, 1)) for _ in range(4)),
+        reprojection_error=0.25,
+        perspective_transform=np.array([[1.1, 0.1, 5], [0.0, 1.2, 7], [0, 1e-4, 1]]),
+        scale=np.float32(2.5),
+        bbox_width=1500,
+        bbox_height=900,
+        chessboard_size=(8, 5),
+        chessboard_square_size=39,
+        metadata="Test calibration",
+        per_view_errors=np.array([0.2, 0.3, 0.25, 0.9]),
+        pruned_views=[3])
+
+def assert_same_calibration(expected, actual):
+    assert actual.metadata == expected.metadata
+    for field in ("camera_matrix", "distortion", "opt_matrix",
+                  "perspective_transform", "per_view_errors"):
+        np.testing.assert_array_equal(getattr(actual, field),
+                                      getattr(expected, field))
+    for expected_vec, actual_vec in zip(expected.rvecs, actual.rvecs):
+        np.testing.assert_array_equal(actual_vec, expected_vec)
+    assert actual.chessboard_size == expected.chessboard_size
+    assert actual.pruned_views == expected.pruned_views
+
+    points = np.array([[100.0, 200.0], [640, 360], [np.nan, 5]])
+    np.testing.assert_array_equal(actual.image_to_world(points),
+                                  expected.image_to_world(points))
+
+def test_save_and_load(tmp_path):
+    filepath = str(tmp_path / "calibration.dt2c")
+    calib = make_calibration()
+    calibration.save(calib, filepath)
+
+    assert not calibration.is_legacy(filepath)
+    assert calibration.verify_calibration(filepath)
+    header = calibration.read_header(filepath)
+    assert header["version"] == calibration.FILE_VERSION
+    assert header["metadata"] == "Test calibration"
+
+    assert_same_calibration(calib, calibration.from_file(filepath))
+
+@pytest.mark.parametrize("protocol", [4, 5])
+def test_legacy_file(tmp_path, protocol):
+    filepath = str(tmp_path / "calibration.dt2c")
+    calib = make_calibration()
+    with open(filepath, 'wb') as f:
+        pickle.dump(calib, f, protocol=protocol)
+
+    assert calibration.is_legacy(filepath)
+    assert calibration.verify_calibration(filepath)
+    assert_same_calibration(calib, calibration.from_file(filepath))
+
+    assert calibration.migrate(filepath)
+    assert not calibration.is_legacy(filepath)
+    assert_same_calibration(calib, calibration.from_file(filepath))
+    assert not calibration.migrate(filepath)
+
+class Malicious():
+    def __reduce__(self):
+        return (os.system, ("echo unsafe",))
+
+def test_legacy_file_cannot_run_code(tmp_path):
+    filepath = str(tmp_path / "calibration.dt2c")
+    with open(filepath, 'wb') as f:
+        pickle.dump(Malicious(), f)
+
+    assert not calibration.verify_calibration(filepath)
+    with pytest.raises(calibration.CalibrationFileError):
+        calibration.from_file(filepath)
+
+def test_missing_file(tmp_path):
+    filepath = str(tmp_path / "missing.dt2c")
+
+    assert not calibration.verify_calibration(filepath)
+    with pytest.raises(calibration.CalibrationFileError):
+        calibration.migrate(filepath)
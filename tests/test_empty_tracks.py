@@ -0,0 +1,59 @@
+"""
+test_empty_tracks.py
+
+Tracks with no points (e.g. an all-NaN column in a track file) are carried
+through processing with NaN results.
+"""
+
+import numpy as np
+import pandas as pd
+
+import orientation
+from track_processing import analyse_track_set, zero_track_set
+from track_set import TrackSet
+
+def make_tracks(empty_first=False):
+    """
+    :param empty_first: If True, the empty track comes first.
+    :return: A TrackSet with one 50 point track and one empty track.
+    """
+    t = np.arange(50.0)
+    full = {"x": 10 + t * 2, "y": 20 + t}
+    empty = {"x": np.nan, "y": np.nan}
+    tracks = [full, empty] if not empty_first else [empty, full]
+
+    data = dict()
+    for idx, track in enumerate(tracks):
+        for dim in ("x", "y"):
+            data["track_{}_{}".format(idx, dim)] = track[dim]
+    return TrackSet.from_dataframe(pd.DataFrame(data))
+
+def test_first_and_last_points():
+    for empty_first in (False, True):
+        track_set = make_tracks(empty_first)
+        full = 1 if empty_first else 0
+        empty = 1 - full
+
+        np.testing.assert_array_equal(track_set.lengths[empty], 0)
+        assert np.isnan(track_set.first_points()[empty]).all()
+        assert np.isnan(track_set.last_points()[empty]).all()
+        np.testing.assert_array_equal(track_set.first_points()[full], [10, 20])
+        np.testing.assert_array_equal(track_set.last_points()[full], [108, 69])
+
+def test_processing_with_empty_trailing_track(project):
+    track_set = make_tracks()
+    assert list(track_set.labels) == ["track_0", "track_1"]
+
+    zeroed = zero_track_set(track_set)
+    np.testing.assert_array_equal(zeroed.lengths, [50, 0])
+    np.testing.assert_array_equal(zeroed["track_0"][0], [0, 0])
+
+    stats = analyse_track_set(zeroed, exit_radius=30)
+    assert stats.loc["track_1"].isna().all()
+    np.testing.assert_allclose(stats.loc["track_0", "Exit x (mm)"],
+                               30 * 2 / np.sqrt(5))
+
+    table = orientation.analyse_orientation(zeroed, 30)
+    assert table.loc["track_1"].isna().all()
+    np.testing.assert_allclose(table.loc["track_0", "Exit bearing (deg)"],
+                               np.degrees(np.arctan2(1, 2)))
@@ -0,0 +1,60 @@
+"""
+test_resampling.py
+
+Resampling tracks onto a uniform time base, followed by smoothing.
+"""
+
+import numpy as np
+
+import smoothing
+from track_processing import resample_track_set
+from track_set import TrackSet
+
+def make_tracks():
+    """
+    :return: Multiple return, two tracks (8 s and 20 s long at 10 Hz) and
+             their timestamps (ms).
+    """
+    lengths = (81, 201)
+    tracks = [np.stack((np.arange(n) * 1.5, np.sin(np.arange(n) / 10)), axis=1)
+              for n in lengths]
+    times = [np.arange(n) * 100.0 for n in lengths]
+    return (TrackSet.from_tracks(["track_0", "track_1"], tracks),
+            TrackSet.from_tracks(["track_0", "track_1"], times, suffixes=('',)))
+
+def test_resample_rate(project):
+    track_set, time_data = make_tracks()
+    resampled, timestamps = resample_track_set(track_set, time_data, 2)
+
+    np.testing.assert_array_equal(resampled.lengths, [17, 41])
+    np.testing.assert_allclose(np.diff(timestamps["track_1"][:, 0]), 500)
+    np.testing.assert_allclose(resampled["track_1"][:, 0],
+                               np.arange(41) * 7.5)
+
+def test_low_rate_keeps_enough_points_to_smooth(project):
+    # At 0.2 Hz the first track would only have 2 points.
+    degree = 3
+    track_set, time_data = make_tracks()
+    resampled, timestamps = resample_track_set(track_set,
+                                               time_data,
+                                               0.2,
+                                               min_length=degree + 1)
+
+    np.testing.assert_array_equal(resampled.lengths, [4, 5])
+    np.testing.assert_allclose(timestamps["track_0"][:, 0],
+                               np.linspace(0, 8000, 4))
+    np.testing.assert_allclose(resampled["track_0"][:, 0],
+                               np.linspace(0, 120, 4))
+
+    smoothed = smoothing.smooth(resampled.points,
+                                resampled.offsets,
+                                method="spline",
+                                degree=degree,
+                                smoothing_scale=0.1,
+                                workers=1)
+    assert np.isfinite(smoothed).all()
+
+def test_spline_smooth_short_track():
+    track = np.array([[0.0, 1.0], [1.0, 2.0], [2.0, 2.5]])
+    smoothed = smoothing.spline_smooth_track(track, 3, 0.1)
+    np.testing.assert_array_equal(smoothed, track)